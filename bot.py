@@ -20,31 +20,53 @@ from apscheduler.triggers.interval import IntervalTrigger
 from handlers import common, feedback, divination, pay, daily_card
 from main.botdef import bot
 from main.database import Database
-
-
-async def main():
-    logging.basicConfig(filename="bot.log", encoding="utf-8", level=logging.INFO)
-
-    # Добавляем роутеры к боту
-    # Порядок важен: common — первый (обрабатывает /start, /cancel),
-    # feedback — рано (до unknown_command),
-    # pay — перед divination (приоритет обработчиков оплаты)
+from main.conversions import conversion_buffer
+from main.tasks import supervisor
+from main.dispatcher import dispatcher
+from main import cluster, llm, max_api, max_webhook, outbox, payment_events, scheduled_jobs, update_workers
+from main.config_reader import config as app_config
+# Обработчики отложенных задач регистрируются при импорте
+from main import activation, payment_reminders  # noqa: F401
+from main.yookassa import close_client as close_yookassa_client
+from main.metrika_mp import dispatcher as metrika_dispatcher
+
+
+def setup_routers():
+    """
+    Добавить роутеры к боту (и в процессах-обработчиках main/update_workers.py).
+    Порядок важен: common — первый (обрабатывает /start, /cancel),
+    feedback — рано (до unknown_command),
+    pay — перед divination (приоритет обработчиков оплаты)
+    """
     bot.add_router(common.router)
     bot.add_router(feedback.router)
     bot.add_router(pay.router)
     bot.add_router(divination.router)
     bot.add_router(daily_card.router)
 
-    # ==================== НАСТРОЙКА ОТПРАВКИ КАРТЫ ДНЯ ====================
-    DAILY_CARD_USER_IDS: Optional[List[int]] = None
-    DAILY_CARD_HOUR = 9
-    DAILY_CARD_MINUTE = 25
-    # ======================================================================
 
-    # Настраиваем APScheduler для отправки карты дня
+# ==================== НАСТРОЙКА ОТПРАВКИ КАРТЫ ДНЯ ====================
+DAILY_CARD_USER_IDS: Optional[List[int]] = None
+DAILY_CARD_HOUR = 9
+DAILY_CARD_MINUTE = 25
+# ======================================================================
+
+# ==================== РАССЫЛКИ (Пн/Чт) ====================
+# Окно 10:00–20:00 MSK, тик каждые 30 мин — персональный слот на пользователя
+BROADCAST_CRON_HOURS = '10-20'
+BROADCAST_CRON_MINUTES = '0,30'
+# ========================================================================
+
+
+def setup_scheduler() -> AsyncIOScheduler:
+    """Задачи APScheduler (рассылки, сверка платежей, таймеры, очистки)."""
+    # Настраиваем APScheduler для отправки карты дня.
+    # Несколько инстансов бота: cron-задачи обёрнуты в cluster.once (срабатывание —
+    # ровно на одном узле, рассылки делятся на CLUSTER_SHARDS частей между узлами),
+    # интервальные — в cluster.exclusive (advisory lock), см. main/cluster.py
     scheduler = AsyncIOScheduler()
 
-    async def send_daily_card_job():
+    async def send_daily_card_job(shard=None):
         """Задача для отправки карты дня пользователям"""
         try:
             from handlers.daily_card import send_daily_card_to_all_users
@@ -56,13 +78,13 @@ async def main():
             else:
                 logging.info("Sending daily card to all users from database")
 
-            results = await send_daily_card_to_all_users(user_ids)
+            results = await send_daily_card_to_all_users(user_ids, shard=shard)
             logging.info(f"Daily card job completed: {results}")
         except Exception as e:
             logging.error(f"Error in daily card job: {e}", exc_info=True)
 
     scheduler.add_job(
-        send_daily_card_job,
+        cluster.once('daily_card_morning', send_daily_card_job, shards=app_config.cluster_shards),
         trigger=CronTrigger(
             hour=DAILY_CARD_HOUR,
             minute=DAILY_CARD_MINUTE,
@@ -80,71 +102,22 @@ async def main():
             if not cfg.yookassa_shop_id or not cfg.yookassa_secret_key:
                 return
 
-            from main.database import (
-                get_stale_pending_payments,
-                update_payment_status,
-                process_successful_payment as db_process,
-            )
-            from handlers.pay import check_payment_status, PACKAGES_BY_ID
-
-            stale = await get_stale_pending_payments(minutes=15)
-            if not stale:
-                return
-
-            logging.info(f"Reconciliation: checking {len(stale)} stale pending payment(s)")
-            for p in stale:
-                pid = p['payment_id']
-                try:
-                    info = await check_payment_status(pid)
-                    actual_status = info.get('status')
-
-                    if actual_status == 'succeeded':
-                        await db_process(pid, yookassa_metadata=info)
-                        logging.info(f"Reconciliation: payment {pid} -> succeeded, balance updated")
-                    elif actual_status == 'canceled':
-                        await update_payment_status(pid, 'canceled')
-                        logging.info(f"Reconciliation: payment {pid} -> canceled")
-                except Exception as e:
-                    logging.error(f"Reconciliation error for {pid}: {e}", exc_info=True)
+            from main.reconciliation import reconcile_pending_payments
+            await reconcile_pending_payments()
         except Exception as e:
             logging.error(f"Error in reconcile_pending_payments_job: {e}", exc_info=True)
 
-    # ==================== РАССЫЛКИ (активация + Пн/Чт) ====================
-    # Окно 10:00–20:00 MSK, тик каждые 30 мин — персональный слот на пользователя
-    BROADCAST_CRON_HOURS = '10-20'
-    BROADCAST_CRON_MINUTES = '0,30'
-    # ========================================================================
-
-    async def activation_broadcast_job():
-        """Welcome-активация: ≥24ч после регистрации, без гаданий."""
-        try:
-            from send_message import send_activation_broadcast
-            await send_activation_broadcast()
-        except Exception as e:
-            logging.error(f"Error in activation broadcast job: {e}", exc_info=True)
-
-    scheduler.add_job(
-        activation_broadcast_job,
-        trigger=CronTrigger(
-            hour=BROADCAST_CRON_HOURS,
-            minute=BROADCAST_CRON_MINUTES,
-            timezone='Europe/Moscow'
-        ),
-        id='activation_broadcast',
-        name='Welcome-активация (ежедневно, 10:00–20:00 MSK)',
-        replace_existing=True
-    )
-
-    async def divination_reminder_broadcast_job():
+    async def divination_reminder_broadcast_job(shard=None):
         """Сегментированная рассылка Пн/Чт."""
         try:
             from send_message import send_divination_reminder_broadcast
-            await send_divination_reminder_broadcast()
+            await send_divination_reminder_broadcast(shard=shard)
         except Exception as e:
             logging.error(f"Error in divination-reminder broadcast job: {e}", exc_info=True)
 
     scheduler.add_job(
-        divination_reminder_broadcast_job,
+        cluster.once('divination_reminder_broadcast', divination_reminder_broadcast_job,
+                     shards=app_config.cluster_shards),
         trigger=CronTrigger(
             day_of_week='mon,thu',
             hour=BROADCAST_CRON_HOURS,
@@ -157,77 +130,255 @@ async def main():
     )
 
     scheduler.add_job(
-        reconcile_pending_payments_job,
+        cluster.exclusive('reconcile_pending_payments', reconcile_pending_payments_job),
         trigger=IntervalTrigger(minutes=10),
         id='reconcile_pending_payments',
         name='Сверка pending-платежей с ЮKassa',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+
+    async def scheduled_jobs_job():
+        """Наступившие таймеры: напоминания об оплате (10м / 1ч / 3ч), welcome-активация."""
+        try:
+            from main.scheduled_jobs import run_due_jobs
+            await run_due_jobs()
+        except Exception as e:
+            logging.error(f"Error in scheduled jobs tick: {e}", exc_info=True)
+
+    scheduler.add_job(
+        scheduled_jobs_job,
+        trigger=IntervalTrigger(minutes=1),
+        id='scheduled_jobs',
+        name='Отложенные задачи (напоминания об оплате, активация)',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+
+    async def credit_holds_sweep_job():
+        """Возврат на баланс гаданий из просроченных резервов (расклад прервался)."""
+        try:
+            from main.credit_holds import sweep_expired_holds
+            released = await sweep_expired_holds()
+            if released:
+                logging.info(f"Credit holds sweep: {released} expired hold(s) released")
+        except Exception as e:
+            logging.error(f"Error in credit holds sweep job: {e}", exc_info=True)
+
+    scheduler.add_job(
+        cluster.exclusive('credit_holds_sweep', credit_holds_sweep_job),
+        trigger=IntervalTrigger(minutes=1),
+        id='credit_holds_sweep',
+        name='Возврат гаданий из просроченных резервов',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+
+    async def metrika_retries_job():
+        """Повторная отправка хитов MP, которые не ушли с первого раза."""
+        try:
+            from main.metrika_mp import retry_failed_hits
+            results = await retry_failed_hits()
+            if results['sent'] or results['failed'] or results['dropped']:
+                logging.info(f"Metrika retries job completed: {results}")
+        except Exception as e:
+            logging.error(f"Error in metrika retries job: {e}", exc_info=True)
+
+    scheduler.add_job(
+        cluster.exclusive('metrika_retries', metrika_retries_job),
+        trigger=IntervalTrigger(minutes=5),
+        id='metrika_retries',
+        name='Повторная отправка хитов Метрики MP',
         replace_existing=True
     )
 
-    async def payment_reminders_job():
-        """Напоминания о незавершённой оплате: 10м, 1ч, 3ч после создания платежа."""
+    async def processed_webhooks_cleanup_job():
+        """Удаление старых ключей идемпотентности вебхуков."""
         try:
-            from main.config_reader import config as cfg
-            if not cfg.payment_reminders_enabled:
-                return
+            from main.idempotency import cleanup_processed_webhooks
+            deleted = await cleanup_processed_webhooks()
+            if deleted:
+                logging.info(f"Processed webhooks cleanup: {deleted} row(s) deleted")
+        except Exception as e:
+            logging.error(f"Error in processed webhooks cleanup job: {e}", exc_info=True)
+
+    scheduler.add_job(
+        cluster.once('processed_webhooks_cleanup', processed_webhooks_cleanup_job),
+        trigger=CronTrigger(hour=4, minute=0, timezone='Europe/Moscow'),
+        id='processed_webhooks_cleanup',
+        name='Очистка ключей идемпотентности вебхуков (04:00 MSK)',
+        replace_existing=True
+    )
 
-            from main.payment_reminders import process_payment_reminders
-            results = await process_payment_reminders()
-            if results['sent'] or results['failed']:
-                logging.info(f"Payment reminders job completed: {results}")
+    async def scheduled_jobs_cleanup_job():
+        """Удаление выполненных отложенных задач (30 дней) и истории срабатываний cron (7 дней)."""
+        try:
+            deleted = await scheduled_jobs.cleanup_scheduled_jobs()
+            if deleted:
+                logging.info(f"Scheduled jobs cleanup: {deleted} row(s) deleted")
+            deleted = await cluster.cleanup_job_runs()
+            if deleted:
+                logging.info(f"Job runs cleanup: {deleted} row(s) deleted")
         except Exception as e:
-            logging.error(f"Error in payment reminders job: {e}", exc_info=True)
-
-    from main.config_reader import config as app_config
-    if app_config.payment_reminders_enabled:
-        scheduler.add_job(
-            payment_reminders_job,
-            trigger=IntervalTrigger(minutes=2),
-            id='payment_reminders',
-            name='Напоминания о незавершённой оплате (10м / 1ч / 3ч)',
-            replace_existing=True
-        )
+            logging.error(f"Error in scheduled jobs cleanup job: {e}", exc_info=True)
+
+    scheduler.add_job(
+        cluster.once('scheduled_jobs_cleanup', scheduled_jobs_cleanup_job),
+        trigger=CronTrigger(hour=4, minute=10, timezone='Europe/Moscow'),
+        id='scheduled_jobs_cleanup',
+        name='Очистка выполненных отложенных задач (04:10 MSK)',
+        replace_existing=True
+    )
+
+    return scheduler
+
+
+async def start_background(scheduler: AsyncIOScheduler) -> None:
+    """Запустить планировщик, воркер outbox и LISTEN событий оплаты."""
+    # Таймеры для платежей/пользователей, появившихся до очереди (идемпотентно)
+    await payment_reminders.backfill_payment_reminder_jobs()
+    await activation.backfill_activation_jobs()
 
     scheduler.start()
+    # Воркер outbox: уведомления об оплате и другие отложенные побочные эффекты
+    outbox.worker.start()
+    # LISTEN на события оплаты: мгновенный сброс FSM и отправка уведомления
+    payment_events.listener.start()
     logging.info(f"APScheduler started - daily card will be sent at {DAILY_CARD_HOUR:02d}:{DAILY_CARD_MINUTE:02d} (Moscow time)")
-    logging.info(
-        f"APScheduler: activation broadcast daily {BROADCAST_CRON_HOURS} MSK "
-        f"(every {BROADCAST_CRON_MINUTES} min)"
-    )
     logging.info(
         f"APScheduler: divination-reminder broadcast Mon/Thu {BROADCAST_CRON_HOURS} MSK "
         f"(every {BROADCAST_CRON_MINUTES} min)"
     )
     logging.info("APScheduler: pending payments reconciliation every 10 minutes")
-    if app_config.payment_reminders_enabled:
-        logging.info("APScheduler: payment reminders every 2 minutes (10m / 1h / 3h stages)")
-    else:
+    logging.info("APScheduler: Metrika MP retries every 5 minutes")
+    logging.info("APScheduler: expired divination holds sweep every minute")
+    logging.info("APScheduler: scheduled jobs (activation, payment reminders) every minute")
+    logging.info(f"APScheduler: cluster node {cluster.NODE_ID}, broadcast shards: {app_config.cluster_shards}")
+    if not app_config.payment_reminders_enabled:
         logging.info("APScheduler: payment reminders DISABLED (PAYMENT_REMINDERS_ENABLED=false)")
 
-    # Запускаем webhook сервер для ЮKassa (если настроены ключи)
+
+async def close_resources() -> None:
+    """
+    Дождаться фоновых задач (гадания из WebApp и т.п.), затем дописать
+    буфер конверсий и очередь MP до закрытия пула.
+    """
+    await payment_events.listener.stop()
+    await dispatcher.drain()
+    await supervisor.drain()
+    await outbox.worker.stop()
+    await conversion_buffer.stop()
+    await metrika_dispatcher.stop()
+    await max_api.close_session()
+    await llm.close_session()
+    await close_yookassa_client()
+    await Database.close_pool()
+
+
+async def main():
+    """Один процесс: апдейты, вебхуки и планировщик (без BOT_SUPERVISOR)."""
+    logging.basicConfig(filename="bot.log", encoding="utf-8", level=logging.INFO)
+
+    setup_routers()
+    # Апдейты одного пользователя — по очереди, разных — параллельно (main/dispatcher.py)
+    dispatcher.install(bot)
+    webhook_mode = max_webhook.enabled()
+
+    scheduler = setup_scheduler()
+    await start_background(scheduler)
+
+    # Пул процессов-обработчиков апдейтов (только в режиме webhook)
+    update_pool = None
+    if webhook_mode and app_config.update_worker_processes > 0:
+        update_pool = update_workers.start_pool(app_config.update_worker_processes)
+        max_webhook.set_worker_pool(update_pool)
+
+    # Запускаем webhook сервер для ЮKassa (если настроены ключи) и апдейтов MAX (режим webhook)
     webhook_runner = None
     try:
         from main.config_reader import config
         from webhook_server import start_webhook_server
-        if config.yookassa_shop_id and config.yookassa_secret_key:
+        if webhook_mode or (config.yookassa_shop_id and config.yookassa_secret_key):
             port = int(os.environ.get('PORT', 8081))
             webhook_runner = await start_webhook_server(port)
-            logging.info(f"Webhook server started for YooKassa notifications on port {port}")
+            logging.info(f"Webhook server started on port {port}")
         else:
             logging.info("YooKassa keys not configured, webhook server not started")
     except Exception as e:
+        if webhook_mode:
+            raise
         logging.warning(f"Could not start webhook server: {e}")
 
-    # Запускаем бота (long polling)
+    # Запускаем бота: апдейты вебхуком (BOT_UPDATES_MODE=webhook) или long polling
     try:
-        await bot.start_polling()
+        if webhook_mode:
+            await max_webhook.run()
+        else:
+            await max_webhook.remove_subscription()
+            await bot.start_polling()
     finally:
         scheduler.shutdown()
         logging.info("APScheduler stopped")
-        await Database.close_pool()
+        if update_pool:
+            await update_pool.stop()
         if webhook_runner:
             await webhook_runner.cleanup()
+            from webhook_server import webapp_jobs
+            await webapp_jobs.stop()
+        await close_resources()
+
+
+async def run_scheduler_role() -> None:
+    """Процесс планировщика (BOT_SUPERVISOR): cron/интервальные задачи, outbox, LISTEN оплат."""
+    scheduler = setup_scheduler()
+    # Рассылки и карта дня шлют сообщения через сессию бота
+    await max_webhook.open_bot_session()
+    await start_background(scheduler)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        scheduler.shutdown()
+        logging.info("APScheduler stopped")
+        await close_resources()
+        await max_webhook.close_bot_session()
+
+
+async def run_web_role(queues) -> None:
+    """
+    Веб-процесс (BOT_SUPERVISOR): вебхуки ЮKassa, WebApp, приём апдейтов MAX
+    (вебхуком или long polling). Апдейты не обрабатываются здесь, а уходят
+    процессам-обработчикам через очереди queues (шард — user_id % N).
+    """
+    from webhook_server import start_webhook_server, webapp_jobs
+
+    router = update_workers.UpdateRouter(queues)
+    update_workers.set_router(router)
+    max_webhook.set_worker_pool(router)
+
+    port = int(os.environ.get('PORT', 8081))
+    webhook_runner = await start_webhook_server(port)
+    logging.info(f"Webhook server started on port {port}")
+    try:
+        if max_webhook.enabled():
+            await max_webhook.run()
+        else:
+            await max_webhook.remove_subscription()
+            # Цикл polling только принимает апдейты и ждёт места в очереди шарда
+            bot.update_sink = router.put
+            await bot.start_polling()
+    finally:
+        await webhook_runner.cleanup()
+        await webapp_jobs.stop()
+        await close_resources()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if app_config.bot_supervisor:
+        # Несколько процессов: веб, планировщик, обработчики апдейтов (main/process_supervisor.py)
+        from main.process_supervisor import run_supervisor
+        run_supervisor()
+    else:
+        asyncio.run(main())
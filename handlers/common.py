@@ -14,7 +14,6 @@
 Кампания Директ → лендинг → бот: start-параметр с лендинга в формате
 __client_id__XXX__camp_YYY (client_id Метрики и utm_campaign) парсится и сохраняется в БД.
 """
-import asyncio
 import logging
 from typing import Optional, Tuple
 
@@ -27,8 +26,8 @@ from main.database import (
     create_user_balance, get_and_delete_webapp_follow_up_context,
     has_paid_access, mark_channel_subscribed, clear_channel_subscribed,
 )
-from main.conversions import save_conversion, save_paywall_conversion
-from main.metrika_mp import generate_metrika_client_id, send_pageview, send_conversion_event
+from main.conversions import track_conversion, track_paywall_conversion
+from main.metrika_mp import generate_metrika_client_id, send_pageview, track_conversion_event
 from main.config_reader import config
 
 router = aiomax.Router()
@@ -199,7 +198,7 @@ async def cmd_start(payload: aiomax.BotStartPayload, cursor: fsm.FSMCursor):
 
             # Сохраняем конверсию регистрации
             try:
-                await save_conversion(
+                track_conversion(
                     user_id=payload.user.user_id,
                     conversion_type="registration",
                     source=source,
@@ -282,7 +281,7 @@ async def cmd_start_command(ctx: aiomax.CommandContext, cursor: fsm.FSMCursor):
         if is_new:
             logging.info(f"New user registered via /start: {ctx.sender.user_id} with source={source}")
             try:
-                await save_conversion(
+                track_conversion(
                     user_id=ctx.sender.user_id,
                     conversion_type="registration",
                     source=source,
@@ -360,8 +359,8 @@ async def consultation_menu_button(message: aiomax.Message, cursor: fsm.FSMCurso
     logging.info(f"consultation_menu: user_id={user_id}")
 
     try:
-        await save_paywall_conversion(user_id=user_id, paywall_source="menu_consultation")
-        asyncio.create_task(send_conversion_event(user_id, 'paywall'))
+        track_paywall_conversion(user_id=user_id, paywall_source="menu_consultation")
+        track_conversion_event(user_id, 'paywall')
     except Exception as e:
         logging.error(f"Error saving paywall conversion (consultation): {e}", exc_info=True)
 
@@ -446,7 +445,7 @@ async def _show_balance(msg, cursor: fsm.FSMCursor):
                 balance_text += "Гадания закончились — нажми ◀ В меню → Купить расклады 💎"
                 
                 try:
-                    await save_paywall_conversion(
+                    track_paywall_conversion(
                         user_id=user_id,
                         paywall_source="balance_view",
                         metadata={
@@ -456,7 +455,7 @@ async def _show_balance(msg, cursor: fsm.FSMCursor):
                             'access_type': access_type,
                         }
                     )
-                    asyncio.create_task(send_conversion_event(user_id, 'paywall'))
+                    track_conversion_event(user_id, 'paywall')
                 except Exception as e:
                     logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
             else:
@@ -9,16 +9,19 @@
 import logging
 import random
 import os
-import asyncio
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import aiomax
 from aiomax import buttons
 
 from keyboards.main_menu import make_back_to_menu_kb
+from main import messages, outbox
 from main.botdef import bot
+from main.broadcast_schedule import MSK
+from main.cluster import in_shard
 from main.database import (
+    Database,
     get_all_users,
     update_user_blocked_status,
     is_send_blocked_error,
@@ -57,15 +60,28 @@ async def create_daily_card_keyboard(user_id: int) -> buttons.KeyboardBuilder:
     return kb
 
 
+DAILY_CARD_TEXT = (
+    "🌅 <b>Доброе утро! Выбери свою карту дня</b>\n\n"
+    "Каждый день — новый ответ Вселенной. "
+    "Нажми на одну из карт, чтобы узнать послание дня ✨"
+)
+# Сколько сообщений ставить в outbox одной транзакцией
+DAILY_CARD_ENQUEUE_CHUNK = 1000
+
+
+async def build_daily_card_message(user_id: int):
+    """Текст и клавиатура карты дня (карты и кнопка оплаты — на момент отправки)"""
+    kb = await create_daily_card_keyboard(user_id)
+    return DAILY_CARD_TEXT, kb
+
+
 async def send_daily_card_message(user_id: int, auto_update_blocked_status: bool = True) -> bool:
     """Отправить сообщение с картой дня пользователю"""
     try:
-        kb = await create_daily_card_keyboard(user_id)
+        text, kb = await build_daily_card_message(user_id)
         
         await bot.send_message(
-            "🌅 <b>Доброе утро! Выбери свою карту дня</b>\n\n"
-            "Каждый день — новый ответ Вселенной. "
-            "Нажми на одну из карт, чтобы узнать послание дня ✨",
+            text,
             user_id=user_id,
             keyboard=kb,
             format='html'
@@ -82,35 +98,45 @@ async def send_daily_card_message(user_id: int, auto_update_blocked_status: bool
         return False
 
 
-async def send_daily_card_to_all_users(user_ids: Optional[List[int]] = None) -> dict:
-    """Отправить карту дня всем пользователям (или списку)"""
-    results = {'sent': 0, 'failed': 0, 'blocked': 0, 'skipped': 0}
+async def send_daily_card_to_all_users(
+    user_ids: Optional[List[int]] = None,
+    shard: Optional[Tuple[int, int]] = None
+) -> dict:
+    """
+    Поставить карту дня в outbox всем пользователям (или списку); отправляет воркер outbox.
+    Повторный запуск в тот же день не дублирует сообщения (dedupe_key на дату).
+    shard=(i, N) — только пользователи с user_id % N == i (часть рассылки для узла кластера).
+    """
+    results = {'queued': 0, 'skipped': 0}
     
     if user_ids:
-        targets = [{'user_id': uid} for uid in user_ids]
+        targets = []
+        for uid in user_ids:
+            if await get_user_daily_card_subscription(uid):
+                targets.append(uid)
+            else:
+                results['skipped'] += 1
     else:
-        targets = await get_all_users(include_blocked=False, include_unsubscribed_daily_card=False)
-    
-    for user in targets:
-        uid = user['user_id']
-        
+        # get_all_users уже исключает заблокированных и отписавшихся
+        users = await get_all_users(include_blocked=False, include_unsubscribed_daily_card=False)
+        targets = [u['user_id'] for u in users]
+    targets = [uid for uid in targets if in_shard(uid, shard)]
+
+    day = datetime.now(MSK).strftime('%Y-%m-%d')
+    await outbox.ensure_outbox_table_once()
+    pool = await Database.get_pool()
+    for start in range(0, len(targets), DAILY_CARD_ENQUEUE_CHUNK):
+        chunk = targets[start:start + DAILY_CARD_ENQUEUE_CHUNK]
         try:
-            is_subscribed = await get_user_daily_card_subscription(uid)
-            if not is_subscribed:
-                results['skipped'] += 1
-                continue
-            
-            success = await send_daily_card_message(uid)
-            if success:
-                results['sent'] += 1
-            else:
-                results['blocked'] += 1
-            
-            await asyncio.sleep(0.1)
-            
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await messages.enqueue_many(
+                        conn, 'daily_card', [(uid, None, f"daily_card:{uid}:{day}") for uid in chunk]
+                    )
+            results['queued'] += len(chunk)
+            outbox.worker.wake()
         except Exception as e:
-            logging.error(f"Error processing user {uid}: {e}", exc_info=True)
-            results['failed'] += 1
+            logging.error(f"Error queueing daily card for {len(chunk)} user(s): {e}", exc_info=True)
     
     logging.info(f"Daily card results: {results}")
     return results
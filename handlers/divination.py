@@ -7,11 +7,11 @@
 - message.sender.user_id вместо message.from_user.id
 - bot.upload_image() вместо FSInputFile для отправки изображений
 """
+import asyncio
 import logging
 import random
 import re
 import time
-import aiohttp
 
 import aiomax
 from aiomax import fsm, filters, buttons
@@ -21,7 +21,8 @@ from keyboards.main_menu import make_main_menu, make_back_to_menu_kb
 from handlers.tarot_cards import (
     create_card_selection_keyboard, interpret_cards, get_card_image_path,
     get_all_available_cards, send_card_images, get_card_info, TAROT_CARDS,
-    get_random_cards, combine_cards_image
+    get_random_cards, combine_cards_image,
+    compose_offline_reading as compose_offline_tarot_reading,
 )
 from handlers.tarot_card_parser import (
     parse_cards_from_text,
@@ -31,16 +32,29 @@ from handlers.tarot_card_parser import (
 )
 from handlers.hexagrams import (
     get_all_available_hexagrams, get_hexagram_image_path,
-    send_hexagram_image, get_hexagram_info, HEXAGRAMS
+    send_hexagram_image, get_hexagram_info, HEXAGRAMS,
+    compose_offline_reading as compose_offline_hexagram_reading,
 )
-from main.database import can_user_divinate, use_divination, save_divination, get_user_balance, update_divination_interpretation, save_pending_question, get_and_delete_webapp_follow_up_context
-from main.conversions import save_conversion, save_paywall_conversion
-from main.metrika_mp import send_conversion_event
+from main.database import (
+    update_divination_interpretation, save_pending_question,
+    get_and_delete_webapp_follow_up_context, save_divination, replace_divination_interpretation,
+)
+from main import credit_holds, llm, metrics
+from main.llm_context import compact_history
+from main.config_reader import config
+from main.tasks import supervisor
+from main.conversions import track_conversion, track_paywall_conversion
+from main.metrika_mp import track_conversion_event
 
 # Лимиты уточняющих вопросов после расклада
 FOLLOW_UP_LIMIT_FREE = 2
 FOLLOW_UP_LIMIT_PAID = 5
 
+NO_DIVINATIONS_TEXT = (
+    "❌ <b>У вас закончились гадания</b>\n\n"
+    "Нажми ◀ В меню → Купить расклады 💎"
+)
+
 # FSM состояния (строковые для aiomax)
 STATE_CHOOSING_DIVINATION = 'choosing_divination'
 STATE_WAITING_FOR_QUESTION = 'waiting_for_question'
@@ -141,36 +155,26 @@ async def process_divination_question(message: aiomax.Message, cursor: fsm.FSMCu
     await process_divination_internal(message, cursor, text)
 
 
+def track_divination_blocked(user_id: int, divination_type: str, question: str | None) -> None:
+    """Paywall-конверсия: гадать нечем (credit_holds.reserve() вернул None)."""
+    try:
+        track_paywall_conversion(
+            user_id=user_id,
+            paywall_source="divination_blocked",
+            metadata={'divination_type': divination_type, 'question': question[:100] if question else None}
+        )
+        track_conversion_event(user_id, 'paywall')
+    except Exception as e:
+        logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
+
+
 async def process_divination_internal(message: aiomax.Message, cursor: fsm.FSMCursor, question: str):
     """Основная логика гадания"""
     user_id = message.sender.user_id
     logging.info(f"process_divination_internal: user_id={user_id}")
     
-    # Проверяем баланс
-    can_div, access_type = await can_user_divinate(user_id)
-    if not can_div:
-        try:
-            data = cursor.get_data() or {}
-            divination_type = data.get("divination_type", "неизвестно")
-            await save_paywall_conversion(
-                user_id=user_id,
-                paywall_source="divination_blocked",
-                metadata={'divination_type': divination_type, 'question': question[:100] if question else None}
-            )
-            import asyncio
-            asyncio.create_task(send_conversion_event(user_id, 'paywall'))
-        except Exception as e:
-            logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
-        
-        await message.reply(
-            "❌ <b>У вас закончились гадания</b>\n\n"
-            "Нажми ◀ В меню → Купить расклады 💎",
-            keyboard=make_back_to_menu_kb(),
-            format='html'
-        )
-        cursor.clear()
-        return
-    
+    # Баланс отдельно не проверяем: гадание списывает credit_holds.reserve() в начале
+    # расклада, гаданий нет — он вернёт None (track_divination_blocked)
     data = cursor.get_data() or {}
     divination_type = data.get("divination_type", "гадание")
     data['question'] = question
@@ -188,7 +192,18 @@ async def _do_iching_divination(message: aiomax.Message, cursor: fsm.FSMCursor,
     """Гадание по Ицзин"""
     from main.botdef import bot
     
+    # Резерв гадания на время расклада: второй одновременный расклад его не получит
+    hold = await credit_holds.reserve(user_id, "Ицзин")
+    if hold is None:
+        track_divination_blocked(user_id, "Ицзин", question)
+        await message.reply(NO_DIVINATIONS_TEXT, keyboard=make_back_to_menu_kb(), format='html')
+        cursor.clear()
+        return
+    
     processing_msg = await message.reply("🔮 Провожу гадание...")
+    late_task = None
+    divination_id = None
+    settled = False
     
     try:
         all_hexagrams = get_all_available_hexagrams()
@@ -198,65 +213,41 @@ async def _do_iching_divination(message: aiomax.Message, cursor: fsm.FSMCursor,
         hexagram_name = hexagram_info['name']
         hexagram_meaning = hexagram_info['meaning']
         
-        # Отправляем изображение гексаграммы
-        try:
-            chat_id = message.recipient.chat_id
-            await send_hexagram_image(bot, chat_id, random_hexagram_id)
-        except Exception as e:
-            logging.warning(f"Не удалось отправить изображение гексаграммы: {e}")
-        
-        # Редактируем сообщение о процессе
-        try:
-            await bot.edit_message(processing_msg.body.mid, text="🔮 Толкую гексаграмму...")
-        except:
-            pass
-        
         # ChatGPT толкование
         system_prompt = ICHING_SYSTEM_PROMPT
-        chatgpt_question = (
-            f"Вопрос пользователя: {question}\n\n"
-            f"Выпавшая гексаграмма: {hexagram_name}\n"
-            f"Значение гексаграммы: {hexagram_meaning}\n\n"
-            f"{ICHING_USER_INSTRUCTION}"
-        )
-        
-        chatgpt_response = await get_chatgpt_response_with_prompt(chatgpt_question, system_prompt)
-        
-        # Списываем гадание
-        balance_before = await get_user_balance(user_id)
-        is_free = balance_before and balance_before['free_divinations_remaining'] > 0 if balance_before else True
+        chatgpt_question = iching_user_prompt(question, hexagram_name, hexagram_meaning)
         
-        used = await use_divination(user_id)
-        if not used:
-            await message.reply("❌ Произошла ошибка при списании гадания.", keyboard=make_back_to_menu_kb())
-            cursor.clear()
-            return
+        # Изображение гексаграммы, статус и толкование — параллельно
+        chat_id = message.recipient.chat_id
+        _, _, (chatgpt_response, late_task) = await asyncio.gather(
+            send_quietly(send_hexagram_image(bot, chat_id, random_hexagram_id), "изображение гексаграммы"),
+            send_quietly(bot.edit_message(processing_msg.body.mid, text="🔮 Толкую гексаграмму..."), "статус гадания"),
+            interpret_with_deadline(get_chatgpt_response_with_prompt(
+                chatgpt_question, system_prompt, lane=llm_lane(hold['access_type']), hedge=True
+            )),
+        )
+        offline = chatgpt_response is None
+        if offline:
+            chatgpt_response = compose_offline_hexagram_reading(random_hexagram_id, question)
         
-        # Сохраняем в БД
-        divination_id = await save_divination(
-            user_id=user_id,
-            divination_type="Ицзин",
+        # Закрываем резерв и сохраняем гадание — одной транзакцией
+        # (краткое толкование без LLM не списывается)
+        divination_id = await settle_reading(
+            hold,
             question=question,
-            selected_cards=[random_hexagram_id],
             interpretation=chatgpt_response,
-            is_free=is_free
+            selected_cards=[random_hexagram_id],
+            offline=offline,
+            upgrade_pending=late_task is not None,
         )
+        settled = True
+        is_free = hold['is_free']
         
-        if divination_id:
-            try:
-                await save_conversion(
-                    user_id=user_id, conversion_type='service_usage',
-                    divination_type="Ицзин",
-                    metadata={'divination_id': divination_id, 'hexagram_id': random_hexagram_id, 'is_free': is_free}
-                )
-                import asyncio
-                asyncio.create_task(send_conversion_event(user_id, 'service_usage'))
-            except Exception as e:
-                logging.error(f"Error saving conversion: {e}", exc_info=True)
-        
-        follow_up_limit = FOLLOW_UP_LIMIT_FREE if is_free else FOLLOW_UP_LIMIT_PAID
         conversation_history = [
-            {"role": "user", "content": f"Мой вопрос: {question}"},
+            {"role": "user", "content": (
+                f"Мой вопрос: {question}\n"
+                f"Выпавшая гексаграмма: {hexagram_name} — {hexagram_meaning}"
+            )},
             {"role": "assistant", "content": chatgpt_response}
         ]
         
@@ -275,14 +266,50 @@ async def _do_iching_divination(message: aiomax.Message, cursor: fsm.FSMCursor,
             f"<b>Ваш вопрос:</b> <i>«{question}»</i>\n\n"
             f"<b>Выпавшая гексаграмма:</b> {hexagram_name}\n\n"
             f"<b>Толкование:</b>\n{chatgpt_response}\n\n"
-            "💬 Хочешь уточнить расклад? Просто напиши свой вопрос.\n"
+            + (f"{offline_note(late_task is not None, 'значению гексаграммы')}\n\n" if offline else "")
+            + "💬 Хочешь уточнить расклад? Просто напиши свой вопрос.\n"
             "🔮 Новый расклад — нажми ◀ В меню",
             keyboard=make_back_to_menu_kb(),
             format='html'
         )
         
+        if late_task is not None:
+            # Дальше резервом и запросом к LLM распоряжается deliver_full_interpretation
+            task, late_task = late_task, None
+            await spawn_full_interpretation(
+                task,
+                hold=hold,
+                divination_id=divination_id,
+                offline_text=chatgpt_response,
+                send=lambda text: bot.send_message(
+                    text, chat_id=chat_id, keyboard=make_back_to_menu_kb(), format='html'
+                ),
+                on_ready=fsm_interpretation_updater(cursor, divination_id),
+            )
+        
+        # Аналитика — после ответа пользователю
+        track_service_usage(
+            user_id, "Ицзин",
+            {'divination_id': divination_id, 'hexagram_id': random_hexagram_id,
+             'is_free': is_free, 'offline': offline}
+        )
+        
+    except asyncio.CancelledError:
+        await abort_reading(hold, late_task=late_task, divination_id=divination_id, settled=settled)
+        raise
+    
+    except credit_holds.HoldExpiredError as e:
+        # Резерв вернули по TTL, а гаданий больше нет — толкование не сохранено и не показано
+        logging.warning(f"I-Ching reading not charged: {e}")
+        track_divination_blocked(user_id, "Ицзин", question)
+        await message.reply(NO_DIVINATIONS_TEXT, keyboard=make_back_to_menu_kb(), format='html')
+        cursor.clear()
+        return
+    
     except Exception as e:
         logging.error(f"Error in I-Ching divination: {e}", exc_info=True)
+        # До сохранения гадание возвращается на баланс (после commit release ничего не делает)
+        await abort_reading(hold, late_task=late_task, divination_id=divination_id, settled=settled)
         await message.reply("❌ Произошла ошибка при гадании. Попробуйте позже.", keyboard=make_back_to_menu_kb())
         cursor.clear()
         return
@@ -296,6 +323,196 @@ async def _do_iching_divination(message: aiomax.Message, cursor: fsm.FSMCursor,
     cursor.change_state(STATE_CHATTING)
 
 
+async def send_quietly(coro, what: str) -> None:
+    """Необязательный шаг расклада (картинка, статус): ошибка не прерывает гадание."""
+    try:
+        await coro
+    except Exception as e:
+        logging.warning(f"Не удалось отправить {what}: {e}")
+
+
+def track_service_usage(user_id: int, divination_type: str, metadata: dict) -> None:
+    """Конверсия service_usage (буфер main/conversions.py) и хит Метрики."""
+    try:
+        track_conversion(
+            user_id=user_id, conversion_type='service_usage',
+            divination_type=divination_type, metadata=metadata
+        )
+        track_conversion_event(user_id, 'service_usage')
+    except Exception as e:
+        logging.error(f"Error saving conversion: {e}", exc_info=True)
+
+
+# ==================== Краткое толкование без LLM ====================
+#
+# Расклад не должен зависать из-за проблем провайдера: если LLM не ответил за
+# LLM_READING_DEADLINE_SEC или недоступен (автоматы разомкнуты, попытки исчерпаны),
+# пользователь сразу получает толкование по шаблонам из значений карт/гексаграммы.
+# Краткое толкование сохраняется бесплатным. Если LLM недоступен, резерв сразу
+# возвращается на баланс. Если LLM просто не успел, резерв остаётся открытым, а его
+# ответ дожидается фоновая задача: полное толкование приходит отдельным сообщением
+# и только тогда гадание списывается; не дождались — резерв возвращается.
+
+# Сколько ещё ждать полного толкования после краткого
+LATE_INTERPRETATION_MAX_SEC = 180
+
+_offline_stats = {'readings': 0, 'deadline': 0, 'unavailable': 0, 'upgraded': 0, 'upgrade_failed': 0}
+
+
+def offline_note(pending: bool, source: str = "значениям карт") -> str:
+    """Пометка краткого толкования в ответе."""
+    if pending:
+        return (
+            f"⚡ <i>Это краткое толкование по {source}: сервис толкований сейчас отвечает медленно. "
+            "Полное толкование пришлю следом — гадание спишется только вместе с ним.</i>"
+        )
+    return (
+        f"⚡ <i>Это краткое толкование по {source}: сервис толкований сейчас недоступен. "
+        "Гадание не списано.</i>"
+    )
+
+
+async def interpret_with_deadline(llm_call) -> tuple[str | None, asyncio.Task | None]:
+    """
+    Толкование LLM, но не дольше LLM_READING_DEADLINE_SEC.
+    (текст, None) — LLM ответил вовремя; (None, task) — не успел, task продолжает ждать
+    ответ (см. deliver_full_interpretation); (None, None) — LLM недоступен.
+    """
+    _offline_stats['readings'] += 1
+    task = asyncio.ensure_future(llm_call)
+    try:
+        done, _ = await asyncio.wait({task}, timeout=config.llm_reading_deadline_sec)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if not done:
+        _offline_stats['deadline'] += 1
+        logging.warning(f"LLM did not answer in {config.llm_reading_deadline_sec}s, sending offline reading")
+        return None, task
+    try:
+        return task.result(), None
+    except llm.LLMError as e:
+        _offline_stats['unavailable'] += 1
+        logging.warning(f"LLM unavailable for reading, sending offline reading: {e}")
+        return None, None
+
+
+async def settle_reading(
+    hold: dict,
+    *,
+    question: str,
+    interpretation: str,
+    selected_cards: list[str],
+    offline: bool,
+    upgrade_pending: bool = False,
+) -> int | None:
+    """
+    Закрыть резерв гадания: толкование LLM — списать и сохранить (credit_holds.commit);
+    краткое толкование — сохранить без списания, резерв вернуть. upgrade_pending —
+    полное толкование ещё ждём: резерв остаётся открытым до deliver_full_interpretation.
+    """
+    if not offline:
+        return await credit_holds.commit(
+            hold, question=question, interpretation=interpretation, selected_cards=selected_cards
+        )
+    if not upgrade_pending:
+        await credit_holds.release(hold)
+    return await save_divination(
+        hold['user_id'], hold['divination_type'], question,
+        selected_cards=selected_cards, interpretation=interpretation, is_free=True,
+    )
+
+
+async def deliver_full_interpretation(
+    task: asyncio.Task,
+    *,
+    hold: dict,
+    divination_id: int | None,
+    offline_text: str,
+    send,
+    on_ready=None,
+) -> None:
+    """
+    Дождаться толкования LLM после краткого, прислать его отдельным сообщением и
+    списать гадание (резерв hold). Не дождались или не отправили — резерв возвращается.
+    send(text) — отправка пользователю, on_ready(text) — обновить контекст уточняющих вопросов.
+    """
+    try:
+        text = await asyncio.wait_for(task, LATE_INTERPRETATION_MAX_SEC)
+        await send(f"✨ <b>Полное толкование</b>\n\n{text}")
+    except asyncio.CancelledError:
+        await credit_holds.release(hold)
+        raise
+    except Exception as e:
+        _offline_stats['upgrade_failed'] += 1
+        logging.warning(f"Full interpretation for divination {divination_id} not delivered: {e}")
+        await credit_holds.release(hold)
+        return
+    _offline_stats['upgraded'] += 1
+    try:
+        try:
+            await credit_holds.commit_saved(hold, divination_id)
+        except credit_holds.HoldExpiredError as e:
+            # Толкование уже отправлено; гадание остаётся бесплатным
+            logging.warning(f"Full interpretation for divination {divination_id} not charged: {e}")
+        if divination_id:
+            await replace_divination_interpretation(divination_id, offline_text, text)
+        if on_ready is not None:
+            await on_ready(text)
+    except Exception as e:
+        logging.error(f"Error saving full interpretation for divination {divination_id}: {e}", exc_info=True)
+
+
+async def spawn_full_interpretation(task: asyncio.Task, *, hold: dict, **kwargs) -> None:
+    """
+    Запустить deliver_full_interpretation в фоне; нет места в пуле — ответ LLM
+    не ждём и возвращаем резерв.
+    """
+    if supervisor.spawn(
+        "default", deliver_full_interpretation(task, hold=hold, **kwargs), name="full_interpretation"
+    ) is None:
+        task.cancel()
+        await credit_holds.release(hold)
+
+
+async def abort_reading(hold: dict, *, late_task: asyncio.Task | None, divination_id: int | None,
+                        settled: bool) -> None:
+    """
+    Ошибка посреди расклада. late_task — ожидание полного толкования, ещё не переданное
+    spawn_full_interpretation (после передачи — None): запрос к LLM отменяется.
+    До settle_reading резерв возвращается на баланс; после — гадание уже сохранено,
+    и открытый резерв (ждали полного толкования) закрывается за него (commit_saved).
+    """
+    if late_task is not None:
+        late_task.cancel()
+    if not settled:
+        await credit_holds.release(hold)
+    elif late_task is not None:
+        try:
+            await credit_holds.commit_saved(hold, divination_id)
+        except Exception as e:
+            logging.error(f"Error closing hold {hold['id']} for divination {divination_id}: {e}", exc_info=True)
+
+
+def fsm_interpretation_updater(cursor: fsm.FSMCursor, divination_id: int | None):
+    """on_ready для deliver_full_interpretation: заменить толкование в FSM, если расклад тот же."""
+    async def update(text: str) -> None:
+        data = cursor.get_data() or {}
+        if divination_id is None or data.get('divination_id') != divination_id:
+            return
+        history = data.get('conversation_history') or []
+        # После сжатия (main/llm_context.py) на месте толкования — краткое содержание
+        if len(history) > 1 and history[1].get('content') == data.get('original_interpretation'):
+            history[1]['content'] = text
+        data['conversation_history'] = history
+        data['original_interpretation'] = text
+        cursor.change_data(data)
+    return update
+
+
+metrics.register("offline_readings", lambda: dict(_offline_stats))
+
+
 # ==================== Таро ====================
 
 async def _do_tarot_divination(message: aiomax.Message, cursor: fsm.FSMCursor, question: str, user_id: int):
@@ -340,59 +557,52 @@ async def _finish_tarot_reading(
     data: dict,
     method: str = 'random',
 ) -> bool:
-    """Отправить карты, получить толкование, списать гадание."""
-    try:
-        await send_card_images(bot, chat_id, card_ids, as_media_group=True)
+    """
+    Отправить карты, получить толкование, списать гадание.
+    Гадание резервируется в начале (main/credit_holds.py) и списывается вместе
+    с сохранением после ответа LLM; при ошибке резерв возвращается на баланс.
+    Картинка и толкование готовятся параллельно, аналитика — после ответа.
+    """
+    hold = await credit_holds.reserve(user_id, "Таро")
+    if hold is None:
+        track_divination_blocked(user_id, "Таро", question)
+        await bot.send_message(
+            NO_DIVINATIONS_TEXT, chat_id=chat_id, keyboard=make_back_to_menu_kb(), format='html'
+        )
+        cursor.clear()
+        return False
 
+    late_task = None
+    divination_id = None
+    settled = False
+    try:
         cards_info = []
         positions = ["Прошлое", "Настоящее", "Будущее"]
         for i, card_id in enumerate(card_ids):
             card = get_card_info(card_id)
             cards_info.append(f"{positions[i]}: {card['name']} — {card['meaning']}")
 
-        chatgpt_question = (
-            f"Вопрос пользователя: {question}\n\n"
-            f"Выпавшие карты:\n" + "\n".join(cards_info) + "\n\n"
-            f"{TAROT_USER_INSTRUCTION}"
+        chatgpt_question = tarot_user_prompt(question, cards_info)
+        _, (chatgpt_response, late_task) = await asyncio.gather(
+            send_quietly(send_card_images(bot, chat_id, card_ids, as_media_group=True), "изображение карт"),
+            interpret_with_deadline(get_chatgpt_response_with_prompt(
+                chatgpt_question, TAROT_SYSTEM_PROMPT, lane=llm_lane(hold['access_type']), hedge=True
+            )),
         )
-        chatgpt_response = await get_chatgpt_response_with_prompt(chatgpt_question, TAROT_SYSTEM_PROMPT)
-
-        balance_before = await get_user_balance(user_id)
-        is_free = balance_before and balance_before['free_divinations_remaining'] > 0 if balance_before else True
-
-        used = await use_divination(user_id)
-        if not used:
-            await bot.send_message(
-                "❌ Произошла ошибка при списании гадания.",
-                chat_id=chat_id,
-                keyboard=make_back_to_menu_kb(),
-            )
-            cursor.clear()
-            return False
-
-        divination_id = await save_divination(
-            user_id=user_id, divination_type="Таро", question=question,
-            selected_cards=card_ids, interpretation=chatgpt_response, is_free=is_free
+        offline = chatgpt_response is None
+        if offline:
+            chatgpt_response = compose_offline_tarot_reading(card_ids, question)
+
+        divination_id = await settle_reading(
+            hold, question=question, interpretation=chatgpt_response,
+            selected_cards=card_ids, offline=offline,
+            upgrade_pending=late_task is not None,
         )
-
-        if divination_id:
-            try:
-                await save_conversion(
-                    user_id=user_id, conversion_type='service_usage', divination_type="Таро",
-                    metadata={
-                        'divination_id': divination_id,
-                        'card_ids': card_ids,
-                        'is_free': is_free,
-                        'method': method,
-                    }
-                )
-                import asyncio
-                asyncio.create_task(send_conversion_event(user_id, 'service_usage'))
-            except Exception as e:
-                logging.error(f"Error saving conversion: {e}", exc_info=True)
+        settled = True
+        is_free = hold['is_free']
 
         conversation_history = [
-            {"role": "user", "content": f"Мой вопрос: {question}"},
+            {"role": "user", "content": f"Мой вопрос: {question}\nВыпавшие карты:\n" + "\n".join(cards_info)},
             {"role": "assistant", "content": chatgpt_response}
         ]
         data.update({
@@ -408,7 +618,8 @@ async def _finish_tarot_reading(
             f"<b>Ваш вопрос:</b> <i>«{question}»</i>\n\n"
             f"<b>Карты:</b> {', '.join(cards_names)}\n\n"
             f"<b>Толкование:</b>\n{chatgpt_response}\n\n"
-            "💬 Хочешь уточнить расклад? Просто напиши свой вопрос.\n"
+            + (f"{offline_note(late_task is not None)}\n\n" if offline else "")
+            + "💬 Хочешь уточнить расклад? Просто напиши свой вопрос.\n"
             "🔮 Новый расклад — нажми ◀ В меню",
             chat_id=chat_id,
             keyboard=make_back_to_menu_kb(),
@@ -416,10 +627,41 @@ async def _finish_tarot_reading(
         )
 
         cursor.change_state(STATE_CHATTING)
+        if late_task is not None:
+            task, late_task = late_task, None
+            await spawn_full_interpretation(
+                task,
+                hold=hold,
+                divination_id=divination_id,
+                offline_text=chatgpt_response,
+                send=lambda text: bot.send_message(
+                    text, chat_id=chat_id, keyboard=make_back_to_menu_kb(), format='html'
+                ),
+                on_ready=fsm_interpretation_updater(cursor, divination_id),
+            )
+        track_service_usage(
+            user_id, "Таро",
+            {'divination_id': divination_id, 'card_ids': card_ids, 'is_free': is_free,
+             'method': method, 'offline': offline}
+        )
         return True
 
+    except asyncio.CancelledError:
+        await abort_reading(hold, late_task=late_task, divination_id=divination_id, settled=settled)
+        raise
+
+    except credit_holds.HoldExpiredError as e:
+        logging.warning(f"Tarot reading ({method}) not charged: {e}")
+        track_divination_blocked(user_id, "Таро", question)
+        await bot.send_message(
+            NO_DIVINATIONS_TEXT, chat_id=chat_id, keyboard=make_back_to_menu_kb(), format='html'
+        )
+        cursor.clear()
+        return False
+
     except Exception as e:
         logging.error(f"Error in Tarot reading ({method}): {e}", exc_info=True)
+        await abort_reading(hold, late_task=late_task, divination_id=divination_id, settled=settled)
         await bot.send_message(
             "❌ Произошла ошибка при гадании. Попробуйте ещё раз.",
             chat_id=chat_id, keyboard=make_back_to_menu_kb()
@@ -496,6 +738,7 @@ async def handle_cards_input(message: aiomax.Message, cursor: fsm.FSMCursor):
         return await _call_deepseek(
             [{"role": "user", "content": user_prompt}],
             system_prompt,
+            lane=llm.LANE_BACKGROUND,
             max_tokens=200,
             temperature=0.1,
             format_output=False,
@@ -700,11 +943,15 @@ async def _process_follow_up_message(message: aiomax.Message, cursor: fsm.FSMCur
     
     conversation_history = data.get('conversation_history', [])
     conversation_history.append({"role": "user", "content": text})
+    # Старые реплики — в краткое содержание, чтобы промпт и FSM не росли с каждым вопросом
+    conversation_history = compact_history(conversation_history, config.llm_follow_up_context_tokens)
     
     system_prompt = FOLLOW_UP_SYSTEM_PROMPT
     
     try:
-        response = await get_chatgpt_response_with_history(conversation_history, system_prompt)
+        response = await get_chatgpt_response_with_history(
+            conversation_history, system_prompt, lane=llm_lane(is_free=is_free)
+        )
         
         conversation_history.append({"role": "assistant", "content": response})
         data['conversation_history'] = conversation_history
@@ -910,18 +1157,21 @@ def format_interpretation_with_bold(text: str) -> str:
     return "\n".join(lines)
 
 
-DEEPSEEK_URL = "https://api.deepseek.com/v1/chat/completions"
-DEEPSEEK_MODEL = "deepseek-v4-flash"
 DEEPSEEK_MAX_TOKENS = 1200
 DEEPSEEK_TEMPERATURE = 0.65
 
+# Промпты устроены под кэширование префикса у провайдера: вся неизменная часть
+# (роль, формат, инструкция) — в системном промпте, переменные карты и вопрос —
+# в конце, в сообщении пользователя. Системные промпты не должны зависеть от запроса.
 TAROT_SYSTEM_PROMPT = (
     "Ты опытный таролог. Толкование расклада из 3 карт Таро: "
     "1-я — Прошлое, 2-я — Настоящее, 3-я — Будущее. "
     "Отвечай на русском, мудро и по существу. "
     "Формат: заголовки «Прошлое:», «Настоящее:», «Будущее:», «Общее толкование:» — "
     "по 2–3 предложения на каждую карту, затем общее толкование на 3–4 предложения. "
-    "Всего 4–6 абзацев, без markdown и списков."
+    "Всего 4–6 абзацев, без markdown и списков. "
+    "Пользователь пришлёт выпавшие карты и свой вопрос. "
+    "Дай толкование этого расклада в контексте вопроса пользователя."
 )
 
 ICHING_SYSTEM_PROMPT = (
@@ -929,7 +1179,9 @@ ICHING_SYSTEM_PROMPT = (
     "Толкование одной гексаграммы в контексте вопроса пользователя. "
     "Отвечай на русском, мудро и по существу. "
     "Формат: краткое значение гексаграммы (2–3 предложения), затем ответ на вопрос (3–4 предложения). "
-    "Всего 3–5 абзацев, без списков и повторов."
+    "Всего 3–5 абзацев, без списков и повторов. "
+    "Пользователь пришлёт выпавшую гексаграмму и свой вопрос. "
+    "Дай толкование этой гексаграммы в контексте вопроса пользователя."
 )
 
 FOLLOW_UP_SYSTEM_PROMPT = (
@@ -939,54 +1191,67 @@ FOLLOW_UP_SYSTEM_PROMPT = (
     "Кратко: 2–4 предложения, без списков и повторов."
 )
 
-TAROT_USER_INSTRUCTION = "Дай толкование этого расклада в контексте вопроса пользователя."
-ICHING_USER_INSTRUCTION = "Дай толкование этой гексаграммы в контексте вопроса пользователя."
+
+def tarot_user_prompt(question: str, cards_info: list[str]) -> str:
+    """Переменная часть запроса толкования Таро: карты, затем вопрос."""
+    return "Выпавшие карты:\n" + "\n".join(cards_info) + f"\n\nВопрос пользователя: {question}"
+
+
+def iching_user_prompt(question: str, hexagram_name: str, hexagram_meaning: str) -> str:
+    """Переменная часть запроса толкования Ицзин: гексаграмма, затем вопрос."""
+    return (
+        f"Выпавшая гексаграмма: {hexagram_name}\n"
+        f"Значение гексаграммы: {hexagram_meaning}\n\n"
+        f"Вопрос пользователя: {question}"
+    )
 
 
 async def _call_deepseek(
     messages: list,
     system_prompt: str,
     *,
+    lane: str = llm.LANE_FREE,
     max_tokens: int | None = None,
     temperature: float | None = None,
     format_output: bool = True,
+    hedge: bool = False,
+) -> str:
+    """
+    Запрос к LLM через регулятор main/llm.py (провайдер выбирает реестр, lane — приоритет,
+    hedge — страховочный повтор при задержке, только для толкований).
+    """
+    response_text = await llm.chat(
+        messages,
+        system_prompt,
+        lane=lane,
+        hedge=hedge,
+        max_tokens=max_tokens if max_tokens is not None else DEEPSEEK_MAX_TOKENS,
+        temperature=temperature if temperature is not None else DEEPSEEK_TEMPERATURE,
+    )
+    if format_output:
+        return format_interpretation_with_bold(response_text)
+    return response_text
+
+
+def llm_lane(access_type: str | None = None, is_free: bool | None = None) -> str:
+    """Полоса регулятора LLM: платные и безлимит — впереди бесплатных."""
+    if access_type is not None:
+        return llm.LANE_PAID if access_type in ('paid', 'unlimited') else llm.LANE_FREE
+    return llm.LANE_FREE if is_free in (None, True) else llm.LANE_PAID
+
+
+async def get_chatgpt_response_with_prompt(
+    question: str, system_prompt: str, lane: str = llm.LANE_FREE, hedge: bool = False
 ) -> str:
-    """Запрос к DeepSeek API."""
-    from main.config_reader import config
-
-    api_key = config.api_key.get_secret_value()
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    data = {
-        "model": DEEPSEEK_MODEL,
-        "messages": [{"role": "system", "content": system_prompt}, *messages],
-        "max_tokens": max_tokens if max_tokens is not None else DEEPSEEK_MAX_TOKENS,
-        "temperature": temperature if temperature is not None else DEEPSEEK_TEMPERATURE,
-    }
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(DEEPSEEK_URL, headers=headers, json=data) as response:
-            if response.status == 200:
-                result = await response.json()
-                response_text = result["choices"][0]["message"]["content"]
-                if format_output:
-                    return format_interpretation_with_bold(response_text)
-                return response_text
-            error_text = await response.text()
-            logging.error(f"DeepSeek API error: {response.status} - {error_text}")
-            raise Exception(f"Ошибка API: {response.status}")
-
-
-async def get_chatgpt_response_with_prompt(question: str, system_prompt: str) -> str:
     """Отправка запроса к DeepSeek API с кастомным системным промптом."""
     return await _call_deepseek(
         [{"role": "user", "content": question}],
         system_prompt,
+        lane=lane,
+        hedge=hedge,
     )
 
 
-async def get_chatgpt_response_with_history(messages: list, system_prompt: str) -> str:
+async def get_chatgpt_response_with_history(messages: list, system_prompt: str, lane: str = llm.LANE_FREE) -> str:
     """Отправка запроса к DeepSeek API с историей диалога."""
-    return await _call_deepseek(messages, system_prompt)
+    return await _call_deepseek(messages, system_prompt, lane=lane)
@@ -108,6 +108,21 @@ def get_hexagram_info(hexagram_id: str) -> Dict:
     })
 
 
+def compose_offline_reading(hexagram_id: str, question: str) -> str:
+    """Толкование гексаграммы по шаблону из её значения (без обращения к LLM)."""
+    info = get_hexagram_info(hexagram_id)
+    meaning = info['meaning']
+    keyword = meaning.split(",")[0].strip()
+    return (
+        f"<b>{info['name']}</b>\n"
+        f"{meaning}.\n\n"
+        "<b>Ответ на вопрос:</b>\n"
+        f"Книга Перемен отвечает на вопрос «{question}» через темы: {meaning[:1].lower() + meaning[1:]}. "
+        f"Присмотритесь, где в вашей ситуации проявляется «{keyword[:1].lower() + keyword[1:]}», — "
+        "там и ключ к ответу."
+    )
+
+
 async def send_hexagram_image(bot: aiomax.Bot, chat_id: int, hexagram_id: str) -> None:
     """Отправить изображение гексаграммы в Max боте
     
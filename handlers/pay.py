@@ -13,9 +13,6 @@
 import logging
 import re
 import json
-import uuid
-import base64
-import aiohttp
 import time
 
 import aiomax
@@ -29,8 +26,11 @@ from main.database import (
     create_payment, process_successful_payment as db_process_successful_payment,
     update_payment_status, update_user_email, get_user_email, get_latest_pending_payment
 )
-from main.conversions import save_conversion, save_paywall_conversion
-from main.metrika_mp import send_conversion_event
+from main.conversions import track_conversion, track_paywall_conversion
+from main.metrika_mp import deliver_conversion_event, track_conversion_event
+from main import outbox, payment_events
+from main.max_api import send_message_direct
+from main.yookassa import get_client as get_yookassa_client
 
 router = aiomax.Router()
 
@@ -91,6 +91,59 @@ def build_consultation_success_text(package_name: str) -> str:
     )
 
 
+@outbox.handler('payment_succeeded')
+async def _deliver_payment_succeeded(event: dict):
+    """
+    Уведомление пользователю об успешной оплате из вебхука ЮKassa (воркер outbox).
+    Цель Метрики — отдельное событие metrika_goal.
+    """
+    user_id = event['user_id']
+    payload = event['payload'] or {}
+    package = PACKAGES_BY_ID.get(payload.get('package_id'))
+
+    if is_consultation_package(package):
+        success_text = build_consultation_success_text(package.get('name', ''))
+        kb = make_tarologist_contact_kb()
+    else:
+        package_description = package.get('description', 'раскладам') if package else 'раскладам'
+        email = payload.get('email')
+        email_text = f"Чек отправлен на email: {email}\n\n" if email else ""
+        success_text = (
+            f"✅ <b>Оплата успешно завершена!</b>\n\n"
+            f"Спасибо за покупку! Теперь у тебя есть доступ к {package_description}.\n\n"
+            f"{email_text}"
+            f"🔮 Можешь начинать гадать! Используй команду /divination или выбери гадание из меню."
+        )
+        kb = make_back_to_menu_kb()
+
+    await send_message_direct(user_id, success_text, keyboard=kb)
+
+
+@outbox.handler('metrika_goal')
+async def _deliver_metrika_goal(event: dict):
+    """Цель Метрики из outbox: ждём ответа Метрики, ошибка — повтор события."""
+    payload = event['payload'] or {}
+    await deliver_conversion_event(event['user_id'], payload['goal'], payload.get('event_time'))
+
+
+@payment_events.on_payment_succeeded
+def _on_payment_succeeded(event: dict):
+    """
+    NOTIFY об оплате (main/payment_events.py): сразу сбрасываем FSM оплаты
+    и будим воркер outbox — уведомление уходит без ожидания очередного опроса.
+    FSM хранится в памяти процесса бота, поэтому сброс — здесь, а не в воркере.
+    """
+    user_id = event.get('user_id')
+    if user_id is not None:
+        try:
+            if bot.storage.get_state(user_id) in (STATE_WAITING_EMAIL, STATE_CONFIRMING_EMAIL, STATE_WAITING_PAYMENT):
+                bot.storage.clear(user_id)
+                logging.info(f"FSM state cleared for user {user_id} after successful payment")
+        except Exception as e:
+            logging.warning(f"Could not clear FSM state for user {user_id}: {e}")
+    outbox.worker.wake()
+
+
 _PAY_TEXT_TAROLOGIST = (
     "🔮 <b>Личная консультация с тарологом Дианой</b>\n\n"
     "Получи разбор от живого таролога — не от алгоритма.\n"
@@ -124,9 +177,8 @@ async def cmd_pay_internal(msg):
     logging.info(f"cmd_pay: user_id={user_id}")
 
     try:
-        await save_paywall_conversion(user_id=user_id, paywall_source="command_pay")
-        import asyncio
-        asyncio.create_task(send_conversion_event(user_id, 'paywall'))
+        track_paywall_conversion(user_id=user_id, paywall_source="command_pay")
+        track_conversion_event(user_id, 'paywall')
     except Exception as e:
         logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
 
@@ -153,9 +205,8 @@ async def handle_remind_pay(cb: aiomax.Callback, cursor: fsm.FSMCursor):
     logging.info(f"remind_pay callback from user {user_id}")
 
     try:
-        await save_paywall_conversion(user_id=user_id, paywall_source="remind_pay")
-        import asyncio
-        asyncio.create_task(send_conversion_event(user_id, 'paywall'))
+        track_paywall_conversion(user_id=user_id, paywall_source="remind_pay")
+        track_conversion_event(user_id, 'paywall')
     except Exception as e:
         logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
 
@@ -377,15 +428,14 @@ async def handle_check_payment(cb: aiomax.Callback, cursor: fsm.FSMCursor):
                 package = PACKAGES_BY_ID.get(pkg_id) or {}
 
             try:
-                await save_conversion(
+                track_conversion(
                     user_id=user_id,
                     conversion_type='purchase',
                     conversion_value=package.get('amount_rub', 0),
                     package_id=package.get('id', ''),
                     metadata={'payment_id': payment_id, 'package_name': package.get('name', '')}
                 )
-                import asyncio
-                asyncio.create_task(send_conversion_event(user_id, 'purchase'))
+                track_conversion_event(user_id, 'purchase')
             except Exception as e:
                 logging.error(f"Error saving purchase conversion: {e}", exc_info=True)
 
@@ -461,13 +511,6 @@ async def create_yookassa_payment(
     package_id: str
 ) -> dict:
     """Создать платёж в ЮKassa"""
-    shop_id = config.yookassa_shop_id.get_secret_value()
-    secret_key = config.yookassa_secret_key.get_secret_value()
-    
-    auth = base64.b64encode(f"{shop_id}:{secret_key}".encode()).decode()
-    
-    idempotence_key = str(uuid.uuid4())
-    
     payment_data = {
         "amount": {
             "value": f"{amount:.2f}",
@@ -502,46 +545,9 @@ async def create_yookassa_payment(
         }
     }
     
-    headers = {
-        "Authorization": f"Basic {auth}",
-        "Content-Type": "application/json",
-        "Idempotence-Key": idempotence_key
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            "https://api.yookassa.ru/v3/payments",
-            headers=headers,
-            json=payment_data
-        ) as response:
-            if response.status in (200, 201):
-                return await response.json()
-            else:
-                error_text = await response.text()
-                logging.error(f"YooKassa error: {response.status} - {error_text}")
-                raise Exception(f"YooKassa error: {response.status}")
+    return await get_yookassa_client().create_payment(payment_data)
 
 
 async def check_payment_status(payment_id: str) -> dict:
     """Проверить статус платежа в ЮKassa"""
-    shop_id = config.yookassa_shop_id.get_secret_value()
-    secret_key = config.yookassa_secret_key.get_secret_value()
-    
-    auth = base64.b64encode(f"{shop_id}:{secret_key}".encode()).decode()
-    
-    headers = {
-        "Authorization": f"Basic {auth}",
-        "Content-Type": "application/json"
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            f"https://api.yookassa.ru/v3/payments/{payment_id}",
-            headers=headers
-        ) as response:
-            if response.status == 200:
-                return await response.json()
-            else:
-                error_text = await response.text()
-                logging.error(f"YooKassa check error: {response.status} - {error_text}")
-                raise Exception(f"YooKassa error: {response.status}")
+    return await get_yookassa_client().get_payment(payment_id)
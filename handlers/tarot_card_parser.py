@@ -179,7 +179,7 @@ MAJOR_ALIASES: dict[str, str] = {
     "world": "21-TheWorld",
 }
 
-CARD_PARSE_SYSTEM_PROMPT = (
+CARD_PARSE_INSTRUCTIONS = (
     "Ты помощник таролога. Определи ровно 3 карты Таро Rider-Waite из текста пользователя "
     "в порядке слева направо (Прошлое, Настоящее, Будущее). "
     "Верни ТОЛЬКО JSON-массив из 3 строк — ID карт из списка ниже. "
@@ -189,12 +189,16 @@ CARD_PARSE_SYSTEM_PROMPT = (
     "Без markdown и пояснений."
 )
 
-CARD_PARSE_USER_TEMPLATE = (
-    "Текст пользователя: {text}\n\n"
+# Каталог карт — в системном промпте, а не после текста пользователя: у всех запросов
+# распознавания общий длинный префикс, его кэширует провайдер (prefix caching)
+CARD_PARSE_SYSTEM_TEMPLATE = (
+    "{instructions}\n\n"
     "Доступные карты (id — название):\n{catalog}\n\n"
     'Пример ответа: ["16-TheTower", "Cups01", "Swords10"]'
 )
 
+CARD_PARSE_USER_TEMPLATE = "Текст пользователя: {text}"
+
 
 def normalize_card_text(text: str) -> str:
     text = text.lower().strip()
@@ -426,6 +430,12 @@ def _build_card_catalog() -> str:
     return "\n".join(lines)
 
 
+CARD_PARSE_SYSTEM_PROMPT = CARD_PARSE_SYSTEM_TEMPLATE.format(
+    instructions=CARD_PARSE_INSTRUCTIONS,
+    catalog=_build_card_catalog(),
+)
+
+
 def _extract_json_array(text: str) -> list | None:
     text = text.strip()
     try:
@@ -464,10 +474,7 @@ async def parse_cards_with_llm(
     text: str,
     call_llm: Callable[[str, str], Awaitable[str]],
 ) -> list[str] | None:
-    user_prompt = CARD_PARSE_USER_TEMPLATE.format(
-        text=text,
-        catalog=_build_card_catalog(),
-    )
+    user_prompt = CARD_PARSE_USER_TEMPLATE.format(text=text)
     try:
         raw = await call_llm(user_prompt, CARD_PARSE_SYSTEM_PROMPT)
     except Exception as exc:
@@ -5,6 +5,7 @@
 - Вместо aiogram FSInputFile / InlineKeyboardBuilder используем aiomax.buttons.KeyboardBuilder
 - Для отправки изображений используем bot.upload_image() + attachments
 """
+import asyncio
 import random
 import os
 import logging
@@ -219,7 +220,8 @@ async def send_card_images(
         send_kw["chat_id"] = chat_id
 
     if as_media_group:
-        combined_image_path = combine_cards_image(card_ids)
+        # Склейка в Pillow — в потоке, чтобы не задерживать параллельный запрос к LLM
+        combined_image_path = await asyncio.to_thread(combine_cards_image, card_ids)
         if combined_image_path and os.path.exists(combined_image_path):
             try:
                 attachment = await bot.upload_image(combined_image_path)
@@ -255,3 +257,40 @@ def interpret_cards(cards: List[str], question: str) -> str:
         )
     
     return "\n".join(interpretations)
+
+
+# Краткое толкование без LLM (когда сервис толкований не успел или недоступен)
+OFFLINE_POSITION_TEMPLATES = {
+    "Прошлое": "В основе ситуации — {meaning}. Это уже повлияло на то, о чём вы спрашиваете.",
+    "Настоящее": "Сейчас на первый план выходит: {meaning}. На это стоит опереться, принимая решение.",
+    "Будущее": "Дальше ситуация ведёт к теме: {meaning}. Это вероятный итог, если сохранить нынешний курс.",
+}
+
+
+def _lower_first(text: str) -> str:
+    return text[:1].lower() + text[1:]
+
+
+def compose_offline_reading(cards: List[str], question: str) -> str:
+    """Толкование расклада по шаблонам из значений карт (без обращения к LLM)."""
+    positions = ["Прошлое", "Настоящее", "Будущее"]
+    parts = []
+    names = []
+    keywords = []
+    for position, card_id in zip(positions, cards):
+        card_info = get_card_info(card_id)
+        names.append(card_info['name'])
+        keywords.append(_lower_first(card_info['meaning'].split(",")[0].strip()))
+        parts.append(
+            f"<b>{position}: {card_info['name']}</b>\n"
+            + OFFLINE_POSITION_TEMPLATES[position].format(meaning=_lower_first(card_info['meaning']))
+        )
+
+    if len(names) == len(positions):
+        parts.append(
+            "<b>Общее толкование:</b>\n"
+            f"Карты отвечают на вопрос «{question}» как история: от «{keywords[0]}» "
+            f"через «{keywords[1]}» к «{keywords[2]}». Ключ к ответу — карта {names[1]}: "
+            "она подсказывает, что делать сейчас."
+        )
+    return "\n\n".join(parts)
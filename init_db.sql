@@ -74,6 +74,8 @@ CREATE INDEX IF NOT EXISTS idx_max_payments_payment_id  ON max_payments(payment_
 CREATE INDEX IF NOT EXISTS idx_max_payments_user_id     ON max_payments(user_id);
 CREATE INDEX IF NOT EXISTS idx_max_payments_status      ON max_payments(status);
 CREATE INDEX IF NOT EXISTS idx_max_payments_created_at  ON max_payments(created_at);
+-- Сверка pending-платежей: постраничный обход по (created_at, id) только среди pending
+CREATE INDEX IF NOT EXISTS idx_max_payments_pending_created ON max_payments(created_at, id) WHERE status = 'pending';
 
 
 -- 4. max_subscriptions — безлимитные подписки
@@ -189,6 +191,140 @@ CREATE TABLE IF NOT EXISTS max_webapp_follow_up_context (
 );
 
 
+-- 8. max_metrika_retries — хиты Measurement Protocol, не отправленные с первой попытки
+CREATE TABLE IF NOT EXISTS max_metrika_retries (
+    id                SERIAL PRIMARY KEY,
+    params            JSONB NOT NULL,
+    attempts          INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at   TIMESTAMP NOT NULL DEFAULT NOW(),
+    created_at        TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_max_metrika_retries_next_attempt ON max_metrika_retries(next_attempt_at);
+
+
+-- 9. max_processed_webhooks — идемпотентность вебхуков ЮKassa (повторные доставки отбрасываются)
+CREATE TABLE IF NOT EXISTS max_processed_webhooks (
+    event_key       VARCHAR(255) PRIMARY KEY,
+    status          VARCHAR(20) NOT NULL DEFAULT 'processing',
+    created_at      TIMESTAMP DEFAULT NOW(),
+    completed_at    TIMESTAMP NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_max_processed_webhooks_created_at ON max_processed_webhooks(created_at);
+
+
+-- 10. max_outbox — отложенные побочные эффекты (уведомления, аналитика), пишутся в транзакции
+-- основного изменения и разбираются воркером main/outbox.py
+CREATE TABLE IF NOT EXISTS max_outbox (
+    id                BIGSERIAL PRIMARY KEY,
+    kind              VARCHAR(50) NOT NULL,
+    user_id           BIGINT NULL,
+    payload           JSONB NOT NULL DEFAULT '{}'::jsonb,
+    status            VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts          INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at   TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_error        TEXT NULL,
+    created_at        TIMESTAMP DEFAULT NOW(),
+    processed_at      TIMESTAMP NULL,
+    dedupe_key        VARCHAR(255) NULL,
+    priority          SMALLINT NOT NULL DEFAULT 0
+);
+
+-- Исходящие сообщения бота (kind='message'): защита от повторной постановки и приоритеты
+ALTER TABLE max_outbox ADD COLUMN IF NOT EXISTS dedupe_key VARCHAR(255) NULL;
+ALTER TABLE max_outbox ADD COLUMN IF NOT EXISTS priority SMALLINT NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_max_outbox_pending ON max_outbox(next_attempt_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_max_outbox_pending_priority ON max_outbox(priority, id) WHERE status = 'pending';
+CREATE UNIQUE INDEX IF NOT EXISTS idx_max_outbox_dedupe_key ON max_outbox(dedupe_key);
+
+
+-- 11. max_scheduled_jobs — таймеры на пользователя (напоминания об оплате, welcome-активация),
+-- ставятся в момент события и забираются тиком main/scheduled_jobs.py по run_at
+CREATE TABLE IF NOT EXISTS max_scheduled_jobs (
+    id                BIGSERIAL PRIMARY KEY,
+    kind              VARCHAR(50) NOT NULL,
+    user_id           BIGINT NULL,
+    payload           JSONB NOT NULL DEFAULT '{}'::jsonb,
+    run_at            TIMESTAMP NOT NULL,
+    status            VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts          INTEGER NOT NULL DEFAULT 0,
+    dedupe_key        VARCHAR(255) NULL UNIQUE,
+    last_error        TEXT NULL,
+    created_at        TIMESTAMP DEFAULT NOW(),
+    processed_at      TIMESTAMP NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_max_scheduled_jobs_due ON max_scheduled_jobs(run_at) WHERE status = 'pending';
+
+
+-- 12. max_job_runs — срабатывания cron-задач: строку вставляет ровно один инстанс бота,
+-- он и выполняет задачу (main/cluster.py)
+CREATE TABLE IF NOT EXISTS max_job_runs (
+    run_key           VARCHAR(255) PRIMARY KEY,
+    job_id            VARCHAR(100) NOT NULL,
+    node_id           VARCHAR(255) NOT NULL,
+    status            VARCHAR(20) NOT NULL DEFAULT 'running',
+    started_at        TIMESTAMP DEFAULT NOW(),
+    finished_at       TIMESTAMP NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_max_job_runs_started_at ON max_job_runs(started_at);
+
+
+-- 13. max_broadcast_runs / max_broadcast_chunks — ручные рассылки send_message.py с курсором
+-- по user_id и чекпоинтами частей: прерванную рассылку продолжает --resume RUN_ID (main/broadcast_runs.py)
+CREATE TABLE IF NOT EXISTS max_broadcast_runs (
+    id                BIGSERIAL PRIMARY KEY,
+    action            VARCHAR(100) NOT NULL,
+    params            JSONB NOT NULL DEFAULT '{}'::jsonb,
+    audience          VARCHAR(20) NOT NULL,
+    chunk_size        INTEGER NOT NULL,
+    cursor_user_id    BIGINT NOT NULL DEFAULT 0,
+    scanned           BOOLEAN NOT NULL DEFAULT FALSE,
+    status            VARCHAR(20) NOT NULL DEFAULT 'running',
+    sent              INTEGER NOT NULL DEFAULT 0,
+    failed            INTEGER NOT NULL DEFAULT 0,
+    created_by        VARCHAR(255) NULL,
+    created_at        TIMESTAMP DEFAULT NOW(),
+    updated_at        TIMESTAMP DEFAULT NOW(),
+    finished_at       TIMESTAMP NULL
+);
+
+CREATE TABLE IF NOT EXISTS max_broadcast_chunks (
+    id                BIGSERIAL PRIMARY KEY,
+    run_id            BIGINT NOT NULL REFERENCES max_broadcast_runs(id) ON DELETE CASCADE,
+    after_user_id     BIGINT NOT NULL,
+    last_user_id      BIGINT NOT NULL,
+    position_user_id  BIGINT NOT NULL,
+    status            VARCHAR(20) NOT NULL DEFAULT 'running',
+    node_id           VARCHAR(255) NOT NULL,
+    leased_until      TIMESTAMP NOT NULL,
+    sent              INTEGER NOT NULL DEFAULT 0,
+    failed            INTEGER NOT NULL DEFAULT 0,
+    created_at        TIMESTAMP DEFAULT NOW(),
+    finished_at       TIMESTAMP NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_max_broadcast_chunks_running
+    ON max_broadcast_chunks(run_id, leased_until) WHERE status = 'running';
+
+
+-- 14. max_credit_holds — резервы гаданий на время расклада: гадание списано при reserve,
+-- резерв закрывается при сохранении расклада или возвращается на баланс (main/credit_holds.py)
+CREATE TABLE IF NOT EXISTS max_credit_holds (
+    id                BIGSERIAL PRIMARY KEY,
+    user_id           BIGINT NOT NULL,
+    access_type       VARCHAR(20) NOT NULL,
+    divination_type   VARCHAR(50) NOT NULL,
+    expires_at        TIMESTAMP NOT NULL,
+    created_at        TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_max_credit_holds_expires ON max_credit_holds(expires_at);
+
+
 -- Готово!
 -- Все таблицы создаются с IF NOT EXISTS — скрипт идемпотентен, можно запускать повторно.
 -- Таблицы: max_users, max_user_balances, max_payments, max_subscriptions, max_divinations, max_conversions
@@ -0,0 +1,98 @@
+"""
+Welcome-активация: через 24 часа после регистрации, если пользователь ни разу не гадал.
+
+Таймер ставится в main/scheduled_jobs.py при регистрации пользователя
+(create_or_update_user) на ближайший персональный слот 10:00–20:00 MSK
+(main/broadcast_schedule.py) после 24 часов. В момент срабатывания задача
+перепроверяет условия; если слот сдвинулся (изменился last_active_at) —
+переносится на новый слот. Сообщение уходит через outbox (main/messages.py):
+пометка activation_sent_at и запись в outbox — одна транзакция.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from main import messages, outbox, scheduled_jobs
+from main.broadcast_schedule import MSK, is_user_due_in_tick, next_send_time
+from main.database import (
+    ACTIVATION_DELAY_HOURS,
+    Database,
+    get_activation_candidate,
+    get_table_name,
+    mark_activation_sent,
+)
+
+JOB_KIND = 'activation'
+
+
+def _dedupe_key(user_id: int) -> str:
+    return f"{JOB_KIND}:{user_id}"
+
+
+async def schedule_activation(user_id: int) -> None:
+    """Поставить таймер активации для нового пользователя."""
+    now = datetime.now(MSK)
+    run_at = next_send_time(user_id, now, not_before=now + timedelta(hours=ACTIVATION_DELAY_HOURS))
+    try:
+        await scheduled_jobs.schedule(
+            JOB_KIND,
+            delay_sec=(run_at - now).total_seconds(),
+            user_id=user_id,
+            dedupe_key=_dedupe_key(user_id),
+        )
+    except Exception as e:
+        # Не критично: задачу поставит backfill при следующем старте
+        logging.error(f"Error scheduling activation for user {user_id}: {e}", exc_info=True)
+
+
+@scheduled_jobs.job_handler(JOB_KIND)
+async def _send_activation_job(job: dict):
+    user_id = job['user_id']
+    user = await get_activation_candidate(user_id)
+    if not user:
+        return
+
+    now = datetime.now(MSK)
+    if not is_user_due_in_tick(user_id, user['last_active_at'], now):
+        run_at = next_send_time(user_id, user['last_active_at'], not_before=now)
+        raise scheduled_jobs.Reschedule((run_at - now).total_seconds())
+
+    await outbox.ensure_outbox_table_once()
+    pool = await Database.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if await mark_activation_sent(user_id, conn=conn):
+                await messages.enqueue(conn, user_id, 'activation', dedupe_key=_dedupe_key(user_id))
+    outbox.worker.wake()
+
+
+async def backfill_activation_jobs() -> int:
+    """
+    Поставить таймеры пользователям, зарегистрированным до появления очереди.
+    Идемпотентно (dedupe_key). Время уточнит сама задача (перенос на слот).
+    """
+    await scheduled_jobs.ensure_scheduled_jobs_table_once()
+    users_table = get_table_name("users")
+    divinations_table = get_table_name("divinations")
+    jobs_table = get_table_name("scheduled_jobs")
+    try:
+        query = f"""
+            INSERT INTO {jobs_table} (kind, user_id, payload, run_at, dedupe_key)
+            SELECT $1::text, u.user_id, '{{}}'::jsonb,
+                   GREATEST(u.created_at + make_interval(hours => $2), NOW()),
+                   $1::text || ':' || u.user_id
+            FROM {users_table} u
+            WHERE u.is_blocked = FALSE
+              AND u.activation_sent_at IS NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM {divinations_table} d WHERE d.user_id = u.user_id
+              )
+            ON CONFLICT (dedupe_key) DO NOTHING
+        """
+        result = await Database.execute_query(query, JOB_KIND, ACTIVATION_DELAY_HOURS)
+        total = int(result.split()[-1]) if result else 0
+        if total:
+            logging.info(f"Activation backfill: {total} timer(s) scheduled")
+        return total
+    except Exception as e:
+        logging.error(f"Error backfilling activation jobs: {e}", exc_info=True)
+        return 0
@@ -1,8 +1,41 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+
 import aiomax
 from aiomax import utils as _aiomax_utils
 from main.config_reader import config
 
-bot = aiomax.Bot(
+
+class MaxBot(aiomax.Bot):
+    """
+    aiomax.Bot с явной точкой входа для апдейтов.
+
+    handle_update (его зовут start_polling и вебхук) отдаёт апдейт update_sink —
+    диспетчеру main/dispatcher.py или очереди процессов-обработчиков; без него
+    апдейт разбирается сразу. dispatch_update разбирает апдейт роутерами и
+    возвращает задачи запущенных обработчиков.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_sink: Optional[Callable[[dict], Awaitable[None]]] = None
+
+    async def handle_update(self, update: dict):
+        if self.update_sink is not None:
+            await self.update_sink(update)
+        else:
+            await self.dispatch_update(update)
+
+    async def dispatch_update(self, update: dict) -> List[asyncio.Task]:
+        """Передать апдейт роутерам; вернуть задачи обработчиков, которые они запустили."""
+        # aiomax запускает обработчики через asyncio.create_task и внутри
+        # handle_update ничего не ждёт: новые задачи цикла — это его обработчики
+        before = asyncio.all_tasks()
+        await super().handle_update(update)
+        return list(asyncio.all_tasks() - before)
+
+
+bot = MaxBot(
     config.effective_bot_token.get_secret_value(),
     default_format='html'
 )
@@ -0,0 +1,346 @@
+"""
+Ручные рассылки (send_message.py) как сохранённые задания с чекпоинтами.
+
+Рассылка — строка max_broadcast_runs: действие (шаблон CLI), его параметры,
+аудитория и курсор по user_id. Получатели выбираются постранично по ключу
+(user_id > курсор ORDER BY user_id LIMIT n), без загрузки всей базы в память.
+
+Работа делится на части (max_broadcast_chunks). Узел занимает часть под
+блокировкой строки рассылки: сдвигает курсор на страницу и записывает диапазон
+части с арендой. Внутри части после каждой отправки сохраняется позиция
+(последний обработанный user_id) и продлевается аренда. Поэтому:
+
+- упавший или прерванный процесс продолжается командой
+  `send_message.py --resume RUN_ID` — с позиции, а не с начала;
+- часть с истёкшей арендой (узел умер) забирает следующий исполнитель;
+- несколько `--resume RUN_ID` параллельно делят рассылку между собой.
+
+Повтор возможен не больше чем для одного сообщения на часть (отправлено,
+но позиция не успела сохраниться).
+
+Автоматические рассылки (карта дня, Пн/Чт) сюда не относятся: они ставят
+сообщения в outbox с dedupe_key, повторный тик их не дублирует.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from main.cluster import NODE_ID
+from main.database import Database, get_broadcast_recipients_page, get_table_name
+
+# Размер части (получателей) и аренда части
+BROADCAST_CHUNK_SIZE = 200
+BROADCAST_LEASE_SEC = 120
+# Пауза между отправками (bot.send_message не проходит через лимитер max_api)
+BROADCAST_SEND_DELAY_SEC = 0.05
+
+AUDIENCE_IDS = 'ids'
+
+SendFunc = Callable[[int], Awaitable[Any]]
+
+
+async def ensure_broadcast_runs_tables():
+    """Создать таблицы broadcast_runs и broadcast_chunks если не существуют"""
+    runs_table = get_table_name("broadcast_runs")
+    chunks_table = get_table_name("broadcast_chunks")
+    runs_query = f"""
+        CREATE TABLE IF NOT EXISTS {runs_table} (
+            id BIGSERIAL PRIMARY KEY,
+            action VARCHAR(100) NOT NULL,
+            params JSONB NOT NULL DEFAULT '{{}}'::jsonb,
+            audience VARCHAR(20) NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            cursor_user_id BIGINT NOT NULL DEFAULT 0,
+            scanned BOOLEAN NOT NULL DEFAULT FALSE,
+            status VARCHAR(20) NOT NULL DEFAULT 'running',
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_by VARCHAR(255) NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW(),
+            finished_at TIMESTAMP NULL
+        )
+    """
+    chunks_query = f"""
+        CREATE TABLE IF NOT EXISTS {chunks_table} (
+            id BIGSERIAL PRIMARY KEY,
+            run_id BIGINT NOT NULL REFERENCES {runs_table}(id) ON DELETE CASCADE,
+            after_user_id BIGINT NOT NULL,
+            last_user_id BIGINT NOT NULL,
+            position_user_id BIGINT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'running',
+            node_id VARCHAR(255) NOT NULL,
+            leased_until TIMESTAMP NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT NOW(),
+            finished_at TIMESTAMP NULL
+        )
+    """
+    index_query = f"""
+        CREATE INDEX IF NOT EXISTS idx_{chunks_table}_running
+            ON {chunks_table}(run_id, leased_until) WHERE status = 'running'
+    """
+    try:
+        await Database.execute_query(runs_query)
+        await Database.execute_query(chunks_query)
+        await Database.execute_query(index_query)
+    except Exception as e:
+        logging.error(f"Error creating broadcast_runs tables: {e}", exc_info=True)
+
+
+_tables_ready = False
+
+
+async def ensure_broadcast_runs_tables_once():
+    global _tables_ready
+    if not _tables_ready:
+        await ensure_broadcast_runs_tables()
+        _tables_ready = True
+
+
+async def create_run(
+    action: str,
+    audience: str,
+    params: Optional[Dict[str, Any]] = None,
+    chunk_size: int = BROADCAST_CHUNK_SIZE,
+) -> int:
+    """
+    Создать рассылку. audience: 'all' | 'paid' (из БД) или 'ids' —
+    тогда список получателей в params['user_ids'].
+    """
+    await ensure_broadcast_runs_tables_once()
+    table = get_table_name("broadcast_runs")
+    return await Database.fetchval(
+        f"""
+        INSERT INTO {table} (action, params, audience, chunk_size, created_by)
+        VALUES ($1, $2, $3, $4, $5)
+        RETURNING id
+        """,
+        action, params or {}, audience, max(1, chunk_size), NODE_ID,
+    )
+
+
+async def get_run(run_id: int) -> Optional[Dict[str, Any]]:
+    await ensure_broadcast_runs_tables_once()
+    table = get_table_name("broadcast_runs")
+    row = await Database.fetch_one(f"SELECT * FROM {table} WHERE id = $1", run_id)
+    return dict(row) if row else None
+
+
+async def list_runs(limit: int = 20) -> List[Dict[str, Any]]:
+    """Последние рассылки (для --runs)."""
+    await ensure_broadcast_runs_tables_once()
+    table = get_table_name("broadcast_runs")
+    rows = await Database.fetch_all(
+        f"""
+        SELECT id, action, audience, status, cursor_user_id, sent, failed, created_at, finished_at
+        FROM {table}
+        ORDER BY id DESC
+        LIMIT $1
+        """,
+        limit,
+    )
+    return [dict(r) for r in rows]
+
+
+async def cancel_run(run_id: int) -> bool:
+    """Остановить рассылку: исполнители завершат текущие части и не возьмут новые."""
+    await ensure_broadcast_runs_tables_once()
+    table = get_table_name("broadcast_runs")
+    result = await Database.execute_query(
+        f"UPDATE {table} SET status = 'canceled', updated_at = NOW(), finished_at = NOW() "
+        f"WHERE id = $1 AND status = 'running'",
+        run_id,
+    )
+    return result == "UPDATE 1"
+
+
+async def _recipients(run: Dict[str, Any], after_user_id: int, limit: int,
+                      upto_user_id: Optional[int] = None, conn=None) -> List[int]:
+    if run['audience'] == AUDIENCE_IDS:
+        ids = sorted(set((run['params'] or {}).get('user_ids') or []))
+        ids = [uid for uid in ids if uid > after_user_id and (upto_user_id is None or uid <= upto_user_id)]
+        return ids[:limit]
+    return await get_broadcast_recipients_page(
+        run['audience'], after_user_id, limit, upto_user_id=upto_user_id, conn=conn
+    )
+
+
+async def _claim_chunk(run_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Занять часть рассылки: сначала брошенную (аренда истекла), иначе следующую
+    страницу после курсора. None — рассылка не активна или частей больше нет.
+    """
+    runs_table = get_table_name("broadcast_runs")
+    chunks_table = get_table_name("broadcast_chunks")
+    pool = await Database.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            run = await conn.fetchrow(f"SELECT * FROM {runs_table} WHERE id = $1 FOR UPDATE", run_id)
+            if run is None or run['status'] != 'running':
+                return None
+
+            chunk = await conn.fetchrow(
+                f"""
+                UPDATE {chunks_table}
+                SET node_id = $2, leased_until = NOW() + make_interval(secs => $3)
+                WHERE id = (
+                    SELECT id FROM {chunks_table}
+                    WHERE run_id = $1 AND status = 'running' AND leased_until < NOW()
+                    ORDER BY id
+                    LIMIT 1
+                )
+                RETURNING *
+                """,
+                run_id, NODE_ID, BROADCAST_LEASE_SEC,
+            )
+            if chunk is not None:
+                logging.info(
+                    f"Broadcast run {run_id}: resuming chunk {chunk['id']} "
+                    f"from user {chunk['position_user_id']}"
+                )
+                return dict(chunk)
+
+            if run['scanned']:
+                return None
+            page = await _recipients(dict(run), run['cursor_user_id'], run['chunk_size'], conn=conn)
+            if not page:
+                await conn.execute(
+                    f"UPDATE {runs_table} SET scanned = TRUE, updated_at = NOW() WHERE id = $1", run_id
+                )
+                return None
+
+            await conn.execute(
+                f"UPDATE {runs_table} SET cursor_user_id = $2, updated_at = NOW() WHERE id = $1",
+                run_id, page[-1],
+            )
+            chunk = await conn.fetchrow(
+                f"""
+                INSERT INTO {chunks_table}
+                    (run_id, after_user_id, last_user_id, position_user_id, node_id, leased_until)
+                VALUES ($1, $2, $3, $2, $4, NOW() + make_interval(secs => $5))
+                RETURNING *
+                """,
+                run_id, run['cursor_user_id'], page[-1], NODE_ID, BROADCAST_LEASE_SEC,
+            )
+            return dict(chunk)
+
+
+async def _checkpoint(chunk_id: int, user_id: int, ok: bool) -> bool:
+    """Сохранить позицию в части и продлить аренду. False — часть забрал другой узел."""
+    table = get_table_name("broadcast_chunks")
+    result = await Database.execute_query(
+        f"""
+        UPDATE {table}
+        SET position_user_id = $2,
+            sent = sent + $3,
+            failed = failed + $4,
+            leased_until = NOW() + make_interval(secs => $6)
+        WHERE id = $1 AND node_id = $5 AND status = 'running'
+        """,
+        chunk_id, user_id, int(ok), int(not ok), NODE_ID, BROADCAST_LEASE_SEC,
+    )
+    return result == "UPDATE 1"
+
+
+async def _release_chunk(chunk_id: int) -> None:
+    table = get_table_name("broadcast_chunks")
+    try:
+        await Database.execute_query(
+            f"UPDATE {table} SET leased_until = NOW() WHERE id = $1 AND node_id = $2 AND status = 'running'",
+            chunk_id, NODE_ID,
+        )
+    except Exception as e:
+        logging.warning(f"Could not release broadcast chunk {chunk_id}: {e}")
+
+
+async def _finish_chunk(run_id: int, chunk_id: int) -> None:
+    runs_table = get_table_name("broadcast_runs")
+    chunks_table = get_table_name("broadcast_chunks")
+    pool = await Database.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            chunk = await conn.fetchrow(
+                f"""
+                UPDATE {chunks_table} SET status = 'done', finished_at = NOW()
+                WHERE id = $1 AND node_id = $2 AND status = 'running'
+                RETURNING sent, failed
+                """,
+                chunk_id, NODE_ID,
+            )
+            if chunk is None:
+                return
+            await conn.execute(
+                f"""
+                UPDATE {runs_table}
+                SET sent = sent + $2, failed = failed + $3, updated_at = NOW()
+                WHERE id = $1
+                """,
+                run_id, chunk['sent'], chunk['failed'],
+            )
+            # Последняя часть: курсор дошёл до конца и незавершённых частей нет
+            await conn.execute(_complete_query(), run_id)
+
+
+def _complete_query() -> str:
+    runs_table = get_table_name("broadcast_runs")
+    chunks_table = get_table_name("broadcast_chunks")
+    return f"""
+        UPDATE {runs_table} r
+        SET status = 'done', finished_at = NOW()
+        WHERE r.id = $1 AND r.status = 'running' AND r.scanned
+          AND NOT EXISTS (
+              SELECT 1 FROM {chunks_table} c WHERE c.run_id = r.id AND c.status = 'running'
+          )
+    """
+
+
+async def _send_chunk(run: Dict[str, Any], chunk: Dict[str, Any], send: SendFunc,
+                      delay_sec: float, results: Dict[str, int]) -> bool:
+    """Отправить часть с сохранённой позиции. False — аренду перехватил другой узел."""
+    position = chunk['position_user_id']
+    while True:
+        page = await _recipients(run, position, run['chunk_size'], upto_user_id=chunk['last_user_id'])
+        if not page:
+            return True
+        for uid in page:
+            try:
+                ok = bool(await send(uid))
+            except Exception as e:
+                logging.error(f"Broadcast run {run['id']}: send to {uid} failed: {e}", exc_info=True)
+                ok = False
+            results['sent' if ok else 'failed'] += 1
+            if not await _checkpoint(chunk['id'], uid, ok):
+                logging.warning(f"Broadcast run {run['id']}: chunk {chunk['id']} lease lost, stopping it")
+                return False
+            position = uid
+            await asyncio.sleep(delay_sec)
+
+
+async def execute(run_id: int, send: SendFunc, delay_sec: float = BROADCAST_SEND_DELAY_SEC) -> Dict[str, int]:
+    """
+    Выполнять части рассылки run_id, пока они есть (в том числе брошенные другими узлами).
+    send(user_id) -> True/False (успех отправки). Возвращает счётчики этого исполнителя.
+    """
+    run = await get_run(run_id)
+    if run is None:
+        raise ValueError(f"Broadcast run {run_id} not found")
+    results = {'sent': 0, 'failed': 0, 'chunks': 0}
+    while True:
+        chunk = await _claim_chunk(run_id)
+        if chunk is None:
+            break
+        try:
+            completed = await _send_chunk(run, chunk, send, delay_sec, results)
+        except BaseException:
+            # Прерывание (Ctrl+C) или ошибка БД: отдать часть сразу, не дожидаясь аренды
+            await _release_chunk(chunk['id'])
+            raise
+        if completed:
+            await _finish_chunk(run_id, chunk['id'])
+            results['chunks'] += 1
+
+    # Последняя страница оказалась пустой — закрыть рассылку, если частей в работе нет
+    await Database.execute_query(_complete_query(), run_id)
+    return results
@@ -5,7 +5,7 @@
   - если есть last_active_at — ближе к часу последней активности (в пределах окна);
   - иначе — детерминированный слот по user_id (hash).
 """
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional
 from zoneinfo import ZoneInfo
 
@@ -58,6 +58,26 @@ def is_user_due_in_tick(
     return send_minute <= current < send_minute + tick_minutes
 
 
+def next_send_time(
+    user_id: int,
+    last_active_at: Optional[datetime] = None,
+    not_before: Optional[datetime] = None,
+    tick_minutes: int = BROADCAST_TICK_MINUTES,
+) -> datetime:
+    """
+    Ближайшее время отправки пользователю (MSK) не раньше not_before.
+    Если not_before уже внутри слота пользователя — возвращается not_before.
+    """
+    not_before = _to_msk(not_before or datetime.now(MSK))
+    send_minute = compute_user_send_minute(user_id, last_active_at)
+    slot = not_before.replace(hour=send_minute // 60, minute=send_minute % 60, second=0, microsecond=0)
+    if slot <= not_before < slot + timedelta(minutes=tick_minutes):
+        return not_before
+    if slot < not_before:
+        slot += timedelta(days=1)
+    return slot
+
+
 def is_same_msk_day(ts: Optional[datetime], now: Optional[datetime] = None) -> bool:
     """True, если ts попадает на ту же календарную дату (MSK), что и now."""
     if ts is None:
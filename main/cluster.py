@@ -0,0 +1,204 @@
+"""
+Запуск задач планировщика на нескольких инстансах бота.
+
+APScheduler живёт в каждом процессе — без координации два инстанса отправят
+каждую рассылку дважды. Здесь два способа координации через PostgreSQL:
+
+- once(job_id, func, shards=N) — для cron-задач (карта дня, рассылки, очистки).
+  Срабатывание cron (время, округлённое до минуты) «занимается» вставкой
+  в таблицу job_runs: строку вставит ровно один инстанс, он и выполняет задачу.
+  С shards > 1 каждое срабатывание делится на N частей (user_id % N): инстансы
+  по очереди забирают свободные части, так что работа распределяется между узлами.
+  Гарантия — не больше одного раза: если узел упал посреди части, она не
+  перезапускается (для рассылок лучше пропуск, чем дубль).
+
+- exclusive(job_id, func) — для интервальных задач (сверка платежей, повторы MP):
+  pg_try_advisory_lock на отдельном соединении пула. Занято — тик пропускается.
+  Если процесс упал, PostgreSQL снимает блокировку вместе с соединением.
+
+Очереди outbox и scheduled_jobs в координации не нуждаются: их строки
+забираются через FOR UPDATE SKIP LOCKED и делятся между узлами сами.
+"""
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from main import metrics
+from main.config_reader import config
+from main.database import Database, get_table_name
+
+# Сколько дней хранить историю срабатываний
+RETENTION_DAYS = 7
+
+NODE_ID = config.node_id or f"{socket.gethostname()}:{os.getpid()}"
+
+Shard = Tuple[int, int]
+_stats: Dict[str, Any] = {'node_id': NODE_ID, 'ran': 0, 'skipped': 0, 'failed': 0}
+
+
+async def ensure_job_runs_table():
+    """Создать таблицу job_runs если не существует"""
+    table = get_table_name("job_runs")
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            run_key VARCHAR(255) PRIMARY KEY,
+            job_id VARCHAR(100) NOT NULL,
+            node_id VARCHAR(255) NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'running',
+            started_at TIMESTAMP DEFAULT NOW(),
+            finished_at TIMESTAMP NULL
+        )
+    """
+    index_query = f"CREATE INDEX IF NOT EXISTS idx_{table}_started_at ON {table}(started_at)"
+    try:
+        await Database.execute_query(query)
+        await Database.execute_query(index_query)
+    except Exception as e:
+        logging.error(f"Error creating job_runs table: {e}", exc_info=True)
+
+
+_table_ready = False
+
+
+async def _ensure_table_once():
+    global _table_ready
+    if not _table_ready:
+        await ensure_job_runs_table()
+        _table_ready = True
+
+
+def occurrence(now: Optional[datetime] = None) -> datetime:
+    """
+    Срабатывание cron-задачи: текущее время (UTC), округлённое до минуты.
+    Cron стреляет в hh:mm:00 — округление сглаживает расхождение часов узлов до ±30 с.
+    """
+    now = now or datetime.now(timezone.utc)
+    return (now + timedelta(seconds=30)).replace(second=0, microsecond=0)
+
+
+async def claim_run(job_id: str, when: datetime, shard: Optional[Shard] = None) -> Optional[str]:
+    """
+    Занять срабатывание (и часть, если задача шардирована).
+    Возвращает run_key, если занял этот узел, иначе None.
+    """
+    run_key = f"{job_id}:{when.strftime('%Y%m%dT%H%M')}"
+    if shard is not None:
+        run_key += f":{shard[0]}/{shard[1]}"
+    await _ensure_table_once()
+    table = get_table_name("job_runs")
+    claimed = await Database.fetchval(
+        f"""
+        INSERT INTO {table} (run_key, job_id, node_id)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (run_key) DO NOTHING
+        RETURNING run_key
+        """,
+        run_key, job_id, NODE_ID,
+    )
+    return claimed
+
+
+async def finish_run(run_key: str, status: str) -> None:
+    table = get_table_name("job_runs")
+    try:
+        await Database.execute_query(
+            f"UPDATE {table} SET status = $2, finished_at = NOW() WHERE run_key = $1",
+            run_key, status,
+        )
+    except Exception as e:
+        logging.error(f"Error finishing job run {run_key}: {e}", exc_info=True)
+
+
+async def _run_claimed(run_key: str, func: Callable[..., Awaitable[Any]], **kwargs) -> None:
+    logging.info(f"Cluster: {NODE_ID} runs {run_key}")
+    try:
+        await func(**kwargs)
+    except Exception as e:
+        _stats['failed'] += 1
+        await finish_run(run_key, 'failed')
+        logging.error(f"Cluster job {run_key} failed: {e}", exc_info=True)
+        return
+    _stats['ran'] += 1
+    await finish_run(run_key, 'done')
+
+
+def once(job_id: str, func: Callable[..., Awaitable[Any]], shards: int = 1) -> Callable[[], Awaitable[None]]:
+    """
+    Обёртка cron-задачи: каждое срабатывание выполняется ровно одним узлом
+    (или, при shards > 1, каждая часть — одним узлом; func получает shard=(i, N)).
+    """
+    async def wrapper() -> None:
+        when = occurrence()
+        parts = [None] if shards <= 1 else [(i, shards) for i in range(shards)]
+        for shard in parts:
+            try:
+                run_key = await claim_run(job_id, when, shard)
+            except Exception as e:
+                # Без БД не можем гарантировать единственность — пропускаем, а не дублируем
+                logging.error(f"Cluster: cannot claim {job_id}: {e}", exc_info=True)
+                return
+            if run_key is None:
+                _stats['skipped'] += 1
+                continue
+            if shard is None:
+                await _run_claimed(run_key, func)
+            else:
+                await _run_claimed(run_key, func, shard=shard)
+
+    wrapper.__name__ = getattr(func, '__name__', job_id)
+    return wrapper
+
+
+def exclusive(job_id: str, func: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[None]]:
+    """
+    Обёртка интервальной задачи: в каждый момент её выполняет не больше одного узла
+    (advisory lock на время выполнения). Если lock занят — тик пропускается.
+    """
+    lock_name = f"{get_table_name('jobs')}:{job_id}"
+
+    async def wrapper() -> None:
+        pool = await Database.get_pool()
+        async with pool.acquire() as conn:
+            locked = await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", lock_name)
+            if not locked:
+                _stats['skipped'] += 1
+                logging.info(f"Cluster: {job_id} is running on another node, skipping tick")
+                return
+            try:
+                await func()
+                _stats['ran'] += 1
+            except Exception as e:
+                _stats['failed'] += 1
+                logging.error(f"Cluster job {job_id} failed: {e}", exc_info=True)
+            finally:
+                try:
+                    await conn.execute("SELECT pg_advisory_unlock(hashtext($1))", lock_name)
+                except Exception as e:
+                    logging.warning(f"Cluster: could not release lock {job_id}: {e}")
+
+    wrapper.__name__ = getattr(func, '__name__', job_id)
+    return wrapper
+
+
+def in_shard(user_id: int, shard: Optional[Shard]) -> bool:
+    """Относится ли пользователь к части shard=(i, N) (None — все пользователи)."""
+    return shard is None or user_id % shard[1] == shard[0]
+
+
+async def cleanup_job_runs(days: int = RETENTION_DAYS) -> int:
+    """Удалить историю срабатываний старше days дней. Возвращает число удалённых строк."""
+    table = get_table_name("job_runs")
+    try:
+        await _ensure_table_once()
+        result = await Database.execute_query(
+            f"DELETE FROM {table} WHERE started_at < NOW() - make_interval(days => $1)", days
+        )
+        return int(result.split()[-1]) if result else 0
+    except Exception as e:
+        logging.error(f"Error cleaning up job_runs: {e}", exc_info=True)
+        return 0
+
+
+metrics.register("cluster", lambda: dict(_stats))
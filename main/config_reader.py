@@ -19,6 +19,8 @@ class Settings(BaseSettings):
     # Для внешней ссылки на оплату через ЮKassa API
     yookassa_shop_id: Optional[SecretStr] = None
     yookassa_secret_key: Optional[SecretStr] = None
+    # Базовый URL API ЮKassa (для локального фейкового сервера в тестах)
+    yookassa_api_url: str = "https://api.yookassa.ru/v3"
     # PostgreSQL настройки
     db_host: str  
     db_port: int  
@@ -28,8 +30,42 @@ class Settings(BaseSettings):
     # Яндекс Метрика Measurement Protocol
     metrika_mp_counter_id: Optional[int] = None
     metrika_mp_token: Optional[str] = None
+    # Очередь событий MP и число параллельных запросов к Метрике
+    metrika_mp_queue_size: int = 5000
+    metrika_mp_concurrency: int = 10
     # URL вебхук-сервера (для мини-приложений и платежей)
     service_url: Optional[str] = None
+    # Гадания из WebApp: число параллельных обработчиков и длина очереди (сверх неё — 429)
+    webapp_workers: int = 4
+    webapp_queue_size: int = 100
+    # Приём апдейтов MAX: polling (long polling) или webhook (подписка на {SERVICE_URL}/webhook/max,
+    # main/max_webhook.py); секрет подписки проверяется в заголовке X-Max-Bot-Api-Secret
+    bot_updates_mode: str = "polling"
+    max_webhook_secret: Optional[SecretStr] = None
+    # Режим webhook: число процессов-обработчиков апдейтов (шарды по user_id); 0 — в основном процессе
+    update_worker_processes: int = 0
+    # Несколько процессов (main/process_supervisor.py): веб (вебхуки, приём апдейтов),
+    # планировщик и UPDATE_WORKER_PROCESSES обработчиков апдейтов (0 — по числу ядер - 1)
+    bot_supervisor: bool = False
+    # Размер пула подключений к БД (в каждом процессе свой пул)
+    db_pool_max_size: int = 10
+    # Апдейты бота (main/dispatcher.py): сколько апдейтов разных пользователей
+    # разбирается одновременно (апдейты одного пользователя — всегда по очереди)
+    update_workers: int = 32
+    # OpenAI-совместимые LLM-провайдеры (JSON-список, main/llm_providers.py); пусто — DeepSeek с API_KEY
+    llm_providers: Optional[SecretStr] = None
+    # Запросы к LLM (main/llm.py): одновременно на процесс и таймаут одной попытки
+    llm_max_in_flight: int = 8
+    llm_timeout_sec: float = 60
+    # Страховочный запрос к LLM для толкований: через сколько секунд без ответа (≈ p90; 0 — выкл.)
+    # и максимальная доля запросов со страховкой
+    llm_hedge_after_sec: float = 12
+    llm_hedge_max_ratio: float = 0.1
+    # Дедлайн толкования расклада, секунд: LLM не ответил (или недоступен) — краткое толкование
+    # по значениям карт без ИИ, полный ответ — следом отдельным сообщением
+    llm_reading_deadline_sec: float = 25
+    # Бюджет токенов истории уточняющих вопросов (main/llm_context.py)
+    llm_follow_up_context_tokens: int = 1500
     # Канал, на который должны подписаться новые пользователи
     channel_chat_id: Optional[int] = None
     channel_url: Optional[str] = None
@@ -40,15 +76,31 @@ class Settings(BaseSettings):
     tarologist_profile_url: Optional[str] = None
     tarologist_work_hours: Optional[str] = "10:00–22:00"
     payment_reminders_enabled: bool = True
+    # Лимит отправки сообщений через MAX API (сообщений в секунду на процесс; 0 — без лимита)
+    max_api_rate_limit: float = 25
+    # Несколько инстансов бота (main/cluster.py): имя узла (по умолчанию host:pid)
+    # и на сколько частей делить рассылки между узлами
+    node_id: str = ""
+    cluster_shards: int = 1
+    # Токен для GET /internal/metrics (заголовок X-Metrics-Token); не задан — эндпоинт выключен
+    metrics_token: Optional[SecretStr] = None
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", extra="allow")
 
-    @field_validator("payment_reminders_enabled", mode="before")
+    @field_validator("payment_reminders_enabled", "bot_supervisor", mode="before")
     @classmethod
     def parse_payment_reminders_enabled(cls, v):
         if isinstance(v, str):
             return v.lower() in ('true', '1', 'yes', 'on')
         return v
 
+    @field_validator("bot_updates_mode")
+    @classmethod
+    def check_bot_updates_mode(cls, v):
+        v = (v or "polling").strip().lower()
+        if v not in ("polling", "webhook"):
+            raise ValueError("BOT_UPDATES_MODE must be 'polling' or 'webhook'")
+        return v
+
     @field_validator("metrika_mp_counter_id", "admin_chat_id", "channel_chat_id", mode="before")
     @classmethod
     def empty_str_to_none(cls, v):
@@ -10,51 +10,205 @@
   2. Директ → бот: конверсии прошиваются через Measurement Protocol (счётчик 106708199).
      В БД сохраняется yclid + metrika_client_id. Модуль metrika_mp.py отправляет события.
 
+Хендлеры пишут конверсии через track_conversion() / track_paywall_conversion():
+событие уходит в write-behind буфер и пишется в БД пачками, ответ пользователю
+не ждёт аналитику. Других путей записи в conversions нет.
+
 CSV-экспорт (функции generate_csv_*) — legacy, не используется.
 """
+import asyncio
 import logging
-from typing import Optional, Dict, Any, List
+from collections import deque
+from typing import Deque, Optional, Dict, Any, List
 from datetime import datetime
-import json
+
+import asyncpg
+
+from main import metrics
 from main.database import Database, get_table_name
 
 
-async def save_paywall_conversion(
-    user_id: int,
-    paywall_source: str,
-    client_id: Optional[str] = None,
-    metadata: Optional[Dict[str, Any]] = None
-) -> Optional[int]:
+# ==================== Write-behind буфер конверсий ====================
+# Хендлеры не ждут запись аналитики: track_conversion() кладёт событие в память
+# и сразу возвращается. Фоновый flusher пишет пачками (executemany) по размеру
+# или по таймеру, client_id добирает одним запросом на всю пачку.
+# При остановке бота/скрипта обязательно вызывать `await conversion_buffer.stop()`.
+
+CONVERSION_BATCH_SIZE = 200
+CONVERSION_FLUSH_INTERVAL_SEC = 2.0
+# Жёсткий предел очереди в памяти (если БД недоступна долго) — старые события отбрасываются
+CONVERSION_BUFFER_LIMIT = 20000
+
+_CONVERSION_COLUMNS = (
+    'user_id', 'client_id', 'conversion_type', 'conversion_value', 'conversion_currency',
+    'package_id', 'divination_type', 'conversion_datetime', 'source', 'campaign_id', 'ad_id',
+    'metadata',
+)
+
+
+async def _resolve_client_ids(conn, events: List[Dict[str, Any]]) -> None:
+    """Заполнить client_id из таблицы users одним запросом на всю пачку."""
+    missing = {e['user_id'] for e in events if e['client_id'] is None}
+    if not missing:
+        return
+    users_table = get_table_name("users")
+    rows = await conn.fetch(
+        f"SELECT user_id, client_id FROM {users_table} "
+        f"WHERE user_id = ANY($1::bigint[]) AND client_id IS NOT NULL",
+        list(missing),
+    )
+    client_ids = {r['user_id']: r['client_id'] for r in rows}
+    for e in events:
+        if e['client_id'] is None:
+            e['client_id'] = client_ids.get(e['user_id'])
+
+
+# Ошибки соединения (в отличие от ошибок данных в строке) — пачку не пропускать, а повторить
+_CONNECTION_ERRORS = (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, OSError)
+
+
+async def _insert_conversions_batch(events: List[Dict[str, Any]]) -> int:
     """
-    Сохранить конверсию просмотра пейволла (paywall_reached)
-    
-    Args:
-        user_id: Telegram User ID
-        paywall_source: Источник показа пейволла:
-            - 'command_pay': пользователь нажал /pay
-            - 'text_pay': пользователь нажал "Купить расклады" или "Оплата"
-            - 'divination_blocked': попытка гадать, когда закончились бесплатные гадания
-            - 'callback_remind_pay': нажал кнопку "Оплатить" в напоминании
-            - 'no_divinations_reminder': получил напоминание о закончившихся гаданиях
-            - 'balance_view': просмотр баланса, когда нет гаданий
-        client_id: ClientID из Яндекс Метрики (может быть None)
-        metadata: Дополнительные данные (например, divination_type, balance_info и т.д.)
-    
-    Returns:
-        ID сохраненной конверсии или None при ошибке
+    Записать пачку конверсий. Если пачка целиком не прошла (например, FK на
+    несуществующего пользователя) — пишем построчно, чтобы одна плохая строка
+    не теряла остальные. Возвращает число записанных строк.
     """
-    return await save_conversion(
-        user_id=user_id,
-        conversion_type='paywall_reached',
-        client_id=client_id,
-        metadata={
-            'paywall_source': paywall_source,
-            **(metadata or {})
-        }
-    )
+    conversions_table = get_table_name("conversions")
+    query = f"""
+        INSERT INTO {conversions_table} (
+            user_id, client_id, conversion_type, conversion_value, conversion_currency,
+            package_id, divination_type, conversion_datetime, source, campaign_id, ad_id,
+            metadata, exported_to_yandex, created_at
+        )
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, FALSE, NOW())
+    """
+    pool = await Database.get_pool()
+    async with pool.acquire() as conn:
+        await _resolve_client_ids(conn, events)
+        records = [tuple(e[col] for col in _CONVERSION_COLUMNS) for e in events]
+        try:
+            await conn.executemany(query, records)
+            return len(records)
+        except _CONNECTION_ERRORS:
+            # Соединение потеряно — пачка целиком вернётся в буфер (ConversionBuffer.flush)
+            raise
+        except Exception as e:
+            logging.warning(f"Batch insert of {len(records)} conversions failed, retrying row by row: {e}")
 
+        saved = 0
+        for record in records:
+            try:
+                await conn.execute(query, *record)
+                saved += 1
+            except _CONNECTION_ERRORS:
+                raise
+            except Exception as e:
+                logging.error(
+                    f"Error saving conversion for user {record[0]} (type={record[2]}): {e}",
+                    exc_info=True,
+                )
+        return saved
+
+
+class ConversionBuffer:
+    """Асинхронный буфер конверсий с пакетной записью в БД."""
+
+    def __init__(
+        self,
+        batch_size: int = CONVERSION_BATCH_SIZE,
+        flush_interval: float = CONVERSION_FLUSH_INTERVAL_SEC,
+        max_pending: int = CONVERSION_BUFFER_LIMIT,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: Deque[Dict[str, Any]] = deque(maxlen=max_pending)
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.dropped = 0
+
+    def add(self, event: Dict[str, Any]) -> None:
+        """Принять событие (не блокирует). Flusher стартует лениво на текущем event loop."""
+        if len(self._pending) >= self.max_pending:
+            # deque(maxlen) сам вытеснит самое старое событие
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logging.warning(f"Conversion buffer overflow: {self.dropped} event(s) dropped so far")
+        self._pending.append(event)
+        self._ensure_started()
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _ensure_started(self) -> None:
+        if self._stopping or (self._task is not None and not self._task.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # вне event loop: событие дождётся flush() / stop()
+        self._task = loop.create_task(self._run())
 
-async def save_conversion(
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Conversion buffer flush error: {e}", exc_info=True)
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self) -> int:
+        """Записать всё накопленное. Возвращает число записанных строк."""
+        saved = 0
+        async with self._flush_lock:
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                try:
+                    saved += await _insert_conversions_batch(batch)
+                except Exception:
+                    # БД недоступна — возвращаем пачку в начало очереди, попробуем позже
+                    # (не помещается — теряются самые новые события)
+                    self.dropped += max(0, len(self._pending) + len(batch) - self.max_pending)
+                    self._pending.extendleft(reversed(batch))
+                    raise
+        if saved:
+            logging.info(f"Conversions flushed: {saved}")
+        return saved
+
+    async def stop(self) -> None:
+        """Остановить flusher и дописать хвост (вызывать до Database.close_pool())."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception as e:
+                logging.error(f"Conversion buffer task failed on stop: {e}", exc_info=True)
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(
+                f"Conversion buffer: {len(self._pending)} event(s) lost on shutdown: {e}",
+                exc_info=True,
+            )
+        self._stopping = False
+
+
+conversion_buffer = ConversionBuffer()
+metrics.register("conversions", lambda: {
+    "pending": len(conversion_buffer._pending),
+    "dropped": conversion_buffer.dropped,
+})
+
+
+def track_conversion(
     user_id: int,
     conversion_type: str,
     client_id: Optional[str] = None,
@@ -67,14 +221,15 @@ async def save_conversion(
     ad_id: Optional[str] = None,
     metadata: Optional[Dict[str, Any]] = None,
     conversion_datetime: Optional[datetime] = None
-) -> Optional[int]:
+) -> None:
     """
-    Сохранить конверсию в БД
-    
+    Поставить конверсию в write-behind буфер. Не ждёт БД; время конверсии
+    фиксируется в момент вызова.
+
     Args:
         user_id: Telegram User ID
         conversion_type: Тип конверсии ('registration', 'purchase', 'service_usage', 'paywall_reached')
-        client_id: ClientID из Яндекс Метрики (может быть None)
+        client_id: ClientID из Яндекс Метрики (None — возьмётся из таблицы users при записи)
         conversion_value: Стоимость конверсии (для покупок)
         conversion_currency: Валюта (по умолчанию 'RUB')
         package_id: ID пакета (для покупок: '3_spreads', '10_spreads', '20_spreads', '30_spreads', 'unlimited')
@@ -84,64 +239,53 @@ async def save_conversion(
         ad_id: ID объявления
         metadata: Дополнительные данные в формате JSON
         conversion_datetime: Дата и время конверсии (если None, используется текущее время)
-    
-    Returns:
-        ID сохраненной конверсии или None при ошибке
     """
-    try:
-        if conversion_datetime is None:
-            conversion_datetime = datetime.now()
-        
-        # Если client_id не передан, пытаемся получить из таблицы users
-        if client_id is None:
-            users_table = get_table_name("users")
-            user_query = f"""
-                SELECT client_id FROM {users_table} WHERE user_id = $1
-            """
-            user_result = await Database.fetch_one(user_query, user_id)
-            if user_result and user_result['client_id']:
-                client_id = user_result['client_id']
-        
-        conversions_table = get_table_name("conversions")
-        query = f"""
-            INSERT INTO {conversions_table} (
-                user_id, client_id, conversion_type, conversion_value, conversion_currency,
-                package_id, divination_type, conversion_datetime, source, campaign_id, ad_id,
-                metadata, exported_to_yandex, created_at
-            )
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, FALSE, NOW())
-            RETURNING id
-        """
-        
-        metadata_json = json.dumps(metadata) if metadata else None
-        
-        result = await Database.fetch_one(
-            query,
-            user_id,
-            client_id,
-            conversion_type,
-            conversion_value,
-            conversion_currency,
-            package_id,
-            divination_type,
-            conversion_datetime,
-            source,
-            campaign_id,
-            ad_id,
-            metadata_json
-        )
-        
-        if result:
-            conversion_id = result['id']
-            logging.info(
-                f"Conversion saved: id={conversion_id}, user={user_id}, "
-                f"type={conversion_type}, client_id={client_id}"
-            )
-            return conversion_id
-        return None
-    except Exception as e:
-        logging.error(f"Error saving conversion for user {user_id}: {e}", exc_info=True)
-        return None
+    conversion_buffer.add({
+        'user_id': user_id,
+        'client_id': client_id,
+        'conversion_type': conversion_type,
+        'conversion_value': conversion_value,
+        'conversion_currency': conversion_currency,
+        'package_id': package_id,
+        'divination_type': divination_type,
+        'conversion_datetime': conversion_datetime or datetime.now(),
+        'source': source,
+        'campaign_id': campaign_id,
+        'ad_id': ad_id,
+        'metadata': metadata or None,
+    })
+
+
+def track_paywall_conversion(
+    user_id: int,
+    paywall_source: str,
+    client_id: Optional[str] = None,
+    metadata: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    Поставить конверсию просмотра пейволла (paywall_reached) в буфер.
+
+    Args:
+        user_id: Telegram User ID
+        paywall_source: Источник показа пейволла:
+            - 'command_pay': пользователь нажал /pay
+            - 'text_pay': пользователь нажал "Купить расклады" или "Оплата"
+            - 'divination_blocked': попытка гадать, когда закончились гадания
+            - 'callback_remind_pay': нажал кнопку "Оплатить" в напоминании
+            - 'no_divinations_reminder': получил напоминание о закончившихся гаданиях
+            - 'balance_view': просмотр баланса, когда нет гаданий
+        client_id: ClientID из Яндекс Метрики (может быть None)
+        metadata: Дополнительные данные (например, divination_type, balance_info и т.д.)
+    """
+    track_conversion(
+        user_id=user_id,
+        conversion_type='paywall_reached',
+        client_id=client_id,
+        metadata={
+            'paywall_source': paywall_source,
+            **(metadata or {})
+        }
+    )
 
 
 async def get_unexported_conversions(limit: int = 1000, only_with_client_id: bool = False) -> List[Dict[str, Any]]:
@@ -190,7 +334,7 @@ async def get_unexported_conversions(limit: int = 1000, only_with_client_id: boo
                 'source': r['source'],
                 'campaign_id': r['campaign_id'],
                 'ad_id': r['ad_id'],
-                'metadata': json.loads(r['metadata']) if r['metadata'] else None,
+                'metadata': r['metadata'],
                 'created_at': r['created_at']
             }
             for r in results
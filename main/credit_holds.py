@@ -0,0 +1,251 @@
+"""
+Резерв гадания на время расклада: reserve → commit / release.
+
+Раньше расклад проверял баланс в начале (can_user_divinate), а списывал
+гадание после ответа LLM: второе чтение баланса, и два одновременных расклада
+одного пользователя проходили проверку оба. Теперь:
+
+- reserve() в начале расклада атомарно списывает одно гадание (FOR UPDATE по
+  балансу, см. database.spend_divination) и записывает резерв с TTL;
+  второй расклад при последнем гадании получает None;
+- commit() после ответа LLM удаляет резерв и сохраняет гадание той же транзакцией,
+  без повторной проверки баланса;
+- commit_saved() — то же для гадания, уже сохранённого без списания (краткое
+  толкование, к которому позже пришло полное, см. handlers/divination.py);
+- release() при ошибке (LLM недоступен и т.п.) возвращает гадание на баланс;
+- резерв, который уже вернули по TTL, commit/commit_saved списывают заново;
+  списать нечем — HoldExpiredError (транзакция откатывается, гадание не сохраняется);
+- резервы, которые никто не закрыл (процесс упал посреди расклада), возвращает
+  sweep_expired_holds() — тик планировщика раз в минуту.
+
+    hold = await credit_holds.reserve(user_id, "Таро")
+    if hold is None: ...  # гаданий нет
+    try:
+        answer = await llm(...)
+        divination_id = await credit_holds.commit(hold, question=..., interpretation=answer)
+    except Exception:
+        await credit_holds.release(hold)
+        raise
+
+hold — dict: id, user_id, access_type ('unlimited' | 'free' | 'paid'),
+divination_type, is_free. После commit access_type и is_free — фактическое списание.
+"""
+import logging
+from typing import Any, Dict, List, Optional
+
+from main import metrics
+from main.database import Database, get_table_name, spend_divination
+
+# Сколько держится резерв без commit/release (дольше любого ответа LLM)
+HOLD_TTL_SEC = 600
+# Сколько просроченных резервов возвращать за один тик
+SWEEP_BATCH_SIZE = 500
+
+_stats: Dict[str, int] = {
+    'reserved': 0, 'rejected': 0, 'committed': 0, 'released': 0, 'expired': 0, 'expired_uncharged': 0,
+}
+
+
+class HoldExpiredError(Exception):
+    """Резерв вернули по TTL до commit, а списать гадание заново нечем."""
+
+
+async def ensure_credit_holds_table():
+    """Создать таблицу credit_holds если не существует"""
+    table = get_table_name("credit_holds")
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            access_type VARCHAR(20) NOT NULL,
+            divination_type VARCHAR(50) NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """
+    index_query = f"""
+        CREATE INDEX IF NOT EXISTS idx_{table}_expires
+            ON {table}(expires_at)
+    """
+    try:
+        await Database.execute_query(query)
+        await Database.execute_query(index_query)
+    except Exception as e:
+        logging.error(f"Error creating credit_holds table: {e}", exc_info=True)
+
+
+_table_ready = False
+
+
+async def ensure_credit_holds_table_once():
+    global _table_ready
+    if not _table_ready:
+        await ensure_credit_holds_table()
+        _table_ready = True
+
+
+def _release_query(where: str, limit: Optional[int] = None) -> str:
+    """
+    Удалить резервы по условию where и вернуть их гадания на баланс
+    (одним запросом; total_divinations_used откатывается тоже).
+    """
+    holds_table = get_table_name("credit_holds")
+    balances_table = get_table_name("user_balances")
+    return f"""
+        WITH released AS (
+            DELETE FROM {holds_table}
+            WHERE id IN (
+                SELECT id FROM {holds_table}
+                WHERE {where}
+                ORDER BY id
+                {f"LIMIT {int(limit)}" if limit else ""}
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING user_id, access_type
+        ),
+        per_user AS (
+            SELECT user_id,
+                   COUNT(*) FILTER (WHERE access_type = 'free') AS free,
+                   COUNT(*) FILTER (WHERE access_type = 'paid') AS paid,
+                   COUNT(*) AS total
+            FROM released
+            GROUP BY user_id
+        )
+        UPDATE {balances_table} b
+        SET free_divinations_remaining = b.free_divinations_remaining + per_user.free,
+            paid_divinations_remaining = b.paid_divinations_remaining + per_user.paid,
+            total_divinations_used = GREATEST(b.total_divinations_used - per_user.total, 0),
+            updated_at = NOW()
+        FROM per_user
+        WHERE b.user_id = per_user.user_id
+        RETURNING b.user_id, per_user.total
+    """
+
+
+async def reserve(user_id: int, divination_type: str, ttl_sec: int = HOLD_TTL_SEC) -> Optional[Dict[str, Any]]:
+    """Списать одно гадание под резерв. None — гаданий нет (или ошибка БД)."""
+    await ensure_credit_holds_table_once()
+    table = get_table_name("credit_holds")
+    try:
+        pool = await Database.get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                access_type = await spend_divination(conn, user_id)
+                if access_type is None:
+                    _stats['rejected'] += 1
+                    return None
+                hold_id = await conn.fetchval(
+                    f"""
+                    INSERT INTO {table} (user_id, access_type, divination_type, expires_at)
+                    VALUES ($1, $2, $3, NOW() + make_interval(secs => $4))
+                    RETURNING id
+                    """,
+                    user_id, access_type, divination_type, float(ttl_sec)
+                )
+    except Exception as e:
+        logging.error(f"Error reserving divination for user {user_id}: {e}", exc_info=True)
+        return None
+    _stats['reserved'] += 1
+    logging.info(f"Divination reserved: hold={hold_id}, user={user_id}, access={access_type}")
+    return {
+        'id': hold_id,
+        'user_id': user_id,
+        'access_type': access_type,
+        'divination_type': divination_type,
+        'is_free': access_type == 'free',
+    }
+
+
+async def _close_hold(conn, hold: Dict[str, Any]) -> None:
+    """
+    Удалить резерв (в транзакции conn); резерв уже вернули по TTL — списать заново.
+    hold['access_type'] / hold['is_free'] обновляются по фактическому списанию;
+    списать нечем — HoldExpiredError.
+    """
+    holds_table = get_table_name("credit_holds")
+    deleted = await conn.fetchval(f"DELETE FROM {holds_table} WHERE id = $1 RETURNING id", hold['id'])
+    if deleted is not None:
+        return
+    logging.warning(f"Divination hold {hold['id']} of user {hold['user_id']} expired before commit")
+    access_type = await spend_divination(conn, hold['user_id'])
+    if access_type is None:
+        _stats['expired_uncharged'] += 1
+        raise HoldExpiredError(f"hold {hold['id']} expired, user {hold['user_id']} has no divinations left")
+    hold['access_type'] = access_type
+    hold['is_free'] = access_type == 'free'
+
+
+async def commit(
+    hold: Dict[str, Any],
+    question: str,
+    interpretation: Optional[str] = None,
+    selected_cards: Optional[List[str]] = None,
+) -> int:
+    """
+    Закрыть резерв и сохранить гадание одной транзакцией. Возвращает id гадания.
+    Если резерв уже вернули по TTL, гадание списывается заново; нечем — HoldExpiredError,
+    гадание не сохраняется.
+    """
+    divinations_table = get_table_name("divinations")
+    user_id = hold['user_id']
+    pool = await Database.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await _close_hold(conn, hold)
+            divination_id = await conn.fetchval(
+                f"""
+                INSERT INTO {divinations_table} (user_id, divination_type, question, selected_cards, interpretation, is_free, created_at)
+                VALUES ($1, $2, $3, $4, $5, $6, NOW())
+                RETURNING id
+                """,
+                user_id, hold['divination_type'], question, selected_cards or None, interpretation, hold['is_free']
+            )
+    _stats['committed'] += 1
+    logging.info(f"Divination saved: id={divination_id}, user={user_id}, type={hold['divination_type']}")
+    return divination_id
+
+
+async def commit_saved(hold: Dict[str, Any], divination_id: Optional[int]) -> None:
+    """
+    Закрыть резерв за уже сохранённое гадание divination_id (оно становится списанным).
+    Списать нечем (резерв вернули по TTL) — HoldExpiredError, гадание остаётся бесплатным.
+    """
+    divinations_table = get_table_name("divinations")
+    pool = await Database.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await _close_hold(conn, hold)
+            if divination_id:
+                await conn.execute(
+                    f"UPDATE {divinations_table} SET is_free = $1 WHERE id = $2",
+                    hold['is_free'], divination_id
+                )
+    _stats['committed'] += 1
+    logging.info(f"Divination hold {hold['id']} committed for saved divination {divination_id}")
+
+
+async def release(hold: Dict[str, Any]) -> None:
+    """Вернуть гадание резерва на баланс (после commit — ничего не делает)."""
+    try:
+        rows = await Database.fetch_all(_release_query("id = $1"), hold['id'])
+    except Exception as e:
+        # Не вернули сейчас — вернёт sweep_expired_holds по TTL
+        logging.error(f"Error releasing divination hold {hold['id']}: {e}", exc_info=True)
+        return
+    if rows:
+        _stats['released'] += 1
+        logging.info(f"Divination hold {hold['id']} released for user {hold['user_id']}")
+
+
+async def sweep_expired_holds() -> int:
+    """Вернуть на баланс гадания просроченных резервов. Возвращает число резервов."""
+    await ensure_credit_holds_table_once()
+    rows = await Database.fetch_all(
+        _release_query("expires_at < NOW()", limit=SWEEP_BATCH_SIZE)
+    )
+    expired = sum(row['total'] for row in rows)
+    _stats['expired'] += expired
+    return expired
+
+
+metrics.register("credit_holds", lambda: dict(_stats))
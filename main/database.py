@@ -5,8 +5,8 @@ import logging
 from typing import Optional, Dict, Any, List
 import asyncpg
 from datetime import datetime, timedelta
-import json
 
+from main import json_codec
 from main.config_reader import config
 
 
@@ -24,32 +24,61 @@ def get_table_name(base_name: str) -> str:
     return f"max_{base_name}{suffix}"
 
 
+async def _init_connection(conn: asyncpg.Connection):
+    """
+    Инициализация каждого соединения пула: кодеки jsonb/json.
+    В запросы передаём dict/list напрямую, из БД получаем уже разобранные объекты —
+    ручные json.dumps/json.loads в CRUD-функциях не нужны.
+    """
+    for type_name in ('jsonb', 'json'):
+        await conn.set_type_codec(
+            type_name,
+            encoder=json_codec.dumps,
+            decoder=json_codec.loads,
+            schema='pg_catalog',
+        )
+
+
 class Database:
     """Класс для работы с базой данных"""
     
     _pool: Optional[asyncpg.Pool] = None
     
+    @staticmethod
+    def _connect_kwargs() -> Dict[str, Any]:
+        """Параметры подключения к PostgreSQL из настроек"""
+        # Получаем значения с защитой (SecretStr требует явного вызова get_secret_value)
+        db_user = config.db_user.get_secret_value() if hasattr(config.db_user, 'get_secret_value') else config.db_user
+        db_password = config.db_password.get_secret_value() if hasattr(config.db_password, 'get_secret_value') else config.db_password
+        return {
+            'host': config.db_host,
+            'port': config.db_port,
+            'database': config.db_name,
+            'user': db_user,
+            'password': db_password,
+        }
+
+    @classmethod
+    async def connect(cls) -> asyncpg.Connection:
+        """Отдельное долгоживущее подключение вне пула (для LISTEN)"""
+        conn = await asyncpg.connect(**cls._connect_kwargs())
+        await _init_connection(conn)
+        return conn
+
     @classmethod
     async def get_pool(cls) -> asyncpg.Pool:
         """Получить пул подключений к БД"""
         if cls._pool is None:
             try:
-                # Получаем значения с защитой (SecretStr требует явного вызова get_secret_value)
-                db_user = config.db_user.get_secret_value() if hasattr(config.db_user, 'get_secret_value') else config.db_user
-                db_password = config.db_password.get_secret_value() if hasattr(config.db_password, 'get_secret_value') else config.db_password
-                
                 # Логируем параметры подключения (без пароля и пользователя для безопасности)
                 logging.info(f"Connecting to database: host={config.db_host}, port={config.db_port}, database={config.db_name}")
                 
                 cls._pool = await asyncpg.create_pool(
-                    host=config.db_host,
-                    port=config.db_port,
-                    database=config.db_name,
-                    user=db_user,
-                    password=db_password,
+                    **cls._connect_kwargs(),
                     min_size=2,
-                    max_size=10,
-                    command_timeout=60
+                    max_size=max(2, config.db_pool_max_size),
+                    command_timeout=60,
+                    init=_init_connection
                 )
                 logging.info("Database connection pool created successfully")
             except Exception as e:
@@ -150,7 +179,7 @@ async def create_or_update_user(
                 utm_term = COALESCE(EXCLUDED.utm_term, {users_table}.utm_term),
                 yclid = COALESCE(EXCLUDED.yclid, {users_table}.yclid),
                 metrika_client_id = COALESCE(EXCLUDED.metrika_client_id, {users_table}.metrika_client_id)
-            RETURNING (xmax = 0) AS is_new
+            RETURNING (xmax = 0) AS is_new, metrika_client_id
         """
         
         result = await Database.fetch_one(
@@ -160,9 +189,17 @@ async def create_or_update_user(
         )
         is_new = result['is_new'] if result else False
         
-        # Если пользователь новый, создаем баланс
+        # Директ-пользователь: сразу в кэш MP, иначе закэшированное «не директ»
+        # скрывало бы его цели до истечения отрицательного TTL
+        if result and result['metrika_client_id']:
+            from main.metrika_mp import remember_metrika_client_id
+            remember_metrika_client_id(user_id, result['metrika_client_id'])
+        
+        # Если пользователь новый, создаем баланс и ставим таймер welcome-активации
         if is_new:
             await create_user_balance(user_id)
+            from main.activation import schedule_activation
+            await schedule_activation(user_id)
             logging.info(f"New user created: {user_id} ({full_name})")
         else:
             logging.info(f"User updated: {user_id} ({full_name})")
@@ -245,6 +282,68 @@ async def can_user_divinate(user_id: int) -> tuple[bool, str]:
         return False, 'no_balance'
 
 
+async def spend_divination(conn: asyncpg.Connection, user_id: int) -> Optional[str]:
+    """
+    Списать одно гадание в транзакции conn (сначала бесплатные, затем платные).
+    Возвращает тип доступа ('unlimited', 'free', 'paid') или None, если гаданий нет.
+    """
+    balances_table = get_table_name("user_balances")
+    # Получаем текущий баланс
+    balance_query = f"""
+        SELECT free_divinations_remaining, paid_divinations_remaining, unlimited_until
+        FROM {balances_table}
+        WHERE user_id = $1
+        FOR UPDATE
+    """
+    balance = await conn.fetchrow(balance_query, user_id)
+
+    if not balance:
+        logging.warning(f"Balance not found for user {user_id}")
+        return None
+
+    # Если есть безлимит и он не истек
+    if balance['unlimited_until'] and balance['unlimited_until'] > datetime.now():
+        # Просто увеличиваем счетчик использованных
+        update_query = f"""
+            UPDATE {balances_table}
+            SET total_divinations_used = total_divinations_used + 1,
+                updated_at = NOW()
+            WHERE user_id = $1
+        """
+        await conn.execute(update_query, user_id)
+        logging.info(f"Divination used (unlimited) for user {user_id}")
+        return 'unlimited'
+
+    # Если есть бесплатные, тратим их
+    if balance['free_divinations_remaining'] > 0:
+        update_query = f"""
+            UPDATE {balances_table}
+            SET free_divinations_remaining = free_divinations_remaining - 1,
+                total_divinations_used = total_divinations_used + 1,
+                updated_at = NOW()
+            WHERE user_id = $1
+        """
+        await conn.execute(update_query, user_id)
+        logging.info(f"Free divination used for user {user_id}")
+        return 'free'
+
+    # Если есть платные, тратим их
+    if balance['paid_divinations_remaining'] > 0:
+        update_query = f"""
+            UPDATE {balances_table}
+            SET paid_divinations_remaining = paid_divinations_remaining - 1,
+                total_divinations_used = total_divinations_used + 1,
+                updated_at = NOW()
+            WHERE user_id = $1
+        """
+        await conn.execute(update_query, user_id)
+        logging.info(f"Paid divination used for user {user_id}")
+        return 'paid'
+
+    logging.warning(f"No divinations available for user {user_id}")
+    return None
+
+
 async def use_divination(user_id: int) -> bool:
     """
     Использовать одно гадание (уменьшить баланс)
@@ -254,61 +353,7 @@ async def use_divination(user_id: int) -> bool:
         pool = await Database.get_pool()
         async with pool.acquire() as conn:
             async with conn.transaction():
-                balances_table = get_table_name("user_balances")
-                # Получаем текущий баланс
-                balance_query = f"""
-                    SELECT free_divinations_remaining, paid_divinations_remaining, unlimited_until
-                    FROM {balances_table}
-                    WHERE user_id = $1
-                    FOR UPDATE
-                """
-                balance = await conn.fetchrow(balance_query, user_id)
-                
-                if not balance:
-                    logging.warning(f"Balance not found for user {user_id}")
-                    return False
-                
-                # Если есть безлимит и он не истек
-                if balance['unlimited_until'] and balance['unlimited_until'] > datetime.now():
-                    # Просто увеличиваем счетчик использованных
-                    update_query = f"""
-                        UPDATE {balances_table}
-                        SET total_divinations_used = total_divinations_used + 1,
-                            updated_at = NOW()
-                        WHERE user_id = $1
-                    """
-                    await conn.execute(update_query, user_id)
-                    logging.info(f"Divination used (unlimited) for user {user_id}")
-                    return True
-                
-                # Если есть бесплатные, тратим их
-                if balance['free_divinations_remaining'] > 0:
-                    update_query = f"""
-                        UPDATE {balances_table}
-                        SET free_divinations_remaining = free_divinations_remaining - 1,
-                            total_divinations_used = total_divinations_used + 1,
-                            updated_at = NOW()
-                        WHERE user_id = $1
-                    """
-                    await conn.execute(update_query, user_id)
-                    logging.info(f"Free divination used for user {user_id}")
-                    return True
-                
-                # Если есть платные, тратим их
-                if balance['paid_divinations_remaining'] > 0:
-                    update_query = f"""
-                        UPDATE {balances_table}
-                        SET paid_divinations_remaining = paid_divinations_remaining - 1,
-                            total_divinations_used = total_divinations_used + 1,
-                            updated_at = NOW()
-                        WHERE user_id = $1
-                    """
-                    await conn.execute(update_query, user_id)
-                    logging.info(f"Paid divination used for user {user_id}")
-                    return True
-                
-                logging.warning(f"No divinations available for user {user_id}")
-                return False
+                return await spend_divination(conn, user_id) is not None
     except Exception as e:
         logging.error(f"Error using divination for user {user_id}: {e}", exc_info=True)
         return False
@@ -336,9 +381,7 @@ async def save_divination(
             RETURNING id
         """
         
-        selected_cards_json = json.dumps(selected_cards) if selected_cards else None
-        
-        result = await Database.fetch_one(query, user_id, divination_type, question, selected_cards_json, interpretation, is_free)
+        result = await Database.fetch_one(query, user_id, divination_type, question, selected_cards or None, interpretation, is_free)
         if result:
             divination_id = result['id']
             logging.info(f"Divination saved: id={divination_id}, user={user_id}, type={divination_type}")
@@ -366,7 +409,7 @@ async def get_user_divinations(user_id: int, limit: int = 10) -> List[Dict[str,
                 'id': r['id'],
                 'divination_type': r['divination_type'],
                 'question': r['question'],
-                'selected_cards': json.loads(r['selected_cards']) if r['selected_cards'] else None,
+                'selected_cards': r['selected_cards'],
                 'interpretation': r['interpretation'],
                 'is_free': r['is_free'],
                 'created_at': r['created_at']
@@ -397,6 +440,26 @@ async def update_divination_interpretation(divination_id: int, interpretation: s
         return False
 
 
+async def replace_divination_interpretation(divination_id: int, old_text: str, new_text: str) -> bool:
+    """
+    Заменить начало interpretation (толкование) на new_text, сохранив дописанные
+    после него уточнения. Ничего не делает, если толкование уже другое.
+    """
+    try:
+        divinations_table = get_table_name("divinations")
+        query = f"""
+            UPDATE {divinations_table}
+            SET interpretation = $1 || substr(interpretation, length($2) + 1)
+            WHERE id = $3 AND left(interpretation, length($2)) = $2
+            RETURNING id
+        """
+        result = await Database.fetch_one(query, new_text, old_text, divination_id)
+        return result is not None
+    except Exception as e:
+        logging.error(f"Error replacing divination {divination_id} interpretation: {e}", exc_info=True)
+        return False
+
+
 # ==================== Платежи ====================
 
 async def create_payment(
@@ -408,18 +471,29 @@ async def create_payment(
     email: Optional[str] = None,
     yookassa_metadata: Optional[Dict[str, Any]] = None
 ) -> bool:
-    """Создать запись о платеже"""
+    """
+    Создать запись о платеже.
+    В той же транзакции ставятся таймеры напоминаний об оплате (10м / 1ч / 3ч).
+    """
     try:
+        from main import payment_reminders
+        await payment_reminders.ensure_ready()
         payments_table = get_table_name("payments")
         query = f"""
             INSERT INTO {payments_table} (payment_id, user_id, package_id, amount, amount_rub, status, email, yookassa_metadata, created_at, updated_at)
             VALUES ($1, $2, $3, $4, $5, 'pending', $6, $7, NOW(), NOW())
             ON CONFLICT (payment_id) DO NOTHING
+            RETURNING payment_id
         """
         
-        metadata_json = json.dumps(yookassa_metadata) if yookassa_metadata else None
-        
-        await Database.execute_query(query, payment_id, user_id, package_id, amount, amount_rub, email, metadata_json)
+        pool = await Database.get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                inserted = await conn.fetchval(
+                    query, payment_id, user_id, package_id, amount, amount_rub, email, yookassa_metadata or None
+                )
+                if inserted:
+                    await payment_reminders.schedule_payment_reminders(conn, payment_id, user_id)
         logging.info(f"Payment created: {payment_id} for user {user_id}, package {package_id}")
         return True
     except Exception as e:
@@ -444,9 +518,7 @@ async def update_payment_status(
             WHERE payment_id = $3::VARCHAR(255)
         """
         
-        metadata_json = json.dumps(yookassa_metadata) if yookassa_metadata else None
-        
-        await Database.execute_query(query, status, metadata_json, payment_id)
+        await Database.execute_query(query, status, yookassa_metadata or None, payment_id)
         logging.info(f"Payment status updated: {payment_id} -> {status}")
         return True
     except Exception as e:
@@ -454,13 +526,22 @@ async def update_payment_status(
         return False
 
 
-async def process_successful_payment(payment_id: str, yookassa_metadata: Optional[Dict[str, Any]] = None) -> bool:
+async def process_successful_payment(
+    payment_id: str,
+    yookassa_metadata: Optional[Dict[str, Any]] = None,
+    notify: bool = False
+) -> bool:
     """
     Обработать успешный платеж (идемпотентно):
     1. Атомарно перевести статус pending → succeeded (если уже succeeded — пропустить)
     2. Обновить баланс пользователя (добавить гадания или создать подписку)
+    3. notify=True — в той же транзакции записать в outbox события payment_succeeded
+       (уведомление) и metrika_goal (цель Метрики); отправит их воркер main/outbox.py
     """
     try:
+        if notify:
+            from main import outbox
+            await outbox.ensure_outbox_table_once()
         pool = await Database.get_pool()
         async with pool.acquire() as conn:
             async with conn.transaction():
@@ -478,10 +559,9 @@ async def process_successful_payment(payment_id: str, yookassa_metadata: Optiona
                         completed_at = NOW(),
                         yookassa_metadata = COALESCE($2::jsonb, yookassa_metadata)
                     WHERE payment_id = $1 AND status != 'succeeded'
-                    RETURNING user_id, package_id, amount, amount_rub
+                    RETURNING user_id, package_id, amount, amount_rub, email
                 """
-                metadata_json = json.dumps(yookassa_metadata) if yookassa_metadata else None
-                payment = await conn.fetchrow(claim_query, payment_id, metadata_json)
+                payment = await conn.fetchrow(claim_query, payment_id, yookassa_metadata or None)
 
                 if not payment:
                     existing = await conn.fetchval(
@@ -499,6 +579,22 @@ async def process_successful_payment(payment_id: str, yookassa_metadata: Optiona
 
                 logging.info(f"Payment status updated: {payment_id} -> succeeded")
 
+                # Событие уходит подписчикам (LISTEN) только при коммите транзакции
+                from main import payment_events
+                await payment_events.notify_payment_succeeded(conn, payment_id, user_id, package_id)
+
+                if notify:
+                    await outbox.add_event(conn, 'payment_succeeded', user_id, {
+                        'payment_id': payment_id,
+                        'package_id': package_id,
+                        'email': payment['email'] or ((yookassa_metadata or {}).get('metadata') or {}).get('email'),
+                    })
+                    # Отдельное событие: неотправленный хит повторяется, не дублируя уведомление
+                    await outbox.add_event(conn, 'metrika_goal', user_id, {
+                        'goal': 'purchase',
+                        'event_time': datetime.now().timestamp(),
+                    }, dedupe_key=f"metrika_goal:purchase:{payment_id}")
+
                 # Личная консультация с тарологом: баланс не начисляется,
                 # услуга оказывается вручную (пользователь пишет тарологу в MAX).
                 if package_id in ('consult_basic', 'consult_detailed'):
@@ -572,7 +668,7 @@ async def get_payment_by_id(payment_id: str) -> Optional[Dict[str, Any]]:
                 'amount_rub': result['amount_rub'],
                 'status': result['status'],
                 'email': result['email'],
-                'yookassa_metadata': json.loads(result['yookassa_metadata']) if result['yookassa_metadata'] else None,
+                'yookassa_metadata': result['yookassa_metadata'],
                 'created_at': result['created_at'],
                 'updated_at': result['updated_at'],
                 'completed_at': result['completed_at']
@@ -607,20 +703,40 @@ async def get_latest_pending_payment(user_id: int) -> Optional[Dict[str, Any]]:
         return None
 
 
-async def get_stale_pending_payments(minutes: int = 15) -> List[Dict[str, Any]]:
-    """Получить все pending-платежи старше N минут для сверки с ЮKassa"""
+async def get_stale_pending_payments(
+    minutes: int = 15,
+    after: Optional[tuple] = None,
+    limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    Получить pending-платежи старше N минут для сверки с ЮKassa.
+    Постранично: after — курсор (created_at, id) последней строки предыдущей страницы,
+    limit — размер страницы (None — все сразу).
+    """
     try:
         payments_table = get_table_name("payments")
+        args: List[Any] = [int(minutes)]
+        cursor_clause = ""
+        if after is not None:
+            args.extend(after)
+            cursor_clause = "AND (created_at, id) > ($2, $3)"
+        limit_clause = ""
+        if limit is not None:
+            args.append(int(limit))
+            limit_clause = f"LIMIT ${len(args)}"
         query = f"""
-            SELECT payment_id, user_id, package_id, amount_rub, email, created_at
+            SELECT id, payment_id, user_id, package_id, amount_rub, email, created_at
             FROM {payments_table}
             WHERE status = 'pending'
-              AND created_at < NOW() - INTERVAL '{int(minutes)} minutes'
-            ORDER BY created_at ASC
+              AND created_at < NOW() - make_interval(mins => $1)
+              {cursor_clause}
+            ORDER BY created_at ASC, id ASC
+            {limit_clause}
         """
-        results = await Database.fetch_all(query)
+        results = await Database.fetch_all(query, *args)
         return [
             {
+                'id': r['id'],
                 'payment_id': r['payment_id'],
                 'user_id': r['user_id'],
                 'package_id': r['package_id'],
@@ -635,6 +751,29 @@ async def get_stale_pending_payments(minutes: int = 15) -> List[Dict[str, Any]]:
         return []
 
 
+async def count_stale_pending_payments(minutes: int = 15, after: Optional[tuple] = None) -> Dict[str, Any]:
+    """Сколько stale pending-платежей осталось (после курсора) и когда создан самый старый из них."""
+    try:
+        payments_table = get_table_name("payments")
+        args: List[Any] = [int(minutes)]
+        cursor_clause = ""
+        if after is not None:
+            args.extend(after)
+            cursor_clause = "AND (created_at, id) > ($2, $3)"
+        query = f"""
+            SELECT COUNT(*) AS cnt, MIN(created_at) AS oldest
+            FROM {payments_table}
+            WHERE status = 'pending'
+              AND created_at < NOW() - make_interval(mins => $1)
+              {cursor_clause}
+        """
+        row = await Database.fetch_one(query, *args)
+        return {'count': row['cnt'], 'oldest': row['oldest']}
+    except Exception as e:
+        logging.error(f"Error counting stale pending payments: {e}", exc_info=True)
+        return {'count': 0, 'oldest': None}
+
+
 PAYMENT_REMINDER_STAGES = {
     '10m': (10, 'reminder_10m_sent_at'),
     '1h': (60, 'reminder_1h_sent_at'),
@@ -642,14 +781,14 @@ PAYMENT_REMINDER_STAGES = {
 }
 
 
-async def get_payments_due_for_reminder(stage: str) -> List[Dict[str, Any]]:
+async def get_payment_reminder_candidate(payment_id: str, stage: str) -> Optional[Dict[str, Any]]:
     """
-    Платежи, которым пора отправить напоминание об оплате.
+    Платёж, если ему всё ещё нужно напоминание этапа stage (иначе None).
+    Вызывается из отложенной задачи payment_reminder (main/payment_reminders.py).
 
     Условия:
     - status in (pending, canceled)
     - пользователь не заблокирован
-    - прошло >= N минут с created_at
     - напоминание этого этапа ещё не отправлялось
     - нет «связанной» успешной оплаты:
       * оплатил (любой пакет) в любой момент после начала этой попытки — рассылка прекращается,
@@ -658,7 +797,7 @@ async def get_payments_due_for_reminder(stage: str) -> List[Dict[str, Any]]:
     if stage not in PAYMENT_REMINDER_STAGES:
         raise ValueError(f"Unknown reminder stage: {stage}")
 
-    minutes, sent_column = PAYMENT_REMINDER_STAGES[stage]
+    _, sent_column = PAYMENT_REMINDER_STAGES[stage]
     payments_table = get_table_name("payments")
     users_table = get_table_name("users")
 
@@ -667,10 +806,10 @@ async def get_payments_due_for_reminder(stage: str) -> List[Dict[str, Any]]:
             SELECT p.payment_id, p.user_id, p.package_id, p.status, p.created_at
             FROM {payments_table} p
             INNER JOIN {users_table} u ON u.user_id = p.user_id
-            WHERE p.status IN ('pending', 'canceled')
+            WHERE p.payment_id = $1
+              AND p.status IN ('pending', 'canceled')
               AND u.is_blocked = FALSE
               AND p.{sent_column} IS NULL
-              AND p.created_at <= NOW() - INTERVAL '{int(minutes)} minutes'
               AND NOT EXISTS (
                   SELECT 1
                   FROM {payments_table} s
@@ -685,26 +824,28 @@ async def get_payments_due_for_reminder(stage: str) -> List[Dict[str, Any]]:
                         )
                     )
               )
-            ORDER BY p.created_at ASC
         """
-        results = await Database.fetch_all(query)
-        return [
-            {
-                'payment_id': r['payment_id'],
-                'user_id': r['user_id'],
-                'package_id': r['package_id'],
-                'status': r['status'],
-                'created_at': r['created_at'],
-            }
-            for r in results
-        ]
+        r = await Database.fetch_one(query, payment_id)
+        if not r:
+            return None
+        return {
+            'payment_id': r['payment_id'],
+            'user_id': r['user_id'],
+            'package_id': r['package_id'],
+            'status': r['status'],
+            'created_at': r['created_at'],
+        }
     except Exception as e:
-        logging.error(f"Error getting payments due for reminder ({stage}): {e}", exc_info=True)
-        return []
+        logging.error(f"Error checking payment reminder ({payment_id}, {stage}): {e}", exc_info=True)
+        raise
 
 
-async def mark_payment_reminder_sent(payment_id: str, stage: str) -> bool:
-    """Отметить, что напоминание об оплате на данном этапе отправлено."""
+async def mark_payment_reminder_sent(payment_id: str, stage: str, conn=None) -> bool:
+    """
+    Отметить, что напоминание об оплате на данном этапе отправлено.
+    True — пометка поставлена сейчас (False — уже стояла или ошибка).
+    conn — выполнить в транзакции вызывающего (вместе с записью сообщения в outbox).
+    """
     if stage not in PAYMENT_REMINDER_STAGES:
         raise ValueError(f"Unknown reminder stage: {stage}")
 
@@ -719,11 +860,18 @@ async def mark_payment_reminder_sent(payment_id: str, stage: str) -> bool:
             WHERE payment_id = $1
               AND {sent_column} IS NULL
         """
-        await Database.execute_query(query, payment_id)
-        logging.info(f"Payment reminder marked sent: {payment_id} stage={stage}")
-        return True
+        if conn is not None:
+            result = await conn.execute(query, payment_id)
+        else:
+            result = await Database.execute_query(query, payment_id)
+        marked = result == "UPDATE 1"
+        if marked:
+            logging.info(f"Payment reminder marked sent: {payment_id} stage={stage}")
+        return marked
     except Exception as e:
         logging.error(f"Error marking payment reminder sent ({payment_id}, {stage}): {e}", exc_info=True)
+        if conn is not None:
+            raise
         return False
 
 
@@ -941,10 +1089,11 @@ async def get_users_for_div_reminder_broadcast() -> List[Dict[str, Any]]:
 ACTIVATION_DELAY_HOURS = 24
 
 
-async def get_users_for_activation_broadcast() -> List[Dict[str, Any]]:
+async def get_activation_candidate(user_id: int) -> Optional[Dict[str, Any]]:
     """
-    Пользователи для welcome-активации: зарегистрировались ≥24ч назад,
-    ни разу не гадали, активация ещё не отправлялась.
+    Пользователь, если ему всё ещё нужна welcome-активация (иначе None):
+    ни разу не гадал, активация ещё не отправлялась, нет открытой оплаты.
+    Вызывается из отложенной задачи activation (main/activation.py).
     """
     users_table = get_table_name("users")
     payments_table = get_table_name("payments")
@@ -957,9 +1106,9 @@ async def get_users_for_activation_broadcast() -> List[Dict[str, Any]]:
                 u.last_active_at,
                 u.created_at
             FROM {users_table} u
-            WHERE u.is_blocked = FALSE
+            WHERE u.user_id = $1
+              AND u.is_blocked = FALSE
               AND u.activation_sent_at IS NULL
-              AND u.created_at <= NOW() - INTERVAL '{ACTIVATION_DELAY_HOURS} hours'
               AND NOT EXISTS (
                   SELECT 1 FROM {divinations_table} d WHERE d.user_id = u.user_id
               )
@@ -981,51 +1130,67 @@ async def get_users_for_activation_broadcast() -> List[Dict[str, Any]]:
                           )
                     )
               )
-            ORDER BY u.user_id
         """
-        results = await Database.fetch_all(query)
-        return [
-            {
-                'user_id': r['user_id'],
-                'last_active_at': r['last_active_at'],
-                'created_at': r['created_at'],
-            }
-            for r in results
-        ]
+        r = await Database.fetch_one(query, user_id)
+        if not r:
+            return None
+        return {
+            'user_id': r['user_id'],
+            'last_active_at': r['last_active_at'],
+            'created_at': r['created_at'],
+        }
     except Exception as e:
-        logging.error(f"Error getting users for activation broadcast: {e}", exc_info=True)
-        return []
+        logging.error(f"Error checking activation for user {user_id}: {e}", exc_info=True)
+        raise
 
 
-async def mark_activation_sent(user_id: int) -> bool:
-    """Отметить, что welcome-активация отправлена."""
+async def mark_activation_sent(user_id: int, conn=None) -> bool:
+    """
+    Отметить, что welcome-активация отправлена.
+    True — пометка поставлена сейчас (False — уже стояла или ошибка).
+    conn — выполнить в транзакции вызывающего (вместе с записью сообщения в outbox).
+    """
     try:
         users_table = get_table_name("users")
         query = f"""
             UPDATE {users_table}
             SET activation_sent_at = NOW()
             WHERE user_id = $1
+              AND activation_sent_at IS NULL
         """
-        await Database.execute_query(query, user_id)
-        return True
+        if conn is not None:
+            result = await conn.execute(query, user_id)
+        else:
+            result = await Database.execute_query(query, user_id)
+        return result == "UPDATE 1"
     except Exception as e:
         logging.error(f"Error marking activation sent for user {user_id}: {e}", exc_info=True)
+        if conn is not None:
+            raise
         return False
 
 
-async def mark_div_reminder_broadcast_sent(user_id: int) -> bool:
-    """Отметить отправку Пн/Чт рассылки."""
+async def mark_div_reminder_broadcast_sent(user_ids: List[int], conn=None) -> bool:
+    """
+    Отметить отправку Пн/Чт рассылки (пачкой).
+    conn — выполнить в транзакции вызывающего (вместе с записью сообщений в outbox).
+    """
     try:
         users_table = get_table_name("users")
         query = f"""
             UPDATE {users_table}
             SET last_div_reminder_broadcast_at = NOW()
-            WHERE user_id = $1
+            WHERE user_id = ANY($1::bigint[])
         """
-        await Database.execute_query(query, user_id)
+        if conn is not None:
+            await conn.execute(query, list(user_ids))
+        else:
+            await Database.execute_query(query, list(user_ids))
         return True
     except Exception as e:
-        logging.error(f"Error marking div reminder broadcast sent for user {user_id}: {e}", exc_info=True)
+        logging.error(f"Error marking div reminder broadcast sent for {len(user_ids)} user(s): {e}", exc_info=True)
+        if conn is not None:
+            raise
         return False
 
 
@@ -1061,6 +1226,54 @@ async def get_paid_users() -> List[Dict[str, Any]]:
         return []
 
 
+BROADCAST_AUDIENCE_ALL = 'all'
+BROADCAST_AUDIENCE_PAID = 'paid'
+
+
+async def get_broadcast_recipients_page(
+    audience: str,
+    after_user_id: int,
+    limit: int,
+    upto_user_id: Optional[int] = None,
+    conn=None,
+) -> List[int]:
+    """
+    Страница получателей рассылки по ключу (keyset): user_id > after_user_id
+    (и <= upto_user_id), по возрастанию user_id, не больше limit.
+
+    audience: 'all' — все незаблокированные; 'paid' — незаблокированные с успешным платежом.
+    Ошибки БД пробрасываются (пустая страница означает конец рассылки).
+    """
+    users_table = get_table_name("users")
+    payments_table = get_table_name("payments")
+    if audience == BROADCAST_AUDIENCE_ALL:
+        condition = ""
+    elif audience == BROADCAST_AUDIENCE_PAID:
+        condition = f"""
+              AND EXISTS (
+                  SELECT 1 FROM {payments_table} p
+                  WHERE p.user_id = u.user_id AND p.status = 'succeeded'
+              )"""
+    else:
+        raise ValueError(f"Unknown broadcast audience: {audience}")
+
+    query = f"""
+        SELECT u.user_id
+        FROM {users_table} u
+        WHERE u.is_blocked = FALSE
+          AND u.user_id > $1
+          AND ($3::bigint IS NULL OR u.user_id <= $3){condition}
+        ORDER BY u.user_id
+        LIMIT $2
+    """
+    args = (after_user_id, limit, upto_user_id)
+    if conn is not None:
+        rows = await conn.fetch(query, *args)
+    else:
+        rows = await Database.fetch_all(query, *args)
+    return [r['user_id'] for r in rows]
+
+
 def is_send_blocked_error(exc: Exception) -> bool:
     """
     Проверить, означает ли исключение при отправке сообщения,
@@ -1266,7 +1479,6 @@ async def save_webapp_follow_up_context(
     table = get_table_name("webapp_follow_up_context")
     try:
         await ensure_webapp_follow_up_context_table()
-        history_json = json.dumps(conversation_history, ensure_ascii=False)
         query = f"""
             INSERT INTO {table} (user_id, divination_id, conversation_history, follow_up_count, is_free, original_interpretation, created_at)
             VALUES ($1, $2, $3::jsonb, 0, $4, $5, NOW())
@@ -1274,13 +1486,32 @@ async def save_webapp_follow_up_context(
                 divination_id = $2, conversation_history = $3::jsonb, follow_up_count = 0, is_free = $4,
                 original_interpretation = $5, created_at = NOW()
         """
-        await Database.execute_query(query, user_id, divination_id, history_json, is_free, original_interpretation)
+        await Database.execute_query(query, user_id, divination_id, conversation_history, is_free, original_interpretation)
         return True
     except Exception as e:
         logging.error(f"Error saving webapp follow-up context for user {user_id}: {e}", exc_info=True)
         return False
 
 
+async def replace_webapp_follow_up_interpretation(user_id: int, divination_id: int, interpretation: str) -> bool:
+    """Заменить толкование в контексте уточняющих вопросов WebApp-гадания (если контекст ещё не забран)"""
+    table = get_table_name("webapp_follow_up_context")
+    try:
+        await ensure_webapp_follow_up_context_table()
+        query = f"""
+            UPDATE {table}
+            SET conversation_history = jsonb_set(conversation_history, '{{1,content}}', to_jsonb($3::text)),
+                original_interpretation = $3
+            WHERE user_id = $1 AND divination_id = $2
+            RETURNING user_id
+        """
+        result = await Database.fetch_one(query, user_id, divination_id, interpretation)
+        return result is not None
+    except Exception as e:
+        logging.error(f"Error updating webapp follow-up context for user {user_id}: {e}", exc_info=True)
+        return False
+
+
 async def get_and_delete_webapp_follow_up_context(user_id: int) -> Optional[Dict[str, Any]]:
     """
     Получить контекст уточняющих вопросов после WebApp-гадания и удалить запись.
@@ -1298,7 +1529,7 @@ async def get_and_delete_webapp_follow_up_context(user_id: int) -> Optional[Dict
             return None
         return {
             "divination_id": row["divination_id"],
-            "conversation_history": row["conversation_history"] if isinstance(row["conversation_history"], list) else json.loads(row["conversation_history"]),
+            "conversation_history": row["conversation_history"],
             "follow_up_count": row["follow_up_count"],
             "is_free_divination": row["is_free"],
             "original_interpretation": row["original_interpretation"],
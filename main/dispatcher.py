@@ -0,0 +1,217 @@
+"""
+Диспетчер апдейтов Max: последовательно для одного пользователя, параллельно для разных.
+
+aiomax.Bot.handle_update запускает обработчики через голый asyncio.create_task:
+два быстрых нажатия «confirm_cards» запускают два расклада одновременно, а
+ограничения на общее число обработчиков нет. Диспетчер встаёт перед роутерами
+(bot.update_sink, main/botdef.py):
+
+- у каждого пользователя своя очередь апдейтов; следующий апдейт пользователя
+  начинается, только когда завершились все обработчики предыдущего;
+- апдейты разных пользователей обрабатываются параллельно: UPDATE_WORKERS
+  ограничивает только разбор апдейта и запуск обработчиков, сами обработчики
+  общий слот не держат — долгий расклад одного пользователя не задерживает
+  /start другого (запросы к LLM ограничивает LLMGovernor, main/llm.py);
+- повтор того же callback (та же кнопка того же сообщения), пока предыдущий
+  ещё в очереди или выполняется, отбрасывается;
+- обработчик дольше UPDATE_HANDLER_TIMEOUT_SEC не блокирует очередь
+  пользователя навсегда: ждать перестаём (обработчик не отменяется).
+
+Какие задачи относятся к апдейту: их возвращает bot.dispatch_update —
+обработчики роутеров, запущенные aiomax. Задачи, которые запускают сами
+обработчики (supervisor.spawn и т.п.), в их число не входят и очередь не держат.
+
+    from main.dispatcher import dispatcher
+    dispatcher.install(bot)   # до bot.start_polling()
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from main import metrics
+from main.config_reader import config
+
+# Сколько ждать обработчики одного апдейта, прежде чем перейти к следующему апдейту пользователя
+UPDATE_HANDLER_TIMEOUT_SEC = 180
+# Максимум апдейтов в очереди одного пользователя (сверх — отбрасываются)
+UPDATE_QUEUE_PER_USER = 20
+
+def update_user_id(update: dict) -> Optional[int]:
+    """user_id отправителя апдейта (None — апдейт не привязан к пользователю)."""
+    update_type = update.get("update_type")
+    try:
+        if update_type in ("message_created", "message_edited"):
+            return update["message"]["sender"]["user_id"]
+        if update_type == "message_callback":
+            return update["callback"]["user"]["user_id"]
+        user = update.get("user")
+        if isinstance(user, dict):
+            return user.get("user_id")
+        return update.get("user_id")
+    except (KeyError, TypeError):
+        return None
+
+
+def _callback_key(update: dict) -> Optional[Tuple[Any, Any]]:
+    """Ключ повторного нажатия: (payload кнопки, id сообщения с клавиатурой)."""
+    if update.get("update_type") != "message_callback":
+        return None
+    callback = update.get("callback") or {}
+    message_id = ((update.get("message") or {}).get("body") or {}).get("mid")
+    return callback.get("payload"), message_id
+
+
+class UpdateDispatcher:
+    """Очереди апдейтов по пользователям с общим лимитом параллельных обработчиков."""
+
+    def __init__(self, max_workers: int, max_queue_per_user: int = UPDATE_QUEUE_PER_USER,
+                 handler_timeout: float = UPDATE_HANDLER_TIMEOUT_SEC):
+        self.max_workers = max(1, max_workers)
+        self.max_queue_per_user = max_queue_per_user
+        self.handler_timeout = handler_timeout
+        self._dispatch: Optional[Callable[[dict], Awaitable[List[asyncio.Task]]]] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._queues: Dict[int, Deque[Tuple[dict, float]]] = {}
+        # Ключи callback в очереди или в работе: user_id -> {key}
+        self._pending_callbacks: Dict[int, Set[Tuple[Any, Any]]] = {}
+        self._workers: Set[asyncio.Task] = set()
+        self.running = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped_duplicate = 0
+        self.dropped_overflow = 0
+        self.timed_out = 0
+        self.max_depth_seen = 0
+        self.dequeued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def install(self, bot) -> None:
+        """Встать перед роутерами bot (main.botdef.MaxBot): start_polling и вебхук будут вызывать диспетчер."""
+        if self._dispatch is not None:
+            return
+        self._dispatch = bot.dispatch_update
+        bot.update_sink = self.submit
+        logging.info(f"Update dispatcher installed: {self.max_workers} worker(s)")
+
+    def _ensure_loop(self) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+
+    async def submit(self, update: dict) -> None:
+        """Принять апдейт (вызывается из цикла polling, не ждёт обработки)."""
+        self._ensure_loop()
+        user_id = update_user_id(update)
+        if user_id is None:
+            # Служебные апдейты без пользователя — как раньше, без очереди
+            await self._dispatch(update)
+            return
+
+        key = _callback_key(update)
+        if key is not None:
+            pending = self._pending_callbacks.setdefault(user_id, set())
+            if key in pending:
+                self.dropped_duplicate += 1
+                logging.info(f"Dispatcher: duplicate callback {key[0]!r} from user {user_id} dropped")
+                return
+            pending.add(key)
+
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            worker = asyncio.get_running_loop().create_task(
+                self._drain_user(user_id, queue), name=f"updates:{user_id}"
+            )
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+        elif len(queue) >= self.max_queue_per_user:
+            self.dropped_overflow += 1
+            if key is not None:
+                self._pending_callbacks[user_id].discard(key)
+            logging.warning(f"Dispatcher: queue of user {user_id} is full, update dropped")
+            return
+        queue.append((update, time.monotonic()))
+        self.max_depth_seen = max(self.max_depth_seen, len(queue))
+
+    async def _drain_user(self, user_id: int, queue: Deque[Tuple[dict, float]]) -> None:
+        try:
+            while queue:
+                update, queued_at = queue[0]
+                try:
+                    await self._process(update, queued_at)
+                finally:
+                    queue.popleft()
+                    key = _callback_key(update)
+                    if key is not None:
+                        self._pending_callbacks.get(user_id, set()).discard(key)
+        finally:
+            self._queues.pop(user_id, None)
+            self._pending_callbacks.pop(user_id, None)
+
+    async def _process(self, update: dict, queued_at: float) -> None:
+        """Разобрать апдейт под общим слотом и дождаться его обработчиков уже без слота."""
+        self.running += 1
+        try:
+            async with self._semaphore:
+                wait = time.monotonic() - queued_at
+                self.dequeued += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                tasks = await self._dispatch(update)
+            if not tasks:
+                return
+            done, pending = await asyncio.wait(tasks, timeout=self.handler_timeout)
+            if pending:
+                self.timed_out += 1
+                logging.warning(
+                    f"Dispatcher: {update.get('update_type')} from user {update_user_id(update)} "
+                    f"still running after {self.handler_timeout}s, moving on"
+                )
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    self.failed += 1
+                    logging.error(
+                        f"Handler for {update.get('update_type')} failed: {task.exception()}",
+                        exc_info=task.exception(),
+                    )
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Dispatcher: error handling {update.get('update_type')}: {e}", exc_info=True)
+        finally:
+            self.running -= 1
+            self.processed += 1
+
+    async def drain(self, timeout: float = 30.0) -> None:
+        """Дождаться обработки принятых апдейтов (при остановке), остальное отменить."""
+        if not self._workers:
+            return
+        done, pending = await asyncio.wait(set(self._workers), timeout=timeout)
+        if pending:
+            logging.warning(f"Dispatcher: cancelling {len(pending)} user queue(s) after {timeout}s")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        depths = [len(q) for q in self._queues.values()]
+        return {
+            "max_workers": self.max_workers,
+            "running": self.running,
+            "active_users": len(depths),
+            "queued": sum(depths),
+            "max_user_depth": max(depths, default=0),
+            "max_user_depth_seen": self.max_depth_seen,
+            "processed": self.processed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "dropped_duplicate": self.dropped_duplicate,
+            "dropped_overflow": self.dropped_overflow,
+            "avg_wait_sec": round(self.total_wait / self.dequeued, 3) if self.dequeued else 0.0,
+            "max_wait_sec": round(self.max_wait, 3),
+        }
+
+
+dispatcher = UpdateDispatcher(config.update_workers)
+metrics.register("dispatcher", dispatcher.stats)
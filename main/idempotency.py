@@ -0,0 +1,161 @@
+"""
+Идемпотентность входящих вебхуков (ЮKassa): повторная доставка одного и того же
+события отбрасывается, не доходя до блокирующего UPDATE платежа.
+
+Два уровня:
+  1. LRU-кэш в памяти с TTL — дубликаты, пришедшие в этот же процесс, отсекаются за O(1);
+  2. таблица processed_webhooks — переживает рестарт и общая для всех инстансов.
+
+Протокол: claim() → обработка → complete() (или release() при ошибке, чтобы
+провайдер мог повторить доставку). Запись в статусе 'processing' старше
+CLAIM_TIMEOUT_MIN считается брошенной (процесс упал) и может быть перехвачена.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from main import metrics
+from main.database import Database, get_table_name
+
+# Размер и время жизни кэша обработанных ключей в памяти
+CACHE_MAX_SIZE = 10000
+CACHE_TTL_SEC = 24 * 3600
+# Через сколько минут незавершённый claim можно перехватить
+CLAIM_TIMEOUT_MIN = 5
+# Сколько дней хранить записи в таблице
+RETENTION_DAYS = 30
+
+
+class _TTLCache:
+    """LRU с TTL: только факт «ключ обработан»."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, float]" = OrderedDict()
+
+    def __contains__(self, key: str) -> bool:
+        expires_at = self._data.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return False
+        self._data.move_to_end(key)
+        return True
+
+    def add(self, key: str) -> None:
+        self._data[key] = time.monotonic() + self.ttl
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_processed = _TTLCache(CACHE_MAX_SIZE, CACHE_TTL_SEC)
+
+
+async def ensure_processed_webhooks_table():
+    """Создать таблицу processed_webhooks если не существует"""
+    table = get_table_name("processed_webhooks")
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            event_key VARCHAR(255) PRIMARY KEY,
+            status VARCHAR(20) NOT NULL DEFAULT 'processing',
+            created_at TIMESTAMP DEFAULT NOW(),
+            completed_at TIMESTAMP NULL
+        )
+    """
+    try:
+        await Database.execute_query(query)
+    except Exception as e:
+        logging.error(f"Error creating processed_webhooks table: {e}", exc_info=True)
+
+
+_table_ready = False
+
+
+async def _ensure_table_once():
+    global _table_ready
+    if not _table_ready:
+        await ensure_processed_webhooks_table()
+        _table_ready = True
+
+
+async def claim(event_key: str) -> bool:
+    """
+    Занять событие для обработки.
+    True — обрабатываем; False — дубликат (уже обработано или обрабатывается сейчас).
+    При недоступности таблицы возвращает True: нижележащая обработка сама идемпотентна.
+    """
+    if event_key in _processed:
+        return False
+    table = get_table_name("processed_webhooks")
+    try:
+        await _ensure_table_once()
+        query = f"""
+            INSERT INTO {table} (event_key, status, created_at)
+            VALUES ($1, 'processing', NOW())
+            ON CONFLICT (event_key) DO UPDATE
+                SET status = 'processing', created_at = NOW()
+                WHERE {table}.status = 'processing'
+                  AND {table}.created_at < NOW() - make_interval(mins => $2)
+            RETURNING status
+        """
+        claimed = await Database.fetchval(query, event_key, CLAIM_TIMEOUT_MIN)
+        if claimed is None:
+            existing = await Database.fetchval(f"SELECT status FROM {table} WHERE event_key = $1", event_key)
+            if existing == 'done':
+                _processed.add(event_key)
+            return False
+        return True
+    except Exception as e:
+        logging.error(f"Idempotency claim failed for {event_key}: {e}", exc_info=True)
+        return True
+
+
+async def complete(event_key: str) -> None:
+    """Отметить событие обработанным."""
+    _processed.add(event_key)
+    table = get_table_name("processed_webhooks")
+    try:
+        await Database.execute_query(
+            f"""
+            INSERT INTO {table} (event_key, status, created_at, completed_at)
+            VALUES ($1, 'done', NOW(), NOW())
+            ON CONFLICT (event_key) DO UPDATE SET status = 'done', completed_at = NOW()
+            """,
+            event_key,
+        )
+    except Exception as e:
+        logging.error(f"Idempotency complete failed for {event_key}: {e}", exc_info=True)
+
+
+async def release(event_key: str) -> None:
+    """Снять claim после неудачной обработки — следующая доставка обработается заново."""
+    table = get_table_name("processed_webhooks")
+    try:
+        await Database.execute_query(
+            f"DELETE FROM {table} WHERE event_key = $1 AND status = 'processing'", event_key
+        )
+    except Exception as e:
+        logging.error(f"Idempotency release failed for {event_key}: {e}", exc_info=True)
+
+
+async def cleanup_processed_webhooks(days: int = RETENTION_DAYS) -> int:
+    """Удалить записи старше days дней. Возвращает число удалённых строк."""
+    table = get_table_name("processed_webhooks")
+    try:
+        await _ensure_table_once()
+        result = await Database.execute_query(
+            f"DELETE FROM {table} WHERE created_at < NOW() - make_interval(days => $1)", days
+        )
+        return int(result.split()[-1]) if result else 0
+    except Exception as e:
+        logging.error(f"Error cleaning up processed_webhooks: {e}", exc_info=True)
+        return 0
+
+
+metrics.register("idempotency", lambda: {"cached_keys": len(_processed)})
@@ -0,0 +1,195 @@
+"""
+Ограниченная очередь заданий с фиксированным числом воркеров.
+
+Используется для гаданий из WebApp: каждое задание — запрос к LLM и склейка картинок,
+поэтому при всплеске не запускаем всё сразу, а обрабатываем N заданий параллельно,
+остальные ждут в очереди. Переполнение очереди — отказ (вебхук отвечает 429),
+статус и позицию в очереди можно опрашивать по job_id.
+
+    jobs = JobQueue("webapp", workers=4, max_queued=100)
+    job = jobs.submit(user_id, _process_webapp_divination(...))
+    jobs.get(job.job_id).status  # queued / running / done / failed
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import Any, Coroutine, Dict, Optional
+
+from main import metrics
+
+# Сколько хранить статус завершённого задания для опроса из WebApp
+JOB_RESULT_TTL_SEC = 10 * 60
+
+
+class QueueFullError(Exception):
+    """Очередь заполнена — новое задание не принято."""
+
+
+class Job:
+    __slots__ = ("job_id", "user_id", "seq", "status", "created_at", "started_at", "finished_at", "coro")
+
+    def __init__(self, user_id: int, seq: int, coro: Coroutine):
+        self.job_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.seq = seq
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.coro: Optional[Coroutine] = coro
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+
+class JobQueue:
+    """FIFO-очередь заданий с воркерами, статусами и метриками."""
+
+    def __init__(self, name: str, workers: int, max_queued: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued = 0
+        self._jobs: Dict[str, Job] = {}
+        self._active_by_user: Dict[int, str] = {}
+        self._worker_tasks = []
+        self._seq = 0
+        self._started_seq = 0
+        self._closing = False
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.total_duration = 0.0
+        metrics.register(f"jobs_{name}", self.stats)
+
+    def _ensure_workers(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._worker_tasks = [t for t in self._worker_tasks if not t.done()]
+        loop = asyncio.get_running_loop()
+        while len(self._worker_tasks) < self.workers:
+            idx = len(self._worker_tasks)
+            self._worker_tasks.append(loop.create_task(self._worker(), name=f"{self.name}-worker-{idx}"))
+
+    def position(self, job: Job) -> int:
+        """Позиция в очереди (1 — следующий), 0 — уже выполняется/завершено."""
+        if job.status != "queued":
+            return 0
+        return job.seq - self._started_seq
+
+    def active_job(self, user_id: int) -> Optional[Job]:
+        """Активное (queued/running) задание пользователя, если есть."""
+        job = self._jobs.get(self._active_by_user.get(user_id, ""))
+        return job if job is not None and job.active else None
+
+    def submit(self, user_id: int, coro: Coroutine) -> Job:
+        """
+        Поставить задание в очередь. Если у пользователя уже есть активное задание —
+        возвращается оно, а coro закрывается (повторное нажатие не ставит второе задание;
+        то, что резервирует coro, вызывающий проверяет через active_job до резерва).
+        При переполнении — QueueFullError.
+        """
+        self._prune()
+        active = self.active_job(user_id)
+        if active is not None:
+            coro.close()
+            return active
+        if self._closing or self._queued >= self.max_queued:
+            self.rejected += 1
+            coro.close()
+            raise QueueFullError(f"{self.name} queue is full ({self._queued})")
+
+        self._ensure_workers()
+        self._seq += 1
+        job = Job(user_id, self._seq, coro)
+        self._jobs[job.job_id] = job
+        self._active_by_user[user_id] = job.job_id
+        self._queued += 1
+        self._queue.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            if job is None:  # сигнал остановки (ставится в конец очереди в stop())
+                return
+            self._queued -= 1
+            self._started_seq = job.seq
+            job.status = "running"
+            job.started_at = time.time()
+            self.total_wait += job.started_at - job.created_at
+            self.running += 1
+            coro, job.coro = job.coro, None
+            try:
+                result = await coro
+                job.status = "failed" if result is False else "done"
+            except asyncio.CancelledError:
+                job.status = "failed"
+                raise
+            except Exception as e:
+                job.status = "failed"
+                logging.error(f"Job {self.name}/{job.job_id} for user {job.user_id} failed: {e}", exc_info=True)
+            finally:
+                job.finished_at = time.time()
+                self.total_duration += job.finished_at - job.started_at
+                self.running -= 1
+                if job.status == "done":
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def _prune(self) -> None:
+        """Удалить статусы давно завершённых заданий."""
+        cutoff = time.time() - JOB_RESULT_TTL_SEC
+        stale = [jid for jid, j in self._jobs.items() if not j.active and j.finished_at and j.finished_at < cutoff]
+        for jid in stale:
+            job = self._jobs.pop(jid)
+            if self._active_by_user.get(job.user_id) == jid:
+                del self._active_by_user[job.user_id]
+
+    async def stop(self, timeout: float = 60.0) -> None:
+        """Не принимать новые задания, доделать очередь (не дольше timeout), воркеры остановить."""
+        self._closing = True
+        if not self._worker_tasks:
+            return
+        for _ in self._worker_tasks:
+            self._queue.put_nowait(None)
+        done, pending = await asyncio.wait(self._worker_tasks, timeout=timeout)
+        if pending:
+            logging.warning(
+                f"Job queue {self.name}: {self._queued} queued job(s) dropped, "
+                f"cancelling {len(pending)} worker(s) after {timeout}s"
+            )
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        while not self._queue.empty():
+            job = self._queue.get_nowait()
+            if job is not None and job.coro is not None:
+                job.coro.close()
+                job.status = "failed"
+        self._queued = 0
+        self._worker_tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        started = self.completed + self.failed + self.running
+        finished = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "max_queued": self.max_queued,
+            "queued": self._queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_sec": round(self.total_wait / started, 3) if started else 0.0,
+            "avg_duration_sec": round(self.total_duration / finished, 3) if finished else 0.0,
+        }
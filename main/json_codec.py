@@ -0,0 +1,54 @@
+"""
+Быстрый JSON для горячих путей: jsonb/json-кодеки asyncpg, webhook ЮKassa, конверсии.
+
+Если установлен orjson — используем его (в разы быстрее на dumps/loads),
+иначе — стандартный json. Снаружи интерфейс одинаковый: dumps() -> str, loads(str|bytes).
+"""
+import json
+from decimal import Decimal
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson — опциональная зависимость
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    """Сериализация типов, которых нет в JSON (Decimal из БД, datetime и т.д.)."""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return str(obj)
+
+
+def dumps(obj: Any) -> str:
+    """Сериализовать объект в JSON-строку (UTF-8, без экранирования кириллицы)."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, ensure_ascii=False, default=_default)
+
+
+def loads(data: "str | bytes") -> Any:
+    """Разобрать JSON из str или bytes. Ошибки — json.JSONDecodeError (orjson наследует его)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class LazyJson:
+    """
+    Отложенная сериализация для логов: JSON строится только если запись
+    реально попадёт в лог (logging вызывает str() лениво при %-форматировании).
+
+        logging.debug("Webhook data: %s", LazyJson(data))
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        if orjson is not None:
+            return orjson.dumps(self.obj, default=_default, option=orjson.OPT_INDENT_2).decode()
+        return json.dumps(self.obj, ensure_ascii=False, indent=2, default=_default)
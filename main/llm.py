@@ -0,0 +1,425 @@
+"""
+Запросы к LLM через «регулятор»: общий лимит одновременных запросов,
+приоритетные полосы, таймауты, повторы, выбор провайдера и автомат отключения.
+
+Без регулятора каждый обработчик сам открывал сессию и ждал DeepSeek сколько
+угодно: когда API тормозит, на event loop копятся сотни зависших запросов.
+Теперь:
+
+- не больше LLM_MAX_IN_FLIGHT запросов одновременно на процесс; остальные ждут
+  в очереди по полосам — LANE_PAID (платные и безлимит) раньше LANE_FREE
+  (бесплатные), а LANE_BACKGROUND (распознавание карт, фоновые задачи) — последними;
+  дольше LLM_QUEUE_TIMEOUT_SEC в очереди — LLMUnavailable;
+- у каждой попытки таймаут LLM_TIMEOUT_SEC; 5xx, 429, таймауты и сетевые
+  ошибки повторяются (LLM_MAX_ATTEMPTS, экспоненциальная пауза с jitter,
+  для 429 — не меньше Retry-After); повтор уходит другому провайдеру, если он есть;
+- провайдер на каждую попытку выбирает реестр main/llm_providers.py (EWMA задержки
+  и ошибок, стоимость); у каждого провайдера свой автомат отключения, и когда
+  отключены все — запросы сразу получают LLMUnavailable;
+- толкования (hedge=True) страхуются вторым запросом, если первый не ответил
+  за LLM_HEDGE_AFTER_SEC (Hedger); страховочный запрос занимает своё место
+  регулятора и не отправляется, если свободного места нет.
+
+    from main import llm
+    text = await llm.chat(messages, system_prompt, lane=llm.LANE_PAID)
+
+Метрики — metrics "llm": ожидание и глубина очереди по полосам, запросы
+в работе, повторы, таймауты, переключения и здоровье провайдеров, страховочные запросы
+(выигрыши/проигрыши) и p50/p90/p99 задержки — по p90 настраивается порог.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+
+from main import metrics
+from main.config_reader import config
+from main.llm_providers import Provider, ProviderRegistry, load_providers
+
+# Полосы в порядке приоритета
+LANE_PAID = 'paid'
+LANE_FREE = 'free'
+LANE_BACKGROUND = 'background'
+LANES = (LANE_PAID, LANE_FREE, LANE_BACKGROUND)
+
+# Сколько ждать места в очереди регулятора
+LLM_QUEUE_TIMEOUT_SEC = 120
+# Повторы: попытки на запрос и пауза base * 2^n (с jitter, не больше max)
+LLM_MAX_ATTEMPTS = 3
+LLM_RETRY_BASE_SEC = 1.0
+LLM_RETRY_MAX_SEC = 10.0
+# Страховочные запросы: окно для доли запросов со страховкой; окно задержек для p50/p90/p99
+HEDGE_WINDOW = 200
+LATENCY_WINDOW = 500
+
+
+class LLMError(Exception):
+    """Ошибка запроса к LLM (status — HTTP-статус, если был ответ)."""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        self.status = status
+        self.retry_after = retry_after
+        super().__init__(message)
+
+    @property
+    def retryable(self) -> bool:
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class LLMUnavailable(LLMError):
+    """LLM сейчас недоступен: автомат разомкнут или очередь регулятора не дождалась места."""
+
+
+class _LaneStats:
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self, depth: int) -> Dict[str, Any]:
+        return {
+            "queued": depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_sec": round(self.total_wait / self.admitted, 3) if self.admitted else 0.0,
+            "max_wait_sec": round(self.max_wait, 3),
+        }
+
+
+class LLMGovernor:
+    """Лимит одновременных запросов с приоритетной очередью по полосам."""
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max(1, max_in_flight)
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, str, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._lanes = {lane: _LaneStats() for lane in LANES}
+        self.requests = 0
+        self.failed = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.short_circuited = 0
+
+    async def acquire(self, lane: str, timeout: float = LLM_QUEUE_TIMEOUT_SEC) -> None:
+        stats = self._lanes[lane]
+        started = time.monotonic()
+        if self.in_flight >= self.max_in_flight or self._waiters:
+            future = asyncio.get_running_loop().create_future()
+            entry = (LANES.index(lane), next(self._seq), lane, future)
+            heapq.heappush(self._waiters, entry)
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                stats.rejected += 1
+                raise LLMUnavailable(f"LLM queue timeout ({lane})")
+            except BaseException:
+                if future.done() and not future.cancelled():
+                    # Место уже выдали — передаём следующему
+                    self._release_slot()
+                raise
+            finally:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+        else:
+            self.in_flight += 1
+        wait = time.monotonic() - started
+        stats.admitted += 1
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+
+    def try_acquire(self) -> bool:
+        """Занять место без ожидания (для страховочного запроса); нет свободного — False."""
+        if self.in_flight >= self.max_in_flight or self._waiters:
+            return False
+        self.in_flight += 1
+        return True
+
+    def _release_slot(self) -> None:
+        while self._waiters:
+            _, _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # in_flight не меняется: место переходит ожидающему
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def release(self) -> None:
+        self._release_slot()
+
+    def stats(self) -> Dict[str, Any]:
+        depths = {lane: 0 for lane in LANES}
+        for _, _, lane, future in self._waiters:
+            if not future.done():
+                depths[lane] += 1
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queued": sum(depths.values()),
+            "lanes": {lane: self._lanes[lane].as_dict(depths[lane]) for lane in LANES},
+            "requests": self.requests,
+            "failed": self.failed,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "short_circuited": self.short_circuited,
+        }
+
+
+class Hedger:
+    """
+    Страховочный (hedged) запрос: если ответа нет дольше after_sec (порог ≈ p90
+    задержки), отправляется второй такой же запрос и берётся тот, что ответил
+    первым; второй отменяется. Доля запросов со страховкой среди последних
+    HEDGE_WINDOW ограничена max_ratio — расходы на токены растут не больше чем
+    на эту долю.
+    """
+
+    def __init__(self, after_sec: float, max_ratio: float):
+        self.after_sec = after_sec
+        self.max_ratio = max_ratio
+        self._recent: Deque[bool] = deque(maxlen=HEDGE_WINDOW)
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.fired = 0
+        self.wins = 0
+        self.losses = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.after_sec > 0 and self.max_ratio > 0
+
+    def _allowed(self) -> bool:
+        return sum(self._recent) < self.max_ratio * max(len(self._recent), 1 / self.max_ratio)
+
+    def observe(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    async def run(self, request: Callable[[], Awaitable[str]],
+                  hedge_request: Optional[Callable[[], Awaitable[str]]] = None,
+                  try_acquire: Optional[Callable[[], bool]] = None,
+                  release: Optional[Callable[[], None]] = None) -> str:
+        """
+        Выполнить request(), при задержке — со страховочным hedge_request() (по умолчанию — тем же).
+        try_acquire/release — отдельное место регулятора под страховочный запрос: нет места —
+        страховка не отправляется, место освобождается по завершении страховочной задачи.
+        """
+        primary = asyncio.ensure_future(request())
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.after_sec)
+            if done:
+                self._recent.append(False)
+                return primary.result()
+            if not self._allowed() or (try_acquire is not None and not try_acquire()):
+                self.skipped += 1
+                self._recent.append(False)
+                return await primary
+            self.fired += 1
+            self._recent.append(True)
+            hedge = asyncio.ensure_future((hedge_request or request)())
+            if release is not None:
+                # Колбэк, а не finally в корутине: задача может быть отменена до старта
+                hedge.add_done_callback(lambda _: release())
+            tasks.append(hedge)
+            logging.info(f"LLM hedge fired after {self.after_sec}s")
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.wins += 1
+                        else:
+                            self.losses += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+
+        def percentile(q: float) -> float:
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 3) if latencies else 0.0
+
+        return {
+            "after_sec": self.after_sec,
+            "max_ratio": self.max_ratio,
+            "fired": self.fired,
+            "wins": self.wins,
+            "losses": self.losses,
+            "skipped": self.skipped,
+            "latency_p50_sec": percentile(0.5),
+            "latency_p90_sec": percentile(0.9),
+            "latency_p99_sec": percentile(0.99),
+        }
+
+
+governor = LLMGovernor(config.llm_max_in_flight)
+hedger = Hedger(config.llm_hedge_after_sec, config.llm_hedge_max_ratio)
+registry = ProviderRegistry(load_providers())
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+    return _session
+
+
+async def close_session():
+    """Закрыть общую сессию (при остановке процесса)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _take_provider(prefer_not: Iterable[Provider] = ()) -> Provider:
+    """
+    Лучший провайдер, чей автомат пропускает запрос; prefer_not — по возможности
+    другой (после ошибки, для страховочного запроса).
+    """
+    blocked: List[Provider] = []
+    while True:
+        provider = registry.pick(exclude=[*prefer_not, *blocked])
+        if provider is None or provider in blocked:
+            raise LLMUnavailable("No LLM provider available (circuits open)")
+        if provider.breaker.allow():
+            return provider
+        blocked.append(provider)
+
+
+async def _request(provider: Provider, payload: Dict[str, Any], timeout: float) -> str:
+    """Одна попытка запроса к провайдеру."""
+    started = time.monotonic()
+    headers = {
+        "Authorization": f"Bearer {provider.api_key}",
+        "Content-Type": "application/json",
+    }
+    try:
+        async with _get_session().post(
+            provider.url, headers=headers, json={**payload, "model": provider.model},
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            if response.status == 200:
+                result = await response.json()
+                latency = time.monotonic() - started
+                hedger.observe(latency)
+                provider.record_success(latency, result.get("usage"))
+                return result["choices"][0]["message"]["content"]
+            error_text = await response.text()
+            retry_after = response.headers.get("Retry-After")
+            logging.error(f"LLM API error ({provider.name}): {response.status} - {error_text[:500]}")
+            error = LLMError(
+                f"Ошибка API: {response.status}",
+                status=response.status,
+                retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+            )
+    except asyncio.CancelledError:
+        # Отменён (проигравший страховочный запрос, остановка): итога нет,
+        # пробный запрос half-open автомата возвращаем
+        provider.breaker.abandon()
+        raise
+    except asyncio.TimeoutError:
+        governor.timeouts += 1
+        error = LLMError(f"{provider.name} timeout after {timeout}s")
+    except aiohttp.ClientError as e:
+        error = LLMError(f"{provider.name} connection error: {e}")
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        error = LLMError(f"{provider.name} malformed response: {e}", status=502)
+    provider.record_failure(error.retryable)
+    raise error
+
+
+def _retry_delay(attempt: int, error: LLMError) -> float:
+    delay = random.uniform(0, min(LLM_RETRY_MAX_SEC, LLM_RETRY_BASE_SEC * 2 ** attempt))
+    if error.retry_after:
+        delay = max(delay, min(error.retry_after, LLM_RETRY_MAX_SEC))
+    return delay
+
+
+async def chat(
+    messages: list,
+    system_prompt: str,
+    *,
+    lane: str = LANE_FREE,
+    max_tokens: int,
+    temperature: float,
+    timeout: Optional[float] = None,
+    hedge: bool = False,
+) -> str:
+    """
+    Запрос к LLM через регулятор. Возвращает текст ответа.
+    hedge — страховочный повтор при задержке (для толкований, см. Hedger).
+    LLMUnavailable — все провайдеры отключены автоматом или не дождались места в очереди;
+    LLMError — запрос не удался после всех попыток.
+    """
+    timeout = timeout or config.llm_timeout_sec
+    payload = {
+        "messages": [{"role": "system", "content": system_prompt}, *messages],
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
+
+    if registry.pick() is None:
+        governor.short_circuited += 1
+        raise LLMUnavailable("No LLM provider available (circuits open)")
+
+    await governor.acquire(lane)
+    governor.requests += 1
+    try:
+        failed_provider: Optional[Provider] = None
+        for attempt in range(LLM_MAX_ATTEMPTS):
+            try:
+                provider = _take_provider([failed_provider] if failed_provider else ())
+            except LLMUnavailable:
+                governor.short_circuited += 1
+                raise
+            if failed_provider is not None and provider is not failed_provider:
+                registry.failovers += 1
+                logging.warning(f"LLM failover: {failed_provider.name} -> {provider.name}")
+
+            async def _hedge_copy(primary: Provider = provider) -> str:
+                return await _request(_take_provider([primary]), payload, timeout)
+
+            try:
+                if hedge and hedger.enabled:
+                    text = await hedger.run(
+                        lambda: _request(provider, payload, timeout), _hedge_copy,
+                        try_acquire=governor.try_acquire, release=governor.release,
+                    )
+                else:
+                    text = await _request(provider, payload, timeout)
+            except LLMError as e:
+                if not e.retryable or attempt == LLM_MAX_ATTEMPTS - 1:
+                    governor.failed += 1
+                    raise
+                governor.retries += 1
+                failed_provider = provider
+                # Есть другой провайдер — переходим на него сразу, иначе пауза
+                alternative = registry.pick(exclude=[provider])
+                if alternative is None or alternative is provider:
+                    delay = _retry_delay(attempt, e)
+                    logging.warning(f"LLM request failed ({e}), retry {attempt + 1} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                continue
+            return text
+    finally:
+        governor.release()
+
+
+metrics.register("llm", lambda: {**governor.stats(), "hedge": hedger.stats(), **registry.stats()})
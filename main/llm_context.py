@@ -0,0 +1,126 @@
+"""
+Сжатие истории диалога для уточняющих вопросов по раскладу.
+
+Раньше каждое уточнение отправляло в LLM всю conversation_history — с длинным
+исходным толкованием и всеми прошлыми ответами; промпт и JSON в FSM /
+webapp_follow_up_context росли с каждым вопросом. compact_history() держит
+историю в бюджете токенов:
+
+    [0] user      — вопрос и выпавшие карты (факты расклада, не сжимаются)
+    [1] assistant — краткое содержание: выжимка толкования и старых уточнений
+                    (SUMMARY_PREFIX), пополняется по мере вытеснения реплик
+    ...           — последние KEEP_LAST_TURNS пар «вопрос — ответ» целиком
+
+Пока история укладывается в бюджет, она не меняется (исходное толкование
+остаётся целиком). Выжимка — первые предложения абзацев, без запросов к LLM.
+
+Токены считаются локально и приблизительно (count_tokens): слово — по
+CHARS_PER_TOKEN символов на токен, знак препинания — токен. Для бюджета этого
+достаточно, токенизатор провайдера не нужен.
+"""
+import math
+import re
+from typing import Dict, List
+
+from main import metrics
+
+# Приблизительно символов на токен в русском тексте
+CHARS_PER_TOKEN = 3.0
+# Служебные токены на сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Сколько последних пар «вопрос — ответ» оставлять целиком
+KEEP_LAST_TURNS = 2
+# Потолок краткого содержания
+SUMMARY_MAX_TOKENS = 400
+# Сколько предложений брать из абзаца толкования и из ответа на уточнение
+SUMMARY_SENTENCES_PER_PARAGRAPH = 1
+
+SUMMARY_PREFIX = "Краткое содержание расклада и беседы:"
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]")
+_TAG_RE = re.compile(r"<[^>]+>")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+_stats: Dict[str, int] = {'compactions': 0, 'tokens_before': 0, 'tokens_after': 0}
+
+
+def count_tokens(text: str) -> int:
+    """Приблизительное число токенов текста."""
+    return sum(max(1, math.ceil(len(word) / CHARS_PER_TOKEN)) for word in _WORD_RE.findall(text or ""))
+
+
+def count_messages_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(count_tokens(m.get("content", "")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def _first_sentences(text: str, count: int) -> str:
+    sentences = _SENTENCE_RE.split(text.strip())
+    return " ".join(sentences[:count])
+
+
+def summarize_text(text: str) -> str:
+    """Выжимка: первые предложения каждого абзаца (HTML-разметка убирается)."""
+    plain = _TAG_RE.sub("", text or "")
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", plain) if p.strip()]
+    return " ".join(_first_sentences(p.replace("\n", " "), SUMMARY_SENTENCES_PER_PARAGRAPH) for p in paragraphs)
+
+
+def _summary_lines(messages: List[Dict[str, str]]) -> List[str]:
+    """Строки краткого содержания для вытесняемых сообщений."""
+    lines = []
+    question = None
+    for message in messages:
+        content = message.get("content", "")
+        if message.get("role") == "user":
+            question = content
+            continue
+        if content.startswith(SUMMARY_PREFIX):
+            lines.extend(line for line in content[len(SUMMARY_PREFIX):].strip().split("\n") if line)
+        elif question is None:
+            lines.append(f"Толкование: {summarize_text(content)}")
+        else:
+            lines.append(f"Уточнение «{question}»: {summarize_text(content)}")
+        question = None
+    return lines
+
+
+def _build_summary(lines: List[str]) -> Dict[str, str]:
+    """Сообщение с кратким содержанием; не влезает в потолок — выпадают старые уточнения."""
+    lines = list(lines)
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > SUMMARY_MAX_TOKENS:
+        # Первая строка — толкование расклада, его держим дольше всего
+        del lines[1]
+    text = "\n".join(lines)
+    if count_tokens(text) > SUMMARY_MAX_TOKENS:
+        text = text[:int(SUMMARY_MAX_TOKENS * CHARS_PER_TOKEN)].rstrip() + "…"
+    return {"role": "assistant", "content": f"{SUMMARY_PREFIX}\n{text}"}
+
+
+def compact_history(history: List[Dict[str, str]], max_tokens: int) -> List[Dict[str, str]]:
+    """
+    История в пределах max_tokens: факты расклада + краткое содержание + последние реплики.
+    Укладывается в бюджет — возвращается как есть.
+    """
+    before = count_messages_tokens(history)
+    if before <= max_tokens or len(history) < 3:
+        return history
+
+    head, rest = history[0], history[1:]
+    # Последнее сообщение — текущий вопрос пользователя (ответа на него ещё нет)
+    pending = 1 if rest[-1].get("role") == "user" else 0
+    compacted = history
+    for turns in range(KEEP_LAST_TURNS, -1, -1):
+        split = max(0, len(rest) - turns * 2 - pending)
+        if split == 0:
+            continue
+        compacted = [head, _build_summary(_summary_lines(rest[:split])), *rest[split:]]
+        if count_messages_tokens(compacted) <= max_tokens:
+            break
+
+    _stats['compactions'] += 1
+    _stats['tokens_before'] += before
+    _stats['tokens_after'] += count_messages_tokens(compacted)
+    return compacted
+
+
+metrics.register("llm_context", lambda: dict(_stats))
@@ -0,0 +1,256 @@
+"""
+Реестр LLM-провайдеров (OpenAI-совместимые /chat/completions) и выбор лучшего
+на каждый запрос.
+
+Провайдеры задаются в LLM_PROVIDERS — JSON-список:
+
+    [{"name": "deepseek", "url": "https://api.deepseek.com/v1/chat/completions",
+      "model": "deepseek-v4-flash", "api_key": "sk-...", "cost_per_1m_tokens": 0.3},
+     {"name": "reserve", "url": "https://.../v1/chat/completions", "model": "...",
+      "api_key": "...", "cost_per_1m_tokens": 1.1}]
+
+Не задан — один провайдер DeepSeek с ключом API_KEY (как раньше).
+
+У каждого провайдера — своё здоровье: EWMA задержки и доли ошибок, токены и
+оценка стоимости, свой автомат отключения (CircuitBreaker). pick() берёт
+доступного провайдера с лучшей оценкой:
+
+    score = ewma_latency * (1 + ERROR_PENALTY * ewma_error_rate) + COST_WEIGHT * cost_per_1m_tokens
+
+Ещё не опрошенные провайдеры считаются с задержкой UNKNOWN_LATENCY_SEC (порядок
+в списке решает при равенстве). Чтобы оценка отставшего провайдера не застывала,
+EXPLORE_RATIO запросов уходит случайному доступному провайдеру. Провайдер с
+разомкнутым автоматом не выбирается — запросы переходят на следующий.
+
+Кэш префикса промпта: провайдеры сообщают в usage, сколько токенов промпта взято
+из кэша (DeepSeek — prompt_cache_hit_tokens, OpenAI-совместимые —
+prompt_tokens_details.cached_tokens). В статистике провайдера — доля токенов из
+кэша и EWMA задержки отдельно для запросов с попаданием в кэш и без: ответы
+не потоковые, так что полная задержка — приближение времени до первого токена.
+
+Проверить локально: два scripts/llm_stub_server.py на разных портах (один
+медленный или с ошибками) и LLM_PROVIDERS с их адресами.
+"""
+import json
+import logging
+import random
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from main.config_reader import config
+
+DEFAULT_URL = "https://api.deepseek.com/v1/chat/completions"
+DEFAULT_MODEL = "deepseek-v4-flash"
+
+# Сглаживание EWMA (вес нового замера)
+EWMA_ALPHA = 0.2
+# Задержка провайдера без замеров, секунд
+UNKNOWN_LATENCY_SEC = 5.0
+# Штраф за ошибки и вес стоимости в оценке
+ERROR_PENALTY = 4.0
+COST_WEIGHT = 0.5
+# Доля запросов случайному провайдеру (обновить его оценку)
+EXPLORE_RATIO = 0.05
+# Автомат отключения провайдера: после N неудач подряд — пауза, затем один пробный запрос
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_SEC = 30
+# Пробный запрос без итога (отменён) дольше этого считается потерянным — выдаётся новый
+CIRCUIT_PROBE_TIMEOUT_SEC = 120
+
+
+class CircuitBreaker:
+    """
+    closed → (N неудач подряд) → open → (пауза) → half-open: один пробный запрос.
+    Пробный запрос, отменённый без итога, возвращается через abandon(); если и этого
+    не случилось (задачу отменили до старта), он истекает через probe_timeout_sec.
+    """
+
+    def __init__(self, threshold: int, open_sec: float, name: str = "LLM",
+                 probe_timeout_sec: float = CIRCUIT_PROBE_TIMEOUT_SEC):
+        self.name = name
+        self.threshold = threshold
+        self.open_sec = open_sec
+        self.probe_timeout_sec = probe_timeout_sec
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.opened_total = 0
+        self._probe_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.open_sec:
+            return 'open'
+        return 'half_open'
+
+    def allow(self) -> bool:
+        """Можно ли сейчас отправить запрос (в half-open — только один пробный)."""
+        state = self.state
+        if state == 'closed':
+            return True
+        now = time.monotonic()
+        if state == 'half_open' and (self._probe_at is None or now - self._probe_at > self.probe_timeout_sec):
+            self._probe_at = now
+            return True
+        return False
+
+    def abandon(self) -> None:
+        """Запрос отменён без итога: пробный запрос можно выдать снова."""
+        self._probe_at = None
+
+    def success(self) -> None:
+        if self.opened_at is not None:
+            logging.info(f"{self.name}: circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_at = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None or self._probe_at is not None:
+                logging.warning(f"{self.name}: circuit opened for {self.open_sec}s after {self.failures} failure(s)")
+                self.opened_total += 1
+            self.opened_at = time.monotonic()
+            self._probe_at = None
+
+
+def _ewma(current: Optional[float], value: float) -> float:
+    return value if current is None else EWMA_ALPHA * value + (1 - EWMA_ALPHA) * current
+
+
+def cached_prompt_tokens(usage: Dict[str, Any]) -> int:
+    """Токены промпта, взятые из кэша провайдера (0 — провайдер не сообщает)."""
+    if "prompt_cache_hit_tokens" in usage:
+        return int(usage["prompt_cache_hit_tokens"] or 0)
+    details = usage.get("prompt_tokens_details") or {}
+    return int(details.get("cached_tokens") or 0)
+
+
+class Provider:
+    """OpenAI-совместимый эндпоинт и его здоровье."""
+
+    def __init__(self, name: str, url: str, model: str, api_key: str,
+                 cost_per_1m_tokens: float = 0.0, order: int = 0):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.cost_per_1m_tokens = cost_per_1m_tokens
+        self.order = order
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SEC, name=name)
+        self.ewma_latency: Optional[float] = None
+        self.ewma_error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.tokens = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.cache_hits = 0
+        self.ewma_latency_cache_hit: Optional[float] = None
+        self.ewma_latency_cache_miss: Optional[float] = None
+
+    @property
+    def available(self) -> bool:
+        return self.breaker.state != 'open'
+
+    def score(self) -> float:
+        latency = self.ewma_latency if self.ewma_latency is not None else UNKNOWN_LATENCY_SEC
+        return (latency * (1 + ERROR_PENALTY * self.ewma_error_rate)
+                + COST_WEIGHT * self.cost_per_1m_tokens
+                + self.order * 1e-6)
+
+    def record_success(self, latency: float, usage: Optional[Dict[str, Any]] = None) -> None:
+        usage = usage or {}
+        self.requests += 1
+        self.tokens += int(usage.get("total_tokens") or 0)
+        self.prompt_tokens += int(usage.get("prompt_tokens") or 0)
+        cached = cached_prompt_tokens(usage)
+        self.cached_tokens += cached
+        if cached:
+            self.cache_hits += 1
+            self.ewma_latency_cache_hit = _ewma(self.ewma_latency_cache_hit, latency)
+        else:
+            self.ewma_latency_cache_miss = _ewma(self.ewma_latency_cache_miss, latency)
+        self.ewma_latency = _ewma(self.ewma_latency, latency)
+        self.ewma_error_rate = (1 - EWMA_ALPHA) * self.ewma_error_rate
+        self.breaker.success()
+
+    def record_failure(self, retryable: bool = True) -> None:
+        self.requests += 1
+        if not retryable:
+            # 4xx — провайдер отвечает, дело в запросе
+            self.breaker.success()
+            return
+        self.errors += 1
+        self.ewma_error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.ewma_error_rate
+        self.breaker.failure()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "circuit": self.breaker.state,
+            "ewma_latency_sec": round(self.ewma_latency, 3) if self.ewma_latency is not None else None,
+            "ewma_error_rate": round(self.ewma_error_rate, 3),
+            "score": round(self.score(), 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "tokens": self.tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_ratio": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else None,
+            "cache_hit_requests": self.cache_hits,
+            "ewma_latency_cache_hit_sec": (
+                round(self.ewma_latency_cache_hit, 3) if self.ewma_latency_cache_hit is not None else None
+            ),
+            "ewma_latency_cache_miss_sec": (
+                round(self.ewma_latency_cache_miss, 3) if self.ewma_latency_cache_miss is not None else None
+            ),
+            "estimated_cost": round(self.tokens * self.cost_per_1m_tokens / 1_000_000, 4),
+        }
+
+
+class ProviderRegistry:
+    """Провайдеры в порядке из конфигурации и выбор лучшего доступного."""
+
+    def __init__(self, providers: List[Provider]):
+        if not providers:
+            raise ValueError("At least one LLM provider is required")
+        self.providers = providers
+        self.failovers = 0
+
+    def pick(self, exclude: Iterable[Provider] = ()) -> Optional[Provider]:
+        """Лучший доступный провайдер (кроме exclude, если есть другие). None — все недоступны."""
+        candidates = [p for p in self.providers if p.available]
+        if not candidates:
+            return None
+        preferred = [p for p in candidates if p not in set(exclude)] or candidates
+        if len(preferred) > 1 and random.random() < EXPLORE_RATIO:
+            return random.choice(preferred)
+        return min(preferred, key=Provider.score)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "failovers": self.failovers,
+            "providers": {p.name: p.stats() for p in self.providers},
+        }
+
+
+def load_providers() -> List[Provider]:
+    """Провайдеры из LLM_PROVIDERS или DeepSeek по умолчанию."""
+    raw = config.llm_providers.get_secret_value() if config.llm_providers else ""
+    if not raw.strip():
+        return [Provider("deepseek", DEFAULT_URL, DEFAULT_MODEL, config.api_key.get_secret_value())]
+    providers = []
+    for order, item in enumerate(json.loads(raw)):
+        providers.append(Provider(
+            name=item.get("name") or f"provider{order}",
+            url=item["url"],
+            model=item["model"],
+            api_key=item.get("api_key") or config.api_key.get_secret_value(),
+            cost_per_1m_tokens=float(item.get("cost_per_1m_tokens", 0)),
+            order=order,
+        ))
+    logging.info(f"LLM providers: {', '.join(p.name for p in providers)}")
+    return providers
@@ -0,0 +1,147 @@
+"""
+Прямые вызовы MAX Bot API, минуя bot.session.
+
+bot.send_message() зависит от сессии, которая создаётся внутри start_polling().
+При cold start на Render вебхук/воркер может сработать раньше — сессии нет.
+Здесь своя общая aiohttp-сессия на процесс, она работает всегда.
+
+Отправка ограничена по частоте (MAX_API_RATE_LIMIT сообщений в секунду на процесс),
+чтобы массовые рассылки через outbox не упирались в лимиты MAX API.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import aiohttp
+
+from main.config_reader import config
+
+MAX_API_URL = "https://platform-api.max.ru"
+_REQUEST_TIMEOUT = 15
+
+
+class MaxApiError(Exception):
+    """Ошибка ответа MAX API (текст содержит статус и тело — для is_send_blocked_error)."""
+
+    def __init__(self, status: int, body: str):
+        self.status = status
+        self.body = body
+        super().__init__(f"MAX API error {status}: {body[:300]}")
+
+
+class _RateLimiter:
+    """Равномерный лимит: не чаще rate вызовов в секунду (rate <= 0 — без лимита)."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_at - now
+            self._next_at = max(now, self._next_at) + 1.0 / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_session: Optional[aiohttp.ClientSession] = None
+_send_limiter = _RateLimiter(config.max_api_rate_limit)
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=_REQUEST_TIMEOUT))
+    return _session
+
+
+async def close_session():
+    """Закрыть общую сессию (при остановке процесса)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _keyboard_attachment(keyboard) -> dict:
+    from aiomax import buttons as btn
+    if isinstance(keyboard, btn.KeyboardBuilder):
+        keyboard = keyboard.to_list()
+    return {
+        "type": "inline_keyboard",
+        "payload": {
+            "buttons": [
+                [b.to_json() if hasattr(b, 'to_json') else b for b in row]
+                for row in keyboard
+            ]
+        },
+    }
+
+
+async def send_message_direct(user_id: int, text: str, keyboard=None, format: Optional[str] = "html") -> bool:
+    """
+    Отправить сообщение пользователю через MAX API.
+    Возвращает True при успехе; при ответе не 2xx — MaxApiError.
+    """
+    token = config.effective_bot_token.get_secret_value()
+    body = {"text": text, "notify": True}
+    if format:
+        body["format"] = format
+    if keyboard:
+        body["attachments"] = [_keyboard_attachment(keyboard)]
+
+    await _send_limiter.acquire()
+    async with _get_session().post(
+        f"{MAX_API_URL}/messages",
+        params={"user_id": user_id},
+        headers={"Authorization": token},
+        json=body,
+    ) as resp:
+        if 200 <= resp.status < 300:
+            logging.info(f"Direct API: message sent to user {user_id}")
+            return True
+        error = await resp.text()
+        logging.error(f"Direct API: failed to send to user {user_id}: {resp.status} - {error}")
+        raise MaxApiError(resp.status, error)
+
+
+async def _api_request(method: str, path: str, params: Optional[dict] = None, json: Optional[dict] = None) -> dict:
+    token = config.effective_bot_token.get_secret_value()
+    async with _get_session().request(
+        method,
+        f"{MAX_API_URL}/{path}",
+        params=params,
+        headers={"Authorization": token},
+        json=json,
+    ) as resp:
+        if 200 <= resp.status < 300:
+            return await resp.json(content_type=None) or {}
+        raise MaxApiError(resp.status, await resp.text())
+
+
+async def get_subscriptions() -> list:
+    """Текущие вебхук-подписки бота (GET /subscriptions)."""
+    data = await _api_request("GET", "subscriptions")
+    return data.get("subscriptions") or []
+
+
+async def subscribe_webhook(url: str, update_types: Optional[list] = None, secret: Optional[str] = None) -> None:
+    """Подписать бота на апдейты вебхуком (POST /subscriptions). Long polling при этом перестаёт получать апдейты."""
+    body = {"url": url}
+    if update_types:
+        body["update_types"] = update_types
+    if secret:
+        body["secret"] = secret
+    data = await _api_request("POST", "subscriptions", json=body)
+    if data.get("success") is False:
+        raise MaxApiError(200, str(data))
+
+
+async def unsubscribe_webhook(url: str) -> None:
+    """Удалить вебхук-подписку (DELETE /subscriptions?url=...)."""
+    await _api_request("DELETE", "subscriptions", params={"url": url})
@@ -0,0 +1,232 @@
+"""
+Приём апдейтов MAX вебхуком — альтернатива long polling (BOT_UPDATES_MODE=webhook).
+
+В режиме webhook бот подписывается на апдейты (POST /subscriptions) с адресом
+{SERVICE_URL}/webhook/max, и MAX сам присылает их на aiohttp-приложение
+webhook_server.py. Обработчик:
+
+- проверяет секрет подписки (заголовок X-Max-Bot-Api-Secret, MAX_WEBHOOK_SECRET);
+- проверяет структуру апдейта (тип, отправитель) — мусор получает 400;
+- отбрасывает повторные доставки (mid сообщения / callback_id) за последнее время;
+- передаёт апдейт тем же роутерам, что и polling (bot.handle_update → диспетчер
+  main/dispatcher.py), либо пулу процессов-обработчиков, шардированному по user_id
+  (UPDATE_WORKER_PROCESSES, main/update_workers.py).
+
+Ответ MAX — сразу после постановки в очередь, обработка идёт в фоне.
+Без вызова start_polling сессию бота (bot.session, get_me, on_ready) открывает
+open_bot_session().
+
+Проверить локально без MAX: scripts/replay_updates.py шлёт сохранённые или
+сгенерированные апдейты на /webhook/max.
+"""
+import asyncio
+import hmac
+import logging
+import os
+import ssl
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import aiohttp
+import aiomax
+from aiohttp import web
+from aiohttp.web_request import Request
+from aiohttp.web_response import Response
+
+from main import json_codec, max_api, metrics
+from main.botdef import bot
+from main.config_reader import config
+from main.tasks import supervisor
+
+MAX_UPDATES_PATH = '/webhook/max'
+SECRET_HEADER = 'X-Max-Bot-Api-Secret'
+
+# Типы апдейтов, которые разбирает aiomax.Bot.handle_update
+UPDATE_TYPES = [
+    'message_created', 'message_edited', 'message_removed', 'message_callback',
+    'bot_started', 'bot_added', 'bot_removed', 'user_added', 'user_removed',
+    'chat_title_changed', 'message_chat_created',
+]
+# Сколько последних ключей апдейтов помнить для отсева повторных доставок
+RECENT_UPDATES_LIMIT = 10000
+
+_recent: "OrderedDict[Hashable, None]" = OrderedDict()
+_worker_pool = None
+_stats: Dict[str, Any] = {
+    'received': 0, 'accepted': 0, 'duplicates': 0, 'invalid': 0, 'unauthorized': 0, 'rejected': 0,
+}
+
+
+def enabled() -> bool:
+    return config.bot_updates_mode == 'webhook'
+
+
+def webhook_url() -> Optional[str]:
+    service_url = config.service_url or os.environ.get('SERVICE_URL') or os.environ.get('RENDER_EXTERNAL_URL')
+    return f"{service_url.rstrip('/')}{MAX_UPDATES_PATH}" if service_url else None
+
+
+def set_worker_pool(pool) -> None:
+    """Передавать апдейты пулу процессов (main/update_workers.py) вместо bot.handle_update."""
+    global _worker_pool
+    _worker_pool = pool
+
+
+def validate_update(data: Any) -> Optional[str]:
+    """Проверить структуру апдейта. Возвращает текст ошибки или None."""
+    if not isinstance(data, dict):
+        return "update must be an object"
+    update_type = data.get('update_type')
+    if update_type not in UPDATE_TYPES:
+        return f"unknown update_type: {update_type!r}"
+    if not isinstance(data.get('timestamp'), int):
+        return "timestamp is required"
+    if update_type in ('message_created', 'message_edited'):
+        message = data.get('message')
+        if not isinstance(message, dict) or not isinstance(message.get('body'), dict):
+            return "message.body is required"
+        if not isinstance((message.get('sender') or {}).get('user_id'), int):
+            return "message.sender.user_id is required"
+    elif update_type == 'message_callback':
+        callback = data.get('callback')
+        if not isinstance(callback, dict) or not callback.get('callback_id'):
+            return "callback.callback_id is required"
+        if not isinstance((callback.get('user') or {}).get('user_id'), int):
+            return "callback.user.user_id is required"
+    elif update_type in ('bot_started', 'bot_added', 'bot_removed', 'user_added', 'user_removed',
+                         'chat_title_changed'):
+        if not isinstance((data.get('user') or {}).get('user_id'), int):
+            return "user.user_id is required"
+    return None
+
+
+def _update_key(data: dict) -> Hashable:
+    update_type = data['update_type']
+    if update_type == 'message_created':
+        return update_type, data['message']['body'].get('mid')
+    if update_type == 'message_callback':
+        return update_type, data['callback']['callback_id']
+    return update_type, data['timestamp'], json_codec.dumps(data)
+
+
+def _seen(data: dict) -> bool:
+    """Апдейт уже принимали (MAX повторяет доставку, если не дождался ответа)."""
+    key = _update_key(data)
+    if key in _recent:
+        return True
+    _recent[key] = None
+    if len(_recent) > RECENT_UPDATES_LIMIT:
+        _recent.popitem(last=False)
+    return False
+
+
+async def deliver(update: dict) -> bool:
+    """Передать апдейт роутерам (или пулу процессов). False — очередь переполнена."""
+    if _worker_pool is not None:
+        return _worker_pool.submit(update)
+    await bot.handle_update(update)
+    return True
+
+
+async def max_updates_handler(request: Request) -> Response:
+    """POST /webhook/max — апдейт от MAX."""
+    if not enabled():
+        return web.Response(status=404)
+    _stats['received'] += 1
+
+    secret = config.max_webhook_secret.get_secret_value() if config.max_webhook_secret else None
+    if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+        _stats['unauthorized'] += 1
+        logging.warning(f"MAX webhook: bad secret from {request.remote}")
+        return web.Response(status=403)
+
+    try:
+        data = json_codec.loads(await request.read())
+    except ValueError as e:
+        _stats['invalid'] += 1
+        return web.Response(text=f"Invalid JSON: {e}", status=400)
+
+    error = validate_update(data)
+    if error:
+        _stats['invalid'] += 1
+        logging.warning(f"MAX webhook: invalid update ({error})")
+        return web.Response(text=error, status=400)
+
+    if _seen(data):
+        _stats['duplicates'] += 1
+        return web.Response(text="OK", status=200)
+
+    if not await deliver(data):
+        # Пусть MAX повторит доставку позже
+        _recent.pop(_update_key(data), None)
+        _stats['rejected'] += 1
+        return web.Response(text="Busy", status=503)
+
+    _stats['accepted'] += 1
+    return web.Response(text="OK", status=200)
+
+
+async def open_bot_session() -> None:
+    """Открыть сессию бота без start_polling: bot.session, get_me(), обработчики on_ready."""
+    connector = None
+    if bot.use_certificate:
+        ssl_context = ssl.create_default_context()
+        ssl_context.load_verify_locations(
+            cafile=os.path.join(os.path.dirname(aiomax.__file__), "russian_trusted_root_ca.cer")
+        )
+        connector = aiohttp.TCPConnector(ssl=ssl_context)
+    bot.session = aiohttp.ClientSession(
+        headers={"Authorization": bot.access_token},
+        connector=connector,
+        base_url=bot.api_url,
+    )
+    await bot.get_me()
+    logging.info(f"Bot session opened: @{bot.username} ({bot.id})")
+    for handler in bot.handlers["on_ready"]:
+        supervisor.spawn("default", handler(), name=f"on_ready:{handler.__name__}")
+
+
+async def close_bot_session() -> None:
+    if bot.session is not None and not bot.session.closed:
+        await bot.session.close()
+    bot.session = None
+
+
+async def subscribe() -> None:
+    """Подписать бота на апдейты по адресу webhook_url()."""
+    url = webhook_url()
+    if not url:
+        raise RuntimeError("BOT_UPDATES_MODE=webhook requires SERVICE_URL")
+    secret = config.max_webhook_secret.get_secret_value() if config.max_webhook_secret else None
+    await max_api.subscribe_webhook(url, UPDATE_TYPES, secret)
+    logging.info(f"MAX webhook subscription set: {url}")
+
+
+async def remove_subscription() -> None:
+    """
+    Режим polling: снять нашу вебхук-подписку, если осталась от запуска в режиме webhook
+    (пока подписка есть, long polling апдейтов не получает).
+    """
+    url = webhook_url()
+    if not url:
+        return
+    try:
+        subscriptions = await max_api.get_subscriptions()
+        if any(s.get('url') == url for s in subscriptions):
+            await max_api.unsubscribe_webhook(url)
+            logging.info(f"MAX webhook subscription removed: {url}")
+    except Exception as e:
+        logging.warning(f"Could not check MAX webhook subscriptions: {e}")
+
+
+async def run() -> None:
+    """Режим webhook: открыть сессию бота, подписаться и ждать остановки."""
+    await open_bot_session()
+    try:
+        await subscribe()
+        await asyncio.Event().wait()
+    finally:
+        await close_bot_session()
+
+
+metrics.register("max_webhook", lambda: {"enabled": enabled(), "worker_pool": _worker_pool is not None, **_stats})
@@ -0,0 +1,259 @@
+"""
+Исходящие сообщения бота через outbox (main/outbox.py).
+
+Автоматические отправки (напоминания об оплате, welcome-активация, рассылка Пн/Чт,
+карта дня) не шлются напрямую: в транзакции, которая ставит пометку «отправлено»,
+в outbox пишется событие kind='message' с шаблоном и параметрами. Воркер outbox
+рендерит шаблон и отправляет через MAX API (main/max_api.py, с лимитом частоты).
+
+Шаблон — функция (user_id, params) -> список частей (text, keyboard, format).
+Многочастные сообщения (текст + меню оплаты) отправляются по порядку; номер
+последней отправленной части сохраняется в событии, так что повтор после ошибки
+не дублирует уже ушедшие части.
+
+Тексты шаблонов используются и ручными отправками send_message.py.
+"""
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiomax import buttons
+
+from main import outbox
+from main.max_api import send_message_direct
+
+Part = Tuple[str, Any, Optional[str]]
+Template = Callable[[int, Dict[str, Any]], Awaitable[List[Part]]]
+OnSent = Callable[[int, Dict[str, Any]], None]
+
+_templates: Dict[str, Template] = {}
+_on_sent: Dict[str, OnSent] = {}
+
+EVENT_KIND = 'message'
+_PROGRESS_KEY = 'parts_sent'
+
+
+def template(name: str, on_sent: Optional[OnSent] = None):
+    """Декоратор: зарегистрировать шаблон name (on_sent — аналитика после первой доставки)."""
+    def decorator(func: Template) -> Template:
+        _templates[name] = func
+        if on_sent is not None:
+            _on_sent[name] = on_sent
+        return func
+    return decorator
+
+
+async def render(name: str, user_id: int, params: Optional[Dict[str, Any]] = None) -> List[Part]:
+    func = _templates.get(name)
+    if func is None:
+        raise outbox.PermanentError(f"Unknown message template: {name}")
+    return await func(user_id, params or {})
+
+
+async def enqueue(
+    conn,
+    user_id: int,
+    name: str,
+    params: Optional[Dict[str, Any]] = None,
+    dedupe_key: Optional[str] = None,
+    priority: int = outbox.PRIORITY_REMINDER,
+) -> Optional[int]:
+    """Поставить сообщение в outbox (на соединении транзакции бизнес-изменения)."""
+    return await outbox.add_event(
+        conn, EVENT_KIND, user_id, {'template': name, 'params': params or {}},
+        dedupe_key=dedupe_key, priority=priority,
+    )
+
+
+async def enqueue_many(
+    conn,
+    name: str,
+    items: List[Tuple[int, Optional[Dict[str, Any]], Optional[str]]],
+    priority: int = outbox.PRIORITY_BULK,
+) -> None:
+    """Пакетно поставить сообщения (user_id, params, dedupe_key) — для рассылок."""
+    await outbox.add_events(
+        conn, EVENT_KIND,
+        [(uid, {'template': name, 'params': params or {}}, key) for uid, params, key in items],
+        priority=priority,
+    )
+
+
+@outbox.handler(EVENT_KIND)
+async def _deliver_message(event: dict):
+    user_id = event['user_id']
+    payload = event['payload'] or {}
+    name = payload.get('template')
+    params = payload.get('params') or {}
+    parts = await render(name, user_id, params)
+
+    sent = int(payload.get(_PROGRESS_KEY, 0))
+    for i in range(sent, len(parts)):
+        text, keyboard, fmt = parts[i]
+        await send_message_direct(user_id, text, keyboard=keyboard, format=fmt)
+        if len(parts) > 1 and i + 1 < len(parts):
+            await outbox.set_progress(event['id'], _PROGRESS_KEY, i + 1)
+
+    # Аналитика — один раз, после доставки всех частей (дальше событие помечается done)
+    hook = _on_sent.get(name)
+    if hook is not None:
+        try:
+            hook(user_id, params)
+        except Exception as e:
+            logging.error(f"Message '{name}' on_sent hook failed for user {user_id}: {e}", exc_info=True)
+
+
+# ==================== Шаблоны ====================
+
+PAYMENT_REMINDER_TEXTS = {
+    '10m': (
+        "<b>Доступ к раскладам почти открыт — осталось только завершить оплату</b> 👇"
+    ),
+    '1h': (
+        "Кажется, оплата не дошла до конца — бывает 🔮\n\n"
+        "Если расклад всё ещё актуален, можешь завершить оплату, "
+        "когда будет удобно."
+    ),
+    '3h': (
+        "На всякий случай напоминаем: доступ к раскладам всё ещё можно открыть ✨\n\n"
+        "Если сейчас не время — ничего страшного. "
+        "Когда захочешь вернуться, нажми «Оплатить» ниже."
+    ),
+}
+
+
+def payment_reminder_message(stage: str) -> Part:
+    """Напоминание об оплате с кнопкой «Оплатить» (stage: '10m' | '1h' | '3h')."""
+    kb = buttons.KeyboardBuilder()
+    kb.row(buttons.CallbackButton("💳 Оплатить", "remind_pay"))
+    return PAYMENT_REMINDER_TEXTS.get(stage, PAYMENT_REMINDER_TEXTS['10m']), kb, 'html'
+
+
+def activation_message() -> Part:
+    """Welcome-активация: пользователь заходил, но ещё не сделал расклад."""
+    from keyboards.main_menu import make_main_menu
+
+    text = (
+        "Привет 🔮\n\n"
+        "Ты заходил(а), но мы ещё не успели погадать вместе.\n\n"
+        "Задай свой первый вопрос — карты уже ждут. "
+        "Можно начать с чего-то простого: «Что мне важно знать сегодня?»\n\n"
+        "Выбери расклад в меню ниже ✨"
+    )
+    return text, make_main_menu(), None
+
+
+def gentle_nudge_message() -> Part:
+    """Мягкое напоминание для пользователей с активным платным доступом."""
+    text = (
+        "Привет 🔮\n\n"
+        "Просто напомню — карты здесь, если захочется новый расклад.\n\n"
+        "Не обязательно ждать сложного момента. "
+        "Можно спросить о делах, отношениях или просто «что важно знать сейчас».\n\n"
+        "Я рядом ✨"
+    )
+    return text, None, None
+
+
+def free_return_message() -> Part:
+    """Мягкое напоминание для пользователей с оставшимися бесплатными раскладами."""
+    text = (
+        "Привет 🔮\n\n"
+        "У тебя ещё есть бесплатные расклады — можешь воспользоваться, когда будет удобно.\n\n"
+        "Карты помогают увидеть ситуацию с другой стороны. "
+        "Загляни, если захочется ясности ✨"
+    )
+    return text, None, None
+
+
+def broadcast_payment_text() -> str:
+    return (
+        "🔮 <b>Личная консультация с тарологом Дианой</b> — от 500₽\n"
+        "Живой расклад и ответ в течение часа (10:00–22:00 МСК).\n\n"
+        "<b>🔥 Самый популярный вариант</b>\n"
+        "👑 Безлимит на месяц — 599₽\n"
+        "Гадай когда угодно и сколько угодно. Полная анонимность.\n\n"
+        "Или выбери пакет:\n"
+        "🔥 30 раскладов — 399₽\n"
+        "🌟 20 раскладов — 289₽\n"
+        "💫 10 раскладов — 179₽\n"
+        "🌙 3 расклада — 99₽\n\n"
+        "👉 Выбрать пакет"
+    )
+
+
+def no_divinations_messages() -> List[Part]:
+    """Напоминание тем, у кого закончились все гадания + меню оплаты."""
+    from keyboards.pay import make_payment_kb
+
+    reminder_text = (
+        "✨ Привет! Может, пора сделать новый расклад?\n\n"
+        "Карты помогли тебе увидеть то, что было скрыто. "
+        "И если сейчас снова нужна ясность — я здесь.\n\n"
+        "Выбери свой путь и продолжай находить ответы внутри себя 💫"
+    )
+    return [(reminder_text, None, None), (broadcast_payment_text(), make_payment_kb(), 'html')]
+
+
+def expired_sub_messages() -> List[Part]:
+    """Напоминание пользователям, у которых закончился платный доступ + меню оплаты."""
+    from keyboards.pay import make_payment_kb
+
+    reminder_text = (
+        "Привет! 💫\n\n"
+        "Твои расклады закончились, но вопросы к картам — нет.\n\n"
+        "Если снова нужна ясность — я здесь. "
+        "Можно вернуться к любой теме, которая сейчас важна ✨"
+    )
+    return [(reminder_text, None, None), (broadcast_payment_text(), make_payment_kb(), 'html')]
+
+
+def track_paywall_sent(user_id: int, paywall_source: str, sent_via: str, segment: Optional[str] = None) -> None:
+    """Конверсия paywall (БД + Метрика) после отправки напоминания с меню оплаты."""
+    from main.conversions import track_paywall_conversion
+    from main.metrika_mp import track_conversion_event
+
+    metadata = {'reminder_type': paywall_source, 'sent_via': sent_via}
+    if segment:
+        metadata['segment'] = segment
+    track_paywall_conversion(user_id=user_id, paywall_source=paywall_source, metadata=metadata)
+    track_conversion_event(user_id, 'paywall')
+
+
+@template('payment_reminder')
+async def _payment_reminder(user_id: int, params: Dict[str, Any]) -> List[Part]:
+    return [payment_reminder_message(params.get('stage', '10m'))]
+
+
+@template('activation')
+async def _activation(user_id: int, params: Dict[str, Any]) -> List[Part]:
+    return [activation_message()]
+
+
+@template('gentle_nudge')
+async def _gentle_nudge(user_id: int, params: Dict[str, Any]) -> List[Part]:
+    return [gentle_nudge_message()]
+
+
+@template('free_return')
+async def _free_return(user_id: int, params: Dict[str, Any]) -> List[Part]:
+    return [free_return_message()]
+
+
+@template('no_divinations', on_sent=lambda uid, p: track_paywall_sent(
+    uid, 'no_divinations_reminder', p.get('sent_via', 'broadcast'), p.get('segment')))
+async def _no_divinations(user_id: int, params: Dict[str, Any]) -> List[Part]:
+    return no_divinations_messages()
+
+
+@template('expired_sub', on_sent=lambda uid, p: track_paywall_sent(
+    uid, 'expired_sub_reminder', p.get('sent_via', 'broadcast'), p.get('segment')))
+async def _expired_sub(user_id: int, params: Dict[str, Any]) -> List[Part]:
+    return expired_sub_messages()
+
+
+@template('daily_card')
+async def _daily_card(user_id: int, params: Dict[str, Any]) -> List[Part]:
+    # Клавиатура (случайные карты, кнопка оплаты по балансу) — на момент отправки
+    from handlers.daily_card import build_daily_card_message
+    text, kb = await build_daily_card_message(user_id)
+    return [(text, kb, 'html')]
@@ -0,0 +1,32 @@
+"""
+Реестр внутренних метрик процесса (очереди, пулы задач, буферы).
+
+Компоненты регистрируют функцию, возвращающую dict со своими счётчиками;
+snapshot() собирает всё в один dict — его отдаёт /internal/metrics вебхук-сервера
+и его же удобно логировать.
+
+    from main import metrics
+    metrics.register("conversions", lambda: {"pending": len(buf)})
+"""
+import logging
+import time
+from typing import Any, Callable, Dict
+
+_providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def register(name: str, provider: Callable[[], Dict[str, Any]]) -> None:
+    """Зарегистрировать источник метрик (повторная регистрация заменяет старый)."""
+    _providers[name] = provider
+
+
+def snapshot() -> Dict[str, Any]:
+    """Собрать текущие значения всех зарегистрированных метрик."""
+    result: Dict[str, Any] = {"timestamp": int(time.time())}
+    for name, provider in list(_providers.items()):
+        try:
+            result[name] = provider()
+        except Exception as e:
+            logging.error(f"Metrics provider {name} failed: {e}", exc_info=True)
+            result[name] = {"error": str(e)}
+    return result
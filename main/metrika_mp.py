@@ -13,14 +13,16 @@ import asyncio
 import logging
 import time
 import random
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import quote, urlencode
 
 import aiohttp
 import asyncpg
 
+from main import metrics
 from main.config_reader import config
 from main.database import Database, get_table_name
+from main.tasks import supervisor
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +32,9 @@ _REQUEST_TIMEOUT = 5
 # URL для сбора данных Measurement Protocol
 _COLLECT_URL = "https://mc.yandex.ru/collect/"
 
+# Максимум одновременных соединений к Метрике из общей сессии
+_MAX_CONNECTIONS = 20
+
 
 def generate_metrika_client_id() -> str:
     """
@@ -41,6 +46,33 @@ def generate_metrika_client_id() -> str:
     return f"{ts}{rnd}"
 
 
+def _mp_configured() -> bool:
+    """Заданы ли счётчик и токен MP (без них хиты не отправляются вовсе)."""
+    return bool(config.metrika_mp_counter_id and config.metrika_mp_token)
+
+
+# Одна aiohttp-сессия на процесс (пул соединений к mc.yandex.ru) вместо сессии на каждый хит
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=_REQUEST_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=_MAX_CONNECTIONS),
+        )
+    return _session
+
+
+async def close_session():
+    """Закрыть общую сессию MP (при остановке процесса)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
 async def _send_hit(params: dict) -> bool:
     """
     Отправляет хит в Яндекс Метрику через Measurement Protocol.
@@ -58,24 +90,22 @@ async def _send_hit(params: dict) -> bool:
         logger.warning("METRIKA_MP_TOKEN not set, skipping MP hit")
         return False
 
-    params["tid"] = str(counter_id)
-    params["ms"] = token
+    # Копия: исходные params (без токена) могут уйти в таблицу ретраев
+    params = {**params, "tid": str(counter_id), "ms": token}
 
     url = _COLLECT_URL + "?" + urlencode(params)
 
     try:
-        timeout = aiohttp.ClientTimeout(total=_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    logger.info(f"MP hit sent: t={params.get('t')}, cid={params.get('cid')}")
-                    return True
-                else:
-                    body = await resp.text()
-                    logger.warning(
-                        f"MP hit unexpected status {resp.status}: {body[:200]}"
-                    )
-                    return False
+        async with _get_session().get(url) as resp:
+            if resp.status == 200:
+                logger.info(f"MP hit sent: t={params.get('t')}, cid={params.get('cid')}")
+                return True
+            else:
+                body = await resp.text()
+                logger.warning(
+                    f"MP hit unexpected status {resp.status}: {body[:200]}"
+                )
+                return False
     except asyncio.TimeoutError:
         logger.warning("MP hit timeout")
         return False
@@ -110,6 +140,17 @@ async def send_pageview(metrika_client_id: str, yclid: str) -> bool:
     return await _send_hit(params)
 
 
+def _event_params(metrika_client_id: str, goal_identifier: str, event_time: Optional[float] = None) -> dict:
+    """Параметры хита цели. event_time — момент события (по умолчанию — сейчас)."""
+    return {
+        "cid": metrika_client_id,
+        "t": "event",
+        "dl": "https://max.ru/gadanie_ai_bot",
+        "ea": goal_identifier,                # идентификатор цели
+        "et": str(int(event_time or time.time())),
+    }
+
+
 async def send_event(metrika_client_id: str, goal_identifier: str) -> bool:
     """
     Отправляет событие достижения цели в Метрику.
@@ -119,15 +160,27 @@ async def send_event(metrika_client_id: str, goal_identifier: str) -> bool:
         goal_identifier: Идентификатор цели (должен совпадать с настроенной в Метрике).
                          Например: 'registration', 'purchase', 'paywall_reached', 'service_usage'.
     """
-    params = {
-        "cid": metrika_client_id,
-        "t": "event",
-        "dl": "https://max.ru/gadanie_ai_bot",
-        "ea": goal_identifier,                # идентификатор цели
-        "et": str(int(time.time())),
-    }
+    return await _send_hit(_event_params(metrika_client_id, goal_identifier))
 
-    return await _send_hit(params)
+
+class MetrikaError(Exception):
+    """Хит не принят Метрикой (таймаут, ошибка сети, не 200)."""
+
+
+async def deliver_conversion_event(user_id: int, goal_identifier: str, event_time: Optional[float] = None) -> bool:
+    """
+    Отправить цель и дождаться ответа Метрики — для событий outbox (kind='metrika_goal'):
+    не отправилось — MetrikaError (или ошибка БД), воркер outbox повторит событие.
+    False — отправлять нечего (MP не настроен, пользователь не из директ-кампании).
+    """
+    if not _mp_configured():
+        return False
+    metrika_client_id = await get_user_metrika_client_id(user_id)
+    if not metrika_client_id:
+        return False
+    if not await _send_hit(_event_params(metrika_client_id, goal_identifier, event_time)):
+        raise MetrikaError(f"MP hit {goal_identifier!r} for user {user_id} not sent")
+    return True
 
 
 async def send_conversion_event(user_id: int, goal_identifier: str) -> bool:
@@ -140,7 +193,7 @@ async def send_conversion_event(user_id: int, goal_identifier: str) -> bool:
 
     Для органических пользователей — тоже ничего не делает.
 
-    Вызывается из хендлеров рядом с save_conversion() — fire-and-forget.
+    Ждёт отправки; из хендлеров используйте track_conversion_event() — он не блокирует.
     
     Args:
         user_id: Telegram User ID.
@@ -157,26 +210,349 @@ async def send_conversion_event(user_id: int, goal_identifier: str) -> bool:
         return False
 
 
+# ==================== Кэш user_id → metrika_client_id ====================
+# metrika_client_id выставляется один раз при регистрации и дальше не меняется (COALESCE),
+# поэтому положительные ответы кэшируем надолго. Отрицательные (органика/лендинг) — коротко,
+# чтобы не пропустить пользователя, которому id проставят позже.
+
+_CLIENT_ID_TTL_SEC = 6 * 3600
+_CLIENT_ID_NEGATIVE_TTL_SEC = 10 * 60
+_CLIENT_ID_CACHE_MAX = 50000
+
+# user_id -> (metrika_client_id | None, expires_at)
+_client_id_cache: Dict[int, Tuple[Optional[str], float]] = {}
+
+
+def _cache_get(user_id: int) -> Tuple[bool, Optional[str]]:
+    """(найдено_в_кэше, значение)."""
+    entry = _client_id_cache.get(user_id)
+    if entry is None:
+        return False, None
+    value, expires_at = entry
+    if expires_at < time.monotonic():
+        _client_id_cache.pop(user_id, None)
+        return False, None
+    return True, value
+
+
+def _cache_put(user_id: int, value: Optional[str]) -> None:
+    if len(_client_id_cache) >= _CLIENT_ID_CACHE_MAX:
+        # dict хранит порядок вставки — выбрасываем самую старую запись
+        _client_id_cache.pop(next(iter(_client_id_cache)), None)
+    ttl = _CLIENT_ID_TTL_SEC if value else _CLIENT_ID_NEGATIVE_TTL_SEC
+    _client_id_cache[user_id] = (value, time.monotonic() + ttl)
+
+
+def remember_metrika_client_id(user_id: int, metrika_client_id: Optional[str]) -> None:
+    """Положить/сбросить значение в кэше (вызывать, если metrika_client_id проставили пользователю)."""
+    if metrika_client_id:
+        _cache_put(user_id, metrika_client_id)
+    else:
+        _client_id_cache.pop(user_id, None)
+
+
 async def get_user_metrika_client_id(user_id: int) -> Optional[str]:
     """
-    Получает metrika_client_id пользователя из БД.
+    Получает metrika_client_id пользователя (из кэша или БД).
     Возвращает None если пользователь не из директ-кампании.
     Если колонки metrika_client_id ещё нет (миграция не применена) — возвращаем None без ошибки,
     как в tg_bot (там колонку добавляют миграцией, см. CONVERSIONS.md).
     """
+    found, value = _cache_get(user_id)
+    if found:
+        return value
+    result = await _fetch_metrika_client_ids([user_id])
+    return result.get(user_id)
+
+
+async def _fetch_metrika_client_ids(user_ids: List[int]) -> Dict[int, Optional[str]]:
+    """
+    Один запрос к БД на пачку пользователей; результат (включая None) кладётся в кэш.
+    Ошибка БД пробрасывается: «не знаем» нельзя путать с «не директ-пользователь».
+    """
+    if not user_ids:
+        return {}
     try:
         users_table = get_table_name("users")
-        query = f"SELECT metrika_client_id FROM {users_table} WHERE user_id = $1"
-        result = await Database.fetch_one(query, user_id)
-        if result and result['metrika_client_id']:
-            return result['metrika_client_id']
-        return None
+        query = f"""
+            SELECT user_id, metrika_client_id FROM {users_table}
+            WHERE user_id = ANY($1::bigint[])
+        """
+        rows = await Database.fetch_all(query, list(user_ids))
+        found = {r['user_id']: r['metrika_client_id'] or None for r in rows}
+        result = {uid: found.get(uid) for uid in user_ids}
+        for uid, value in result.items():
+            _cache_put(uid, value)
+        return result
     except asyncpg.exceptions.UndefinedColumnError:
         logger.debug(
             "Column metrika_client_id missing in %s (run migration for MP).",
             get_table_name("users"),
         )
-        return None
+        return {}
+
+
+# ==================== Ретраи неотправленных хитов ====================
+
+# После стольких неудачных попыток хит удаляется из таблицы ретраев
+METRIKA_RETRY_MAX_ATTEMPTS = 6
+# Пауза перед попыткой N: база * 2^(N-1)
+METRIKA_RETRY_BASE_DELAY_MIN = 5
+
+
+async def ensure_metrika_retries_table():
+    """Создать таблицу metrika_retries если не существует"""
+    table = get_table_name("metrika_retries")
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id SERIAL PRIMARY KEY,
+            params JSONB NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """
+    try:
+        await Database.execute_query(query)
+    except Exception as e:
+        logger.error(f"Error creating metrika_retries table: {e}", exc_info=True)
+
+
+_table_ready = False
+
+
+async def ensure_metrika_retries_table_once():
+    global _table_ready
+    if not _table_ready:
+        await ensure_metrika_retries_table()
+        _table_ready = True
+
+
+async def _save_failed_hits(hits: List[dict]) -> None:
+    """Сохранить неотправленные хиты (параметры без токена) для повторной отправки."""
+    if not hits:
+        return
+    table = get_table_name("metrika_retries")
+    try:
+        await ensure_metrika_retries_table_once()
+        pool = await Database.get_pool()
+        async with pool.acquire() as conn:
+            await conn.executemany(
+                f"""
+                INSERT INTO {table} (params, attempts, next_attempt_at)
+                VALUES ($1, 1, NOW() + make_interval(mins => $2))
+                """,
+                [(params, METRIKA_RETRY_BASE_DELAY_MIN) for params in hits],
+            )
+        logger.info(f"MP: {len(hits)} failed hit(s) saved for retry")
     except Exception as e:
-        logger.error(f"Error getting metrika_client_id for user {user_id}: {e}", exc_info=True)
-        return None
+        logger.error(f"Error saving {len(hits)} failed MP hit(s): {e}", exc_info=True)
+
+
+async def retry_failed_hits(limit: int = 200) -> dict:
+    """
+    Повторно отправить хиты из таблицы ретраев (задача планировщика).
+    Успешные удаляются, неуспешные откладываются с экспоненциальной паузой,
+    после METRIKA_RETRY_MAX_ATTEMPTS попыток — удаляются.
+    """
+    results = {'sent': 0, 'failed': 0, 'dropped': 0}
+    if not _mp_configured():
+        return results
+
+    table = get_table_name("metrika_retries")
+    await ensure_metrika_retries_table_once()
+    rows = await Database.fetch_all(
+        f"""
+        SELECT id, params, attempts FROM {table}
+        WHERE next_attempt_at <= NOW()
+        ORDER BY next_attempt_at
+        LIMIT $1
+        """,
+        limit,
+    )
+    if not rows:
+        return results
+
+    sem = asyncio.Semaphore(_MAX_CONNECTIONS)
+
+    async def _one(row) -> Tuple[int, int, bool]:
+        async with sem:
+            return row['id'], row['attempts'], await _send_hit(row['params'])
+
+    outcomes = await asyncio.gather(*(_one(r) for r in rows))
+
+    sent_ids = [rid for rid, _, ok in outcomes if ok]
+    dropped_ids = [rid for rid, attempts, ok in outcomes if not ok and attempts + 1 >= METRIKA_RETRY_MAX_ATTEMPTS]
+    retry_ids = [rid for rid, attempts, ok in outcomes if not ok and attempts + 1 < METRIKA_RETRY_MAX_ATTEMPTS]
+
+    if sent_ids or dropped_ids:
+        await Database.execute_query(
+            f"DELETE FROM {table} WHERE id = ANY($1::int[])", sent_ids + dropped_ids
+        )
+    if retry_ids:
+        await Database.execute_query(
+            f"""
+            UPDATE {table}
+            SET attempts = attempts + 1,
+                next_attempt_at = NOW() + make_interval(mins => $2 * power(2, attempts)::int)
+            WHERE id = ANY($1::int[])
+            """,
+            retry_ids, METRIKA_RETRY_BASE_DELAY_MIN,
+        )
+
+    results['sent'] = len(sent_ids)
+    results['failed'] = len(retry_ids)
+    results['dropped'] = len(dropped_ids)
+    if dropped_ids:
+        logger.warning(f"MP: {len(dropped_ids)} hit(s) dropped after {METRIKA_RETRY_MAX_ATTEMPTS} attempts")
+    return results
+
+
+# ==================== Диспетчер событий ====================
+
+# Пауза перед повтором событий, для которых не удалось получить metrika_client_id
+CLIENT_ID_RETRY_DELAY_SEC = 30
+
+
+class MetrikaDispatcher:
+    """
+    Фоновая отправка целей MP: ограниченная очередь, пачечный резолв
+    metrika_client_id (кэш + один запрос к БД на пачку), ограничение параллельных
+    запросов к Метрике, неотправленные хиты — в таблицу ретраев.
+    """
+
+    def __init__(self, queue_size: int, concurrency: int, batch_size: int = 100):
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    def submit(self, user_id: int, goal_identifier: str) -> bool:
+        """Поставить цель в очередь. Не блокирует; при переполнении событие отбрасывается."""
+        if not _mp_configured():
+            return False
+        found, value = _cache_get(user_id)
+        if found and value is None:
+            return False  # органика / лендинг — в MP не шлём, БД не трогаем
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            logger.warning(f"MP event {goal_identifier} for user {user_id} dropped: no running event loop")
+            return False
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        try:
+            self._queue.put_nowait((user_id, goal_identifier, time.time()))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"MP queue full ({self.queue_size}), {self.dropped} event(s) dropped so far")
+            return False
+
+    async def _run(self) -> None:
+        queue = self._queue
+        while True:
+            item = await queue.get()
+            batch = [item]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                await self._process_batch(batch)
+            except Exception as e:
+                logger.error(f"MP dispatcher batch error: {e}", exc_info=True)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _process_batch(self, batch: List[Tuple[int, str, float]]) -> None:
+        client_ids: Dict[int, Optional[str]] = {}
+        missing = []
+        for user_id, _, _ in batch:
+            found, value = _cache_get(user_id)
+            if found:
+                client_ids[user_id] = value
+            elif user_id not in missing:
+                missing.append(user_id)
+        if missing:
+            try:
+                client_ids.update(await _fetch_metrika_client_ids(missing))
+            except Exception as e:
+                # БД недоступна — события этих пользователей возвращаем в очередь после паузы
+                logger.error(f"MP: error resolving metrika_client_id for {len(missing)} user(s): {e}", exc_info=True)
+                unresolved = set(missing)
+                self._requeue([item for item in batch if item[0] in unresolved])
+                batch = [item for item in batch if item[0] not in unresolved]
+
+        hits = [
+            _event_params(client_ids[user_id], goal, event_time)
+            for user_id, goal, event_time in batch
+            if client_ids.get(user_id)
+        ]
+        if not hits:
+            return
+
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _one(params: dict) -> bool:
+            async with sem:
+                return await _send_hit(params)
+
+        outcomes = await asyncio.gather(*(_one(p) for p in hits))
+        await _save_failed_hits([p for p, ok in zip(hits, outcomes) if not ok])
+
+    def _requeue(self, items: List[Tuple[int, str, float]]) -> None:
+        """Вернуть события в очередь через CLIENT_ID_RETRY_DELAY_SEC (не влезли — отбрасываются)."""
+        if not items:
+            return
+
+        async def _later() -> None:
+            await asyncio.sleep(CLIENT_ID_RETRY_DELAY_SEC)
+            for item in items:
+                try:
+                    self._queue.put_nowait(item)
+                except asyncio.QueueFull:
+                    self.dropped += 1
+
+        supervisor.spawn("default", _later(), name="metrika_requeue")
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Дождаться отправки очереди (не дольше timeout) и закрыть сессию."""
+        if self._queue is not None and self._task is not None and not self._task.done():
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"MP dispatcher: {self._queue.qsize()} event(s) not sent on shutdown")
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.error(f"MP dispatcher task failed: {e}", exc_info=True)
+            self._task = None
+        await close_session()
+
+
+dispatcher = MetrikaDispatcher(
+    queue_size=config.metrika_mp_queue_size,
+    concurrency=config.metrika_mp_concurrency,
+)
+metrics.register("metrika_mp", lambda: {
+    "queued": dispatcher._queue.qsize() if dispatcher._queue is not None else 0,
+    "dropped": dispatcher.dropped,
+    "client_id_cache": len(_client_id_cache),
+})
+
+
+def track_conversion_event(user_id: int, goal_identifier: str) -> bool:
+    """
+    Поставить цель MP в очередь диспетчера (fire-and-forget, не блокирует хендлер).
+    Вызывается из хендлеров рядом с track_conversion().
+    """
+    return dispatcher.submit(user_id, goal_identifier)
@@ -0,0 +1,365 @@
+"""
+Transactional outbox: побочные эффекты (уведомления, аналитика) записываются в таблицу
+outbox в той же транзакции, что и основное изменение (например, зачисление оплаты),
+а отправляет их фоновый воркер.
+
+Вебхук ЮKassa отвечает сразу после коммита транзакции — медленный MAX API
+больше не держит ответ, и при этом событие не теряется: если процесс упал
+до отправки, воркер подхватит запись после рестарта.
+
+Обработчики регистрируются по типу события:
+
+    @outbox.handler("payment_succeeded")
+    async def _notify(event: dict): ...
+
+event — dict: id, kind, user_id, payload, attempts.
+
+Исходящие сообщения бота (напоминания, рассылки, карта дня) тоже идут через
+outbox — событие kind='message' (main/messages.py): пометка «отправлено»
+и запись в outbox коммитятся вместе, так что падение между ними не даёт ни
+дубля, ни потери. dedupe_key не даёт поставить одно и то же сообщение дважды,
+priority — транзакционные уведомления (оплата) идут раньше массовых рассылок.
+Воркер берёт только события тех типов, обработчики которых зарегистрированы
+в этом процессе. Повторная отправка (replay) — replay() / send_message.py --outbox-replay.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from main import metrics
+from main.max_api import MaxApiError
+from main.database import (
+    Database, get_table_name, is_send_blocked_error, update_user_blocked_status,
+)
+
+# Пачка событий за один проход и параллельность их обработки
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_CONCURRENCY = 10
+# Как часто воркер опрашивает таблицу, если его не будят явно
+OUTBOX_POLL_INTERVAL_SEC = 5.0
+# Аренда события: столько секунд другой воркер его не возьмёт
+OUTBOX_LEASE_SEC = 120
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE_SEC = 30
+
+# Приоритеты (меньше — раньше)
+PRIORITY_TRANSACTIONAL = 0
+PRIORITY_REMINDER = 5
+PRIORITY_BULK = 10
+
+EventHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+_handlers: Dict[str, EventHandler] = {}
+
+
+class PermanentError(Exception):
+    """Ошибка, при которой повторять событие бессмысленно."""
+
+
+def handler(kind: str):
+    """Декоратор: зарегистрировать обработчик событий типа kind."""
+    def decorator(func: EventHandler) -> EventHandler:
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+async def ensure_outbox_table():
+    """Создать таблицу outbox если не существует"""
+    table = get_table_name("outbox")
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id BIGSERIAL PRIMARY KEY,
+            kind VARCHAR(50) NOT NULL,
+            user_id BIGINT NULL,
+            payload JSONB NOT NULL DEFAULT '{{}}'::jsonb,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            last_error TEXT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            processed_at TIMESTAMP NULL,
+            dedupe_key VARCHAR(255) NULL,
+            priority SMALLINT NOT NULL DEFAULT 0
+        )
+    """
+    migrate_queries = [
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS dedupe_key VARCHAR(255) NULL",
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS priority SMALLINT NOT NULL DEFAULT 0",
+    ]
+    index_queries = [
+        f"""
+        CREATE INDEX IF NOT EXISTS idx_{table}_pending
+            ON {table}(next_attempt_at) WHERE status = 'pending'
+        """,
+        f"""
+        CREATE INDEX IF NOT EXISTS idx_{table}_pending_priority
+            ON {table}(priority, id) WHERE status = 'pending'
+        """,
+        f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_dedupe_key ON {table}(dedupe_key)",
+    ]
+    try:
+        await Database.execute_query(query)
+        for q in migrate_queries + index_queries:
+            await Database.execute_query(q)
+    except Exception as e:
+        logging.error(f"Error creating outbox table: {e}", exc_info=True)
+
+
+_table_ready = False
+
+
+async def ensure_outbox_table_once():
+    global _table_ready
+    if not _table_ready:
+        await ensure_outbox_table()
+        _table_ready = True
+
+
+async def add_event(
+    conn,
+    kind: str,
+    user_id: Optional[int],
+    payload: Optional[Dict[str, Any]] = None,
+    dedupe_key: Optional[str] = None,
+    priority: int = PRIORITY_TRANSACTIONAL,
+) -> Optional[int]:
+    """
+    Записать событие в outbox на переданном соединении — вызывать внутри транзакции
+    основного изменения. Возвращает id события (None — такой dedupe_key уже есть).
+    """
+    table = get_table_name("outbox")
+    return await conn.fetchval(
+        f"""
+        INSERT INTO {table} (kind, user_id, payload, dedupe_key, priority)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (dedupe_key) DO NOTHING
+        RETURNING id
+        """,
+        kind, user_id, payload or {}, dedupe_key, priority,
+    )
+
+
+async def add_events(
+    conn,
+    kind: str,
+    events: List[Tuple[Optional[int], Dict[str, Any], Optional[str]]],
+    priority: int = PRIORITY_BULK,
+) -> None:
+    """Пакетная запись событий (user_id, payload, dedupe_key) — для рассылок."""
+    table = get_table_name("outbox")
+    await conn.executemany(
+        f"""
+        INSERT INTO {table} (kind, user_id, payload, dedupe_key, priority)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (dedupe_key) DO NOTHING
+        """,
+        [(kind, user_id, payload or {}, dedupe_key, priority) for user_id, payload, dedupe_key in events],
+    )
+
+
+async def set_progress(event_id: int, key: str, value: Any) -> None:
+    """Сохранить прогресс внутри события (например, сколько частей сообщения уже ушло)."""
+    table = get_table_name("outbox")
+    await Database.execute_query(
+        f"UPDATE {table} SET payload = payload || jsonb_build_object($2::text, $3::jsonb) WHERE id = $1",
+        event_id, key, value,
+    )
+
+
+async def replay(
+    kind: Optional[str] = None,
+    status: str = 'failed',
+    since_hours: Optional[int] = None,
+    event_ids: Optional[List[int]] = None,
+) -> int:
+    """
+    Вернуть события в очередь (status → pending, попытки с нуля).
+    По умолчанию — окончательно упавшие; status='done' — повторная отправка уже доставленных.
+    Возвращает число возвращённых событий.
+    """
+    table = get_table_name("outbox")
+    conditions = ["status = $1"]
+    args: List[Any] = [status]
+    if kind:
+        args.append(kind)
+        conditions.append(f"kind = ${len(args)}")
+    if since_hours:
+        args.append(since_hours)
+        conditions.append(f"created_at >= NOW() - make_interval(hours => ${len(args)})")
+    if event_ids:
+        args.append(event_ids)
+        conditions.append(f"id = ANY(${len(args)}::bigint[])")
+    await ensure_outbox_table_once()
+    result = await Database.execute_query(
+        f"""
+        UPDATE {table}
+        SET status = 'pending', attempts = 0, next_attempt_at = NOW(),
+            last_error = NULL, processed_at = NULL
+        WHERE {' AND '.join(conditions)}
+        """,
+        *args,
+    )
+    count = int(result.split()[-1]) if result else 0
+    logging.info(f"Outbox replay: {count} event(s) re-queued (kind={kind}, status={status})")
+    worker.wake()
+    return count
+
+
+async def _claim_batch(limit: int):
+    table = get_table_name("outbox")
+    query = f"""
+        UPDATE {table}
+        SET attempts = attempts + 1,
+            next_attempt_at = NOW() + make_interval(secs => $2)
+        WHERE id IN (
+            SELECT id FROM {table}
+            WHERE status = 'pending' AND next_attempt_at <= NOW()
+              AND kind = ANY($3::text[])
+            ORDER BY priority, id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, kind, user_id, payload, attempts, created_at
+    """
+    return await Database.fetch_all(query, limit, OUTBOX_LEASE_SEC, list(_handlers))
+
+
+async def _mark_done(event_id: int) -> None:
+    table = get_table_name("outbox")
+    await Database.execute_query(
+        f"UPDATE {table} SET status = 'done', processed_at = NOW(), last_error = NULL WHERE id = $1",
+        event_id,
+    )
+
+
+async def _mark_failed(event: Dict[str, Any], error: Exception, permanent: bool) -> None:
+    table = get_table_name("outbox")
+    if permanent or event['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+        await Database.execute_query(
+            f"UPDATE {table} SET status = 'failed', processed_at = NOW(), last_error = $2 WHERE id = $1",
+            event['id'], str(error)[:1000],
+        )
+        logging.error(f"Outbox event {event['id']} ({event['kind']}) failed permanently: {error}")
+        return
+    delay = OUTBOX_RETRY_BASE_SEC * (2 ** (event['attempts'] - 1))
+    await Database.execute_query(
+        f"""
+        UPDATE {table}
+        SET next_attempt_at = NOW() + make_interval(secs => $2), last_error = $3
+        WHERE id = $1
+        """,
+        event['id'], delay, str(error)[:1000],
+    )
+    logging.warning(
+        f"Outbox event {event['id']} ({event['kind']}) attempt {event['attempts']} failed, "
+        f"retry in {delay}s: {error}"
+    )
+
+
+class OutboxWorker:
+    """Фоновый разбор outbox: по таймеру и по wake() сразу после записи события."""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self.processed = 0
+        self.failed = 0
+        self.last_lag_sec = 0.0
+
+    def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="outbox-worker")
+        logging.info("Outbox worker started")
+
+    def wake(self) -> None:
+        """Разбудить воркер (после коммита транзакции с новым событием)."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        await ensure_outbox_table_once()
+        while not self._stopping:
+            try:
+                while not self._stopping and await self.process_batch():
+                    pass
+            except Exception as e:
+                logging.error(f"Outbox worker error: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def process_batch(self) -> int:
+        """Обработать одну пачку событий. Возвращает число взятых событий."""
+        rows = await _claim_batch(OUTBOX_BATCH_SIZE)
+        if not rows:
+            return 0
+        sem = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+
+        async def _one(row) -> None:
+            async with sem:
+                await self._dispatch(dict(row))
+
+        await asyncio.gather(*(_one(r) for r in rows))
+        return len(rows)
+
+    async def _dispatch(self, event: Dict[str, Any]) -> None:
+        func = _handlers.get(event['kind'])
+        if func is None:
+            await _mark_failed(event, PermanentError(f"No handler for {event['kind']}"), permanent=True)
+            self.failed += 1
+            return
+        try:
+            await func(event)
+        except PermanentError as e:
+            await _mark_failed(event, e, permanent=True)
+            self.failed += 1
+            return
+        except Exception as e:
+            if is_send_blocked_error(e) and event.get('user_id'):
+                await update_user_blocked_status(event['user_id'], True)
+                await _mark_failed(event, e, permanent=True)
+            else:
+                # 4xx от MAX API (кроме 429) повтором не исправить
+                permanent = isinstance(e, MaxApiError) and 400 <= e.status < 500 and e.status != 429
+                await _mark_failed(event, e, permanent=permanent)
+            self.failed += 1
+            return
+        await _mark_done(event['id'])
+        self.processed += 1
+        created_at = event.get('created_at')
+        if created_at is not None:
+            self.last_lag_sec = max(0.0, time.time() - created_at.timestamp())
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Остановить воркер (текущая пачка дорабатывается, не дольше timeout)."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self.wake()
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            logging.warning("Outbox worker cancelled on shutdown (leased events will be retried)")
+        except Exception as e:
+            logging.error(f"Outbox worker failed on stop: {e}", exc_info=True)
+        self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "processed": self.processed,
+            "failed": self.failed,
+            "last_lag_sec": round(self.last_lag_sec, 3),
+        }
+
+
+worker = OutboxWorker()
+metrics.register("outbox", worker.stats)
@@ -0,0 +1,176 @@
+"""
+События об оплате через PostgreSQL LISTEN/NOTIFY.
+
+process_successful_payment() в той же транзакции делает pg_notify — PostgreSQL
+доставляет уведомление слушателям только после коммита, так что «оплата прошла»
+не придёт раньше, чем баланс реально зачислен.
+
+Процесс бота держит отдельное подключение с LISTEN и сразу реагирует на событие
+(сброс FSM оплаты, немедленный разбор outbox), даже если вебхук ЮKassa принял
+другой процесс (standalone webhook_server). Подписчики регистрируются так:
+
+    @payment_events.on_payment_succeeded
+    async def _react(event: dict): ...
+
+event — dict: payment_id, user_id, package_id.
+
+NOTIFY не хранится: пока слушатель переподключается, события теряются. Это
+допустимо — доставка уведомления гарантирована outbox (опрос по таймеру), здесь
+только ускорение реакции.
+"""
+import asyncio
+import inspect
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from main import json_codec, metrics
+from main.database import Database, get_table_name
+from main.tasks import supervisor
+
+# Пауза перед переподключением слушателя (экспоненциально до максимума)
+RECONNECT_BASE_DELAY_SEC = 1.0
+RECONNECT_MAX_DELAY_SEC = 60.0
+# Как часто проверять, что LISTEN-подключение живо
+HEALTHCHECK_INTERVAL_SEC = 30.0
+
+EventCallback = Callable[[Dict[str, Any]], Any]
+_subscribers: List[EventCallback] = []
+
+
+def channel_name() -> str:
+    """Имя канала NOTIFY (с суффиксом таблиц — тестовый и боевой бот не мешают друг другу)."""
+    return get_table_name("payment_events")
+
+
+def on_payment_succeeded(func: EventCallback) -> EventCallback:
+    """Декоратор: подписаться на успешные оплаты (функция sync или async)."""
+    _subscribers.append(func)
+    return func
+
+
+async def notify_payment_succeeded(conn, payment_id: str, user_id: int, package_id: str) -> None:
+    """
+    Отправить NOTIFY на переданном соединении — вызывать внутри транзакции зачисления.
+    """
+    payload = json_codec.dumps({
+        'payment_id': payment_id,
+        'user_id': user_id,
+        'package_id': package_id,
+    })
+    await conn.execute("SELECT pg_notify($1, $2)", channel_name(), payload)
+
+
+class PaymentEventListener:
+    """LISTEN на отдельном подключении с автоматическим переподключением."""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._conn = None
+        self._lost: Optional[asyncio.Event] = None
+        self._stopping = False
+        self.received = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.last_event_at: Optional[float] = None
+
+    def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="payment-events-listener")
+
+    async def _run(self) -> None:
+        delay = RECONNECT_BASE_DELAY_SEC
+        channel = channel_name()
+        while not self._stopping:
+            try:
+                self._lost = asyncio.Event()
+                self._conn = await Database.connect()
+                self._conn.add_termination_listener(lambda _conn: self._lost.set())
+                await self._conn.add_listener(channel, self._on_notify)
+                logging.info(f"Payment events listener: LISTEN {channel}")
+                delay = RECONNECT_BASE_DELAY_SEC
+                while not self._stopping and not self._lost.is_set():
+                    try:
+                        await asyncio.wait_for(self._lost.wait(), timeout=HEALTHCHECK_INTERVAL_SEC)
+                    except asyncio.TimeoutError:
+                        # Полуоткрытое TCP-соединение termination listener не заметит
+                        await self._conn.execute("SELECT 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logging.warning(f"Payment events listener connection lost: {e!r}")
+            finally:
+                await self._close_conn()
+            if self._stopping:
+                break
+            self.reconnects += 1
+            logging.info(f"Payment events listener: reconnecting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY_SEC)
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        try:
+            event = json_codec.loads(payload)
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Payment events: bad payload {payload!r}: {e}")
+            return
+        self.received += 1
+        self.last_event_at = time.time()
+        logging.info(f"Payment event received: payment {event.get('payment_id')} for user {event.get('user_id')}")
+        for callback in _subscribers:
+            try:
+                result = callback(event)
+                if inspect.isawaitable(result):
+                    supervisor.spawn("default", self._await_callback(callback, result), name="payment_event")
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Payment event subscriber {callback.__name__} failed: {e}", exc_info=True)
+
+    async def _await_callback(self, callback: EventCallback, awaitable) -> None:
+        try:
+            await awaitable
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Payment event subscriber {callback.__name__} failed: {e}", exc_info=True)
+
+    async def _close_conn(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is None or conn.is_closed():
+            return
+        try:
+            await asyncio.wait_for(conn.close(), timeout=5)
+        except Exception:
+            conn.terminate()
+
+    async def stop(self) -> None:
+        """Остановить слушателя и закрыть его подключение."""
+        if self._task is None:
+            return
+        self._stopping = True
+        if self._lost is not None:
+            self._lost.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=10)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+        except Exception as e:
+            logging.error(f"Payment events listener failed on stop: {e}", exc_info=True)
+        self._task = None
+        logging.info("Payment events listener stopped")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "listening": self._conn is not None and not self._conn.is_closed(),
+            "received": self.received,
+            "errors": self.errors,
+            "reconnects": self.reconnects,
+            "last_event_at": int(self.last_event_at) if self.last_event_at else None,
+        }
+
+
+listener = PaymentEventListener()
+metrics.register("payment_events", listener.stats)
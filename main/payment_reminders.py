@@ -2,57 +2,109 @@
 Автоматические напоминания о незавершённой оплате (pending / canceled).
 
 Этапы: 10 минут, 1 час, 3 часа после создания платежа.
+
+Таймеры ставятся в main/scheduled_jobs.py при создании платежа (в той же
+транзакции, что и запись платежа); в момент срабатывания задача перепроверяет
+платёж — если оплата прошла или пользователь заблокировал бота, ничего не шлём.
+Само сообщение уходит через outbox (main/messages.py): пометка этапа и запись
+в outbox — одна транзакция.
 """
-import asyncio
 import logging
 
+from main import messages, outbox, scheduled_jobs
+from main.config_reader import config
 from main.database import (
+    Database,
     PAYMENT_REMINDER_STAGES,
-    get_payment_by_id,
-    get_payments_due_for_reminder,
+    get_payment_reminder_candidate,
+    get_table_name,
     mark_payment_reminder_sent,
 )
-from send_message import send_payment_reminder
-
-REMINDER_DELAY_SEC = 0.05
-
-
-async def process_payment_reminders() -> dict:
-    """Проверить все этапы и отправить напоминания."""
-    results = {'sent': 0, 'skipped': 0, 'failed': 0}
-
-    for stage in PAYMENT_REMINDER_STAGES:
-        due = await get_payments_due_for_reminder(stage)
-        if not due:
-            continue
-
-        logging.info(f"Payment reminders ({stage}): {len(due)} payment(s) due")
-
-        for payment in due:
-            payment_id = payment['payment_id']
-            user_id = payment['user_id']
-
-            current = await get_payment_by_id(payment_id)
-            if not current or current['status'] not in ('pending', 'canceled'):
-                results['skipped'] += 1
-                continue
-
-            try:
-                success = await send_payment_reminder(user_id, stage=stage)
-                if success:
-                    await mark_payment_reminder_sent(payment_id, stage)
-                    results['sent'] += 1
-                else:
-                    results['failed'] += 1
-            except Exception as e:
-                logging.error(
-                    f"Payment reminder error ({stage}) payment={payment_id} user={user_id}: {e}",
-                    exc_info=True,
+
+JOB_KIND = 'payment_reminder'
+# Backfill при старте: платежи не старше стольких часов без поставленных таймеров
+BACKFILL_HOURS = 24
+
+
+def _dedupe_key(payment_id: str, stage: str) -> str:
+    return f"{JOB_KIND}:{payment_id}:{stage}"
+
+
+async def ensure_ready() -> None:
+    """Таблица таймеров должна существовать до транзакции create_payment."""
+    await scheduled_jobs.ensure_scheduled_jobs_table_once()
+
+
+async def schedule_payment_reminders(conn, payment_id: str, user_id: int) -> None:
+    """Поставить таймеры всех этапов (на соединении транзакции создания платежа)."""
+    if not config.payment_reminders_enabled:
+        return
+    for stage, (minutes, _) in PAYMENT_REMINDER_STAGES.items():
+        await scheduled_jobs.schedule(
+            JOB_KIND,
+            delay_sec=minutes * 60,
+            user_id=user_id,
+            payload={'payment_id': payment_id, 'stage': stage},
+            dedupe_key=_dedupe_key(payment_id, stage),
+            conn=conn,
+        )
+
+
+@scheduled_jobs.job_handler(JOB_KIND)
+async def _send_payment_reminder_job(job: dict):
+    payload = job['payload'] or {}
+    payment_id = payload.get('payment_id')
+    stage = payload.get('stage')
+    if not config.payment_reminders_enabled or stage not in PAYMENT_REMINDER_STAGES:
+        return
+
+    payment = await get_payment_reminder_candidate(payment_id, stage)
+    if not payment:
+        logging.info(f"Payment reminder ({stage}) for {payment_id} no longer needed")
+        return
+
+    await outbox.ensure_outbox_table_once()
+    pool = await Database.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if await mark_payment_reminder_sent(payment_id, stage, conn=conn):
+                await messages.enqueue(
+                    conn, payment['user_id'], 'payment_reminder', {'stage': stage},
+                    dedupe_key=_dedupe_key(payment_id, stage),
                 )
-                results['failed'] += 1
+    outbox.worker.wake()
 
-            await asyncio.sleep(REMINDER_DELAY_SEC)
 
-    if any(results.values()):
-        logging.info(f"Payment reminders job finished: {results}")
-    return results
+async def backfill_payment_reminder_jobs() -> int:
+    """
+    Поставить таймеры для недавних платежей, созданных до появления очереди
+    (или пока напоминания были выключены). Идемпотентно (dedupe_key).
+    """
+    if not config.payment_reminders_enabled:
+        return 0
+    await scheduled_jobs.ensure_scheduled_jobs_table_once()
+    payments_table = get_table_name("payments")
+    jobs_table = get_table_name("scheduled_jobs")
+    total = 0
+    try:
+        for stage, (minutes, sent_column) in PAYMENT_REMINDER_STAGES.items():
+            query = f"""
+                INSERT INTO {jobs_table} (kind, user_id, payload, run_at, dedupe_key)
+                SELECT $1::text, p.user_id,
+                       jsonb_build_object('payment_id', p.payment_id, 'stage', $2::text),
+                       GREATEST(p.created_at + make_interval(mins => $3), NOW()),
+                       $1::text || ':' || p.payment_id || ':' || $2::text
+                FROM {payments_table} p
+                WHERE p.status IN ('pending', 'canceled')
+                  AND p.{sent_column} IS NULL
+                  AND p.created_at >= NOW() - make_interval(hours => $4)
+                ON CONFLICT (dedupe_key) DO NOTHING
+            """
+            result = await Database.execute_query(query, JOB_KIND, stage, minutes, BACKFILL_HOURS)
+            total += int(result.split()[-1]) if result else 0
+        if total:
+            logging.info(f"Payment reminders backfill: {total} timer(s) scheduled")
+        return total
+    except Exception as e:
+        logging.error(f"Error backfilling payment reminder jobs: {e}", exc_info=True)
+        return total
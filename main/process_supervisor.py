@@ -0,0 +1,207 @@
+"""
+Режим нескольких процессов (BOT_SUPERVISOR=true): python bot.py запускает супервизор,
+а он — дочерние процессы (multiprocessing, spawn):
+
+- web — aiohttp (вебхуки ЮKassa, WebApp, /internal/metrics) и приём апдейтов MAX
+  вебхуком или long polling; апдейты не обрабатывает, а раскладывает по очередям
+  обработчиков (main/update_workers.py, UpdateRouter);
+- scheduler — APScheduler, воркер outbox, LISTEN событий оплаты;
+- updates-0..N-1 — обработчики апдейтов: роутеры бота и диспетчер; апдейт
+  пользователя всегда попадает в процесс user_id % N (UPDATE_WORKER_PROCESSES,
+  0 — по числу ядер минус одно).
+
+Общее состояние — в БД (идемпотентность вебхуков, outbox, отложенные задачи, claims
+cron-задач main/cluster.py) либо передаётся сообщениями через очереди: FSM
+пользователя живёт в процессе его шарда, сброс FSM из веб-процесса —
+update_workers.clear_user_state().
+
+Упавший процесс перезапускается с нарастающей паузой. Очереди обработчиков
+создаёт супервизор, поэтому апдейты, принятые до падения обработчика, дождутся его
+перезапуска. Остановка (SIGTERM/SIGINT): сначала web (прекращаем приём),
+затем обработчики (дообрабатывают очередь), последним — планировщик.
+
+Метрики /internal/metrics отдаёт веб-процесс: в них роутер апдейтов, но не
+диспетчеры обработчиков и не планировщик.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import signal
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from main.config_reader import config
+from main.update_workers import UPDATE_WORKER_QUEUE_SIZE, worker_main
+
+# Пауза перед перезапуском упавшего процесса: удваивается до максимума,
+# сбрасывается, если процесс проработал дольше RESTART_RESET_SEC
+RESTART_BACKOFF_SEC = 1.0
+RESTART_BACKOFF_MAX_SEC = 60.0
+RESTART_RESET_SEC = 300.0
+# Сколько ждать завершения процесса при остановке
+STOP_TIMEOUT_SEC = 30.0
+
+
+def install_stop_signals() -> None:
+    """
+    В дочернем процессе: SIGTERM отменяет главную задачу (срабатывают finally
+    с закрытием ресурсов), SIGINT игнорируется — Ctrl+C получает вся группа
+    процессов, а порядок остановки задаёт супервизор.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+
+
+def _run_role(coro_factory: Callable) -> None:
+    logging.basicConfig(filename="bot.log", encoding="utf-8", level=logging.INFO)
+
+    async def _main():
+        install_stop_signals()
+        await coro_factory()
+
+    try:
+        asyncio.run(_main())
+    except asyncio.CancelledError:
+        pass
+
+
+def _web_main(queues: list) -> None:
+    """Точка входа веб-процесса."""
+    import bot
+    _run_role(lambda: bot.run_web_role(queues))
+
+
+def _scheduler_main() -> None:
+    """Точка входа процесса планировщика."""
+    import bot
+    _run_role(bot.run_scheduler_role)
+
+
+class _Child:
+    """Описание дочернего процесса и его состояние для перезапусков."""
+
+    def __init__(self, name: str, target: Callable, args: Tuple = ()):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.backoff = RESTART_BACKOFF_SEC
+        self.restart_at: Optional[float] = None
+
+
+class ProcessSupervisor:
+    """Запуск, перезапуск и упорядоченная остановка процессов бота."""
+
+    def __init__(self, update_processes: int):
+        self._ctx = multiprocessing.get_context("spawn")
+        self.queues = [self._ctx.Queue(UPDATE_WORKER_QUEUE_SIZE) for _ in range(max(1, update_processes))]
+        self.web = _Child("web", _web_main, (self.queues,))
+        self.scheduler = _Child("scheduler", _scheduler_main)
+        self.workers = [
+            _Child(f"updates-{index}", worker_main, (index, q)) for index, q in enumerate(self.queues)
+        ]
+        self._stopping = False
+
+    @property
+    def children(self) -> List[_Child]:
+        return [self.scheduler, *self.workers, self.web]
+
+    def _spawn(self, child: _Child) -> None:
+        child.process = self._ctx.Process(target=child.target, args=child.args, name=child.name)
+        child.process.start()
+        child.started_at = time.monotonic()
+        child.restart_at = None
+        logging.info(f"Supervisor: started {child.name} (pid {child.process.pid})")
+
+    def start(self) -> None:
+        # Обработчики — до веб-процесса, чтобы первые апдейты не ждали их запуска
+        for child in self.children:
+            self._spawn(child)
+
+    def _check(self, child: _Child) -> None:
+        if child.process is None or child.process.is_alive():
+            return
+        now = time.monotonic()
+        if child.restart_at is None:
+            if now - child.started_at > RESTART_RESET_SEC:
+                child.backoff = RESTART_BACKOFF_SEC
+            child.restart_at = now + child.backoff
+            logging.error(
+                f"Supervisor: {child.name} exited with code {child.process.exitcode}, "
+                f"restarting in {child.backoff:.0f}s"
+            )
+            child.backoff = min(child.backoff * 2, RESTART_BACKOFF_MAX_SEC)
+        elif now >= child.restart_at:
+            child.restarts += 1
+            self._spawn(child)
+
+    async def monitor(self) -> None:
+        while not self._stopping:
+            for child in self.children:
+                self._check(child)
+            await asyncio.sleep(1)
+
+    async def _stop_child(self, child: _Child, sentinel=None) -> None:
+        """Остановить процесс: sentinel — очередь, в которую отправить None, иначе SIGTERM."""
+        process = child.process
+        if process is None or not process.is_alive():
+            return
+        if sentinel is not None:
+            try:
+                sentinel.put(None, timeout=1)
+            except queue_module.Full:
+                process.terminate()
+        else:
+            process.terminate()
+        await asyncio.get_running_loop().run_in_executor(None, process.join, STOP_TIMEOUT_SEC)
+        if process.is_alive():
+            logging.warning(f"Supervisor: {child.name} did not stop in {STOP_TIMEOUT_SEC:.0f}s, killing")
+            process.kill()
+        logging.info(f"Supervisor: {child.name} stopped")
+
+    async def stop(self) -> None:
+        """Веб → обработчики (дообрабатывают очередь) → планировщик."""
+        self._stopping = True
+        await self._stop_child(self.web)
+        await asyncio.gather(*(self._stop_child(w, w.args[1]) for w in self.workers))
+        await self._stop_child(self.scheduler)
+
+    def stats(self) -> Dict[str, Dict]:
+        return {
+            child.name: {
+                "pid": child.process.pid if child.process else None,
+                "alive": bool(child.process and child.process.is_alive()),
+                "restarts": child.restarts,
+            }
+            for child in self.children
+        }
+
+
+async def _supervise() -> None:
+    processes = config.update_worker_processes or max(1, (os.cpu_count() or 2) - 1)
+    supervisor = ProcessSupervisor(processes)
+    supervisor.start()
+    logging.info(f"Supervisor started: web, scheduler and {processes} update worker(s)")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    monitor = asyncio.create_task(supervisor.monitor())
+    await stop.wait()
+    logging.info("Supervisor: stopping")
+    monitor.cancel()
+    await supervisor.stop()
+    logging.info(f"Supervisor stopped: {supervisor.stats()}")
+
+
+def run_supervisor() -> None:
+    """Точка входа режима BOT_SUPERVISOR (python bot.py)."""
+    logging.basicConfig(filename="bot.log", encoding="utf-8", level=logging.INFO)
+    asyncio.run(_supervise())
@@ -0,0 +1,138 @@
+"""
+Сверка зависших pending-платежей с ЮKassa (задача планировщика).
+
+Если вебхук не дошёл, платёж остаётся pending — сверка спрашивает реальный статус
+у ЮKassa и зачисляет оплату / отмечает отмену.
+
+- параллельно, не больше RECONCILE_CONCURRENCY запросов к ЮKassa одновременно;
+- постранично по курсору (created_at, id) — без загрузки всего хвоста в память;
+- бюджет времени на запуск — недосмотренное подхватит следующий тик;
+- запуски не пересекаются (lock в процессе + max_instances=1 в APScheduler);
+- отставание (сколько осталось и возраст самого старого) — в лог и /internal/metrics.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from main import metrics
+from main.database import (
+    count_stale_pending_payments,
+    get_stale_pending_payments,
+    process_successful_payment,
+    update_payment_status,
+)
+
+# Платёж считается зависшим через столько минут в pending
+STALE_AFTER_MIN = 15
+RECONCILE_CONCURRENCY = 5
+RECONCILE_PAGE_SIZE = 100
+# Бюджет времени на один запуск (интервал задачи — 10 минут)
+RECONCILE_TIME_BUDGET_SEC = 8 * 60
+
+_lock = asyncio.Lock()
+_last_run: Dict[str, Any] = {}
+# Если прошлый запуск упёрся в бюджет — следующий продолжает с этого курсора,
+# чтобы хвост не голодал из-за одних и тех же старых платежей в начале списка
+_resume_cursor: Optional[tuple] = None
+
+
+async def _reconcile_one(payment: Dict[str, Any], results: Dict[str, int]) -> None:
+    from handlers.pay import check_payment_status
+
+    pid = payment['payment_id']
+    try:
+        info = await check_payment_status(pid)
+        actual_status = info.get('status')
+
+        if actual_status == 'succeeded':
+            # notify=True: вебхук потерян — пользователь узнаёт об оплате только отсюда
+            # (для уже succeeded платежа process_successful_payment выходит раньше, дублей нет)
+            await process_successful_payment(pid, yookassa_metadata=info, notify=True)
+            results['succeeded'] += 1
+            logging.info(f"Reconciliation: payment {pid} -> succeeded, balance updated")
+        elif actual_status == 'canceled':
+            await update_payment_status(pid, 'canceled')
+            results['canceled'] += 1
+            logging.info(f"Reconciliation: payment {pid} -> canceled")
+        else:
+            results['still_pending'] += 1
+    except Exception as e:
+        results['errors'] += 1
+        logging.error(f"Reconciliation error for {pid}: {e}", exc_info=True)
+
+
+async def reconcile_pending_payments(
+    time_budget_sec: float = RECONCILE_TIME_BUDGET_SEC,
+    concurrency: int = RECONCILE_CONCURRENCY,
+    page_size: int = RECONCILE_PAGE_SIZE,
+) -> Optional[Dict[str, Any]]:
+    """
+    Один проход сверки. Возвращает результаты или None, если предыдущий проход ещё идёт.
+    """
+    global _resume_cursor
+    if _lock.locked():
+        logging.warning("Reconciliation: previous run still in progress, skipping tick")
+        return None
+
+    async with _lock:
+        started = time.monotonic()
+        deadline = started + time_budget_sec
+        results = {'checked': 0, 'succeeded': 0, 'canceled': 0, 'still_pending': 0, 'errors': 0}
+        sem = asyncio.Semaphore(concurrency)
+        cursor: Optional[tuple] = _resume_cursor
+        budget_exhausted = False
+
+        async def _bounded(payment):
+            async with sem:
+                if time.monotonic() >= deadline:
+                    return False
+                await _reconcile_one(payment, results)
+                results['checked'] += 1
+                return True
+
+        while True:
+            if time.monotonic() >= deadline:
+                budget_exhausted = True
+                break
+            page = await get_stale_pending_payments(
+                minutes=STALE_AFTER_MIN, after=cursor, limit=page_size
+            )
+            if not page:
+                break
+            done = await asyncio.gather(*(_bounded(p) for p in page))
+            # Курсор — по последнему реально проверенному платежу (порядок страницы сохранён)
+            checked = [p for p, ok in zip(page, done) if ok]
+            if checked:
+                cursor = (checked[-1]['created_at'], checked[-1]['id'])
+            if len(checked) < len(page):
+                budget_exhausted = True
+                break
+            if len(page) < page_size:
+                break
+
+        backlog = {'count': 0, 'oldest': None}
+        if budget_exhausted:
+            backlog = await count_stale_pending_payments(minutes=STALE_AFTER_MIN, after=cursor)
+        _resume_cursor = cursor if budget_exhausted else None
+
+        oldest = backlog['oldest']
+        results['backlog'] = backlog['count']
+        results['lag_sec'] = int((datetime.now() - oldest).total_seconds()) if oldest else 0
+        results['duration_sec'] = round(time.monotonic() - started, 1)
+
+        _last_run.clear()
+        _last_run.update(results, finished_at=int(time.time()))
+
+        if results['checked'] or results['backlog']:
+            logging.info(f"Reconciliation completed: {results}")
+        if results['backlog']:
+            logging.warning(
+                f"Reconciliation behind: {results['backlog']} stale payment(s) not checked this run, "
+                f"oldest waiting {results['lag_sec']}s"
+            )
+        return results
+
+
+metrics.register("reconciliation", lambda: {"running": _lock.locked(), **_last_run})
@@ -0,0 +1,280 @@
+"""
+Отложенные задачи на пользователя (таймеры): «через 10 минут после платежа»,
+«через 24 часа после регистрации» и т.п.
+
+Задача ставится в таблицу scheduled_jobs в момент события (платёж создан,
+пользователь зарегистрирован) с временем запуска run_at. Тик планировщика
+забирает только наступившие задачи по частичному индексу (run_at WHERE pending)
+через FOR UPDATE SKIP LOCKED — стоимость тика O(наступивших задач), а не
+полный проход по платежам/пользователям.
+
+Обработчики регистрируются по типу задачи:
+
+    @scheduled_jobs.job_handler("payment_reminder")
+    async def _remind(job: dict): ...
+
+job — dict: id, kind, user_id, payload, attempts, lag_sec (сколько секунд задача ждала после run_at).
+Обработчик сам перепроверяет актуальность (оплата могла пройти) и может
+перенести задачу: raise Reschedule(delay_sec).
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from main import metrics
+from main.database import (
+    Database, get_table_name, is_send_blocked_error, update_user_blocked_status,
+)
+
+# Пачка задач за один проход и параллельность их обработки
+JOBS_BATCH_SIZE = 100
+JOBS_CONCURRENCY = 5
+# Бюджет одного тика (тик — раз в минуту)
+JOBS_TICK_BUDGET_SEC = 50
+# Аренда: столько секунд взятую задачу не возьмёт другой тик/инстанс
+JOBS_LEASE_SEC = 300
+JOBS_MAX_ATTEMPTS = 5
+JOBS_RETRY_BASE_SEC = 60
+# Сколько дней хранить выполненные задачи (dedupe_key защищает от повторной постановки)
+RETENTION_DAYS = 30
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+_handlers: Dict[str, JobHandler] = {}
+
+
+class Reschedule(Exception):
+    """Перенести задачу на delay_sec секунд (не ошибка, попытка не тратится)."""
+
+    def __init__(self, delay_sec: float):
+        self.delay_sec = max(0.0, float(delay_sec))
+        super().__init__(f"rescheduled in {self.delay_sec:.0f}s")
+
+
+def job_handler(kind: str):
+    """Декоратор: зарегистрировать обработчик задач типа kind."""
+    def decorator(func: JobHandler) -> JobHandler:
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+async def ensure_scheduled_jobs_table():
+    """Создать таблицу scheduled_jobs если не существует"""
+    table = get_table_name("scheduled_jobs")
+    query = f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id BIGSERIAL PRIMARY KEY,
+            kind VARCHAR(50) NOT NULL,
+            user_id BIGINT NULL,
+            payload JSONB NOT NULL DEFAULT '{{}}'::jsonb,
+            run_at TIMESTAMP NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            dedupe_key VARCHAR(255) NULL UNIQUE,
+            last_error TEXT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            processed_at TIMESTAMP NULL
+        )
+    """
+    index_query = f"""
+        CREATE INDEX IF NOT EXISTS idx_{table}_due
+            ON {table}(run_at) WHERE status = 'pending'
+    """
+    try:
+        await Database.execute_query(query)
+        await Database.execute_query(index_query)
+    except Exception as e:
+        logging.error(f"Error creating scheduled_jobs table: {e}", exc_info=True)
+
+
+_table_ready = False
+
+
+async def ensure_scheduled_jobs_table_once():
+    global _table_ready
+    if not _table_ready:
+        await ensure_scheduled_jobs_table()
+        _table_ready = True
+
+
+async def schedule(
+    kind: str,
+    delay_sec: float = 0,
+    user_id: Optional[int] = None,
+    payload: Optional[Dict[str, Any]] = None,
+    dedupe_key: Optional[str] = None,
+    conn=None,
+) -> Optional[int]:
+    """
+    Поставить задачу на NOW() + delay_sec.
+    conn — выполнить на переданном соединении (внутри транзакции события).
+    С dedupe_key повторная постановка игнорируется. Возвращает id или None.
+    """
+    table = get_table_name("scheduled_jobs")
+    query = f"""
+        INSERT INTO {table} (kind, user_id, payload, run_at, dedupe_key)
+        VALUES ($1, $2, $3, NOW() + make_interval(secs => $4), $5)
+        ON CONFLICT (dedupe_key) DO NOTHING
+        RETURNING id
+    """
+    args = (kind, user_id, payload or {}, float(delay_sec), dedupe_key)
+    if conn is not None:
+        return await conn.fetchval(query, *args)
+    await ensure_scheduled_jobs_table_once()
+    return await Database.fetchval(query, *args)
+
+
+async def cancel(dedupe_key: str) -> None:
+    """Отменить ещё не выполненную задачу по ключу."""
+    table = get_table_name("scheduled_jobs")
+    await Database.execute_query(
+        f"UPDATE {table} SET status = 'canceled', processed_at = NOW() "
+        f"WHERE dedupe_key = $1 AND status = 'pending'",
+        dedupe_key,
+    )
+
+
+async def _claim_due(limit: int):
+    table = get_table_name("scheduled_jobs")
+    query = f"""
+        UPDATE {table} j
+        SET attempts = j.attempts + 1,
+            run_at = NOW() + make_interval(secs => $2)
+        FROM (
+            SELECT id, run_at FROM {table}
+            WHERE status = 'pending' AND run_at <= NOW()
+            ORDER BY run_at
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        ) due
+        WHERE j.id = due.id
+        RETURNING j.id, j.kind, j.user_id, j.payload, j.attempts,
+                  EXTRACT(EPOCH FROM NOW() - due.run_at)::float8 AS lag_sec
+    """
+    return await Database.fetch_all(query, limit, JOBS_LEASE_SEC)
+
+
+async def _mark_done(job_id: int) -> None:
+    table = get_table_name("scheduled_jobs")
+    await Database.execute_query(
+        f"UPDATE {table} SET status = 'done', processed_at = NOW(), last_error = NULL WHERE id = $1",
+        job_id,
+    )
+
+
+async def _reschedule(job: Dict[str, Any], delay_sec: float) -> None:
+    table = get_table_name("scheduled_jobs")
+    # Перенос — не попытка: возвращаем счётчик, увеличенный при захвате
+    await Database.execute_query(
+        f"""
+        UPDATE {table}
+        SET run_at = NOW() + make_interval(secs => $2), attempts = GREATEST(attempts - 1, 0)
+        WHERE id = $1
+        """,
+        job['id'], delay_sec,
+    )
+
+
+async def _mark_failed(job: Dict[str, Any], error: Exception, permanent: bool) -> None:
+    table = get_table_name("scheduled_jobs")
+    if permanent or job['attempts'] >= JOBS_MAX_ATTEMPTS:
+        await Database.execute_query(
+            f"UPDATE {table} SET status = 'failed', processed_at = NOW(), last_error = $2 WHERE id = $1",
+            job['id'], str(error)[:1000],
+        )
+        logging.error(f"Scheduled job {job['id']} ({job['kind']}) failed permanently: {error}")
+        return
+    delay = JOBS_RETRY_BASE_SEC * (2 ** (job['attempts'] - 1))
+    await Database.execute_query(
+        f"UPDATE {table} SET run_at = NOW() + make_interval(secs => $2), last_error = $3 WHERE id = $1",
+        job['id'], delay, str(error)[:1000],
+    )
+    logging.warning(
+        f"Scheduled job {job['id']} ({job['kind']}) attempt {job['attempts']} failed, "
+        f"retry in {delay}s: {error}"
+    )
+
+
+_stats: Dict[str, Any] = {'processed': 0, 'failed': 0, 'rescheduled': 0, 'last_lag_sec': 0.0}
+_lock = asyncio.Lock()
+
+
+async def _dispatch(job: Dict[str, Any]) -> None:
+    func = _handlers.get(job['kind'])
+    if func is None:
+        await _mark_failed(job, Exception(f"No handler for {job['kind']}"), permanent=True)
+        _stats['failed'] += 1
+        return
+    try:
+        await func(job)
+    except Reschedule as r:
+        await _reschedule(job, r.delay_sec)
+        _stats['rescheduled'] += 1
+        return
+    except Exception as e:
+        permanent = False
+        if is_send_blocked_error(e) and job.get('user_id'):
+            await update_user_blocked_status(job['user_id'], True)
+            permanent = True
+        await _mark_failed(job, e, permanent=permanent)
+        _stats['failed'] += 1
+        return
+    await _mark_done(job['id'])
+    _stats['processed'] += 1
+
+
+async def run_due_jobs(time_budget_sec: float = JOBS_TICK_BUDGET_SEC) -> Optional[Dict[str, int]]:
+    """
+    Один тик: выполнить наступившие задачи (пачками, пока есть и пока не вышел бюджет).
+    Возвращает счётчики или None, если предыдущий тик ещё идёт.
+    """
+    if _lock.locked():
+        return None
+    async with _lock:
+        await ensure_scheduled_jobs_table_once()
+        deadline = time.monotonic() + time_budget_sec
+        sem = asyncio.Semaphore(JOBS_CONCURRENCY)
+        claimed = 0
+
+        async def _one(row) -> None:
+            async with sem:
+                try:
+                    await _dispatch(dict(row))
+                except Exception as e:
+                    # Не записали результат (ошибка БД) — задача вернётся в работу
+                    # по истечении аренды, остальные задачи пачки выполняются дальше
+                    logging.error(f"Scheduled job {row['id']} ({row['kind']}) bookkeeping failed: {e}",
+                                  exc_info=True)
+
+        while time.monotonic() < deadline:
+            rows = await _claim_due(JOBS_BATCH_SIZE)
+            if not rows:
+                break
+            claimed += len(rows)
+            # Задержка считается в БД: NOW() и run_at — в одной временной зоне сессии
+            _stats['last_lag_sec'] = max(0.0, max(r['lag_sec'] for r in rows))
+            await asyncio.gather(*(_one(r) for r in rows))
+            if len(rows) < JOBS_BATCH_SIZE:
+                break
+        return {'claimed': claimed}
+
+
+async def cleanup_scheduled_jobs(days: int = RETENTION_DAYS) -> int:
+    """Удалить завершённые задачи старше days дней. Возвращает число удалённых строк."""
+    table = get_table_name("scheduled_jobs")
+    try:
+        await ensure_scheduled_jobs_table_once()
+        result = await Database.execute_query(
+            f"DELETE FROM {table} WHERE status <> 'pending' "
+            f"AND processed_at < NOW() - make_interval(days => $1)",
+            days,
+        )
+        return int(result.split()[-1]) if result else 0
+    except Exception as e:
+        logging.error(f"Error cleaning up scheduled_jobs: {e}", exc_info=True)
+        return 0
+
+
+metrics.register("scheduled_jobs", lambda: {"running": _lock.locked(), **_stats,
+                                             "last_lag_sec": round(_stats['last_lag_sec'], 1)})
@@ -0,0 +1,154 @@
+"""
+Супервизор фоновых задач (fire-and-forget).
+
+Вместо голых asyncio.create_task / ensure_future:
+  - держит ссылки на задачи (GC не съест незавершённую задачу);
+  - именованные пулы с ограничением одновременно выполняемых задач и длины очереди;
+  - метрики по пулам (queued / running / completed / failed / rejected / длительность);
+  - drain() при остановке — дождаться задач в работе, остальное отменить.
+
+    from main.tasks import supervisor
+    supervisor.spawn("default", some_coroutine(), name="some_job")
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Coroutine, Dict, Optional, Set
+
+from main import metrics
+
+# Пулы по умолчанию: имя -> (одновременно выполняется, максимум задач в пуле вместе с ожидающими)
+DEFAULT_POOLS = {
+    "default": (20, 1000),
+}
+
+
+class TaskPool:
+    """Пул задач с семафором и счётчиками."""
+
+    def __init__(self, name: str, max_concurrency: int, max_pending: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.tasks: Set[asyncio.Task] = set()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+
+    async def _run(self, coro: Coroutine, task_name: str) -> Any:
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        except BaseException:
+            self.queued -= 1
+            coro.close()
+            raise
+        self.queued -= 1
+        self.running += 1
+        started = time.monotonic()
+        try:
+            result = await coro
+            self.completed += 1
+            return result
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Background task {self.name}/{task_name} failed: {e}", exc_info=True)
+        finally:
+            duration = time.monotonic() - started
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+            self.running -= 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.completed + self.failed
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_pending": self.max_pending,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+            "avg_duration_sec": round(self.total_duration / finished, 3) if finished else 0.0,
+            "max_duration_sec": round(self.max_duration, 3),
+        }
+
+
+class TaskSupervisor:
+    """Набор именованных пулов фоновых задач процесса."""
+
+    def __init__(self):
+        self._pools: Dict[str, TaskPool] = {}
+        self._closing = False
+        for name, (max_concurrency, max_pending) in DEFAULT_POOLS.items():
+            self.configure(name, max_concurrency, max_pending)
+
+    def configure(self, name: str, max_concurrency: int, max_pending: int) -> TaskPool:
+        """Создать пул (или пересоздать пустой с новыми лимитами)."""
+        pool = self._pools.get(name)
+        if pool is not None and pool.tasks:
+            logging.warning(f"Task pool {name} is busy, limits not changed")
+            return pool
+        pool = TaskPool(name, max_concurrency, max_pending)
+        self._pools[name] = pool
+        return pool
+
+    def spawn(self, pool_name: str, coro: Coroutine, *, name: Optional[str] = None) -> Optional[asyncio.Task]:
+        """
+        Запустить корутину в фоне в пуле pool_name.
+        Возвращает задачу или None, если пул переполнен / идёт остановка
+        (корутина при этом закрывается, не выполняясь).
+        """
+        pool = self._pools.get(pool_name) or self._pools["default"]
+        task_name = name or getattr(coro, "__name__", "task")
+        if self._closing or len(pool.tasks) >= pool.max_pending:
+            pool.rejected += 1
+            coro.close()
+            logging.warning(
+                f"Background task {pool.name}/{task_name} rejected "
+                f"({'shutting down' if self._closing else f'pool full: {len(pool.tasks)}'})"
+            )
+            return None
+        task = asyncio.get_running_loop().create_task(
+            pool._run(coro, task_name), name=f"{pool.name}:{task_name}"
+        )
+        pool.tasks.add(task)
+        task.add_done_callback(pool.tasks.discard)
+        return task
+
+    def has_capacity(self, pool_name: str) -> bool:
+        """Есть ли место в пуле (для отказа с 429/сообщением ещё до запуска работы)."""
+        pool = self._pools.get(pool_name) or self._pools["default"]
+        return not self._closing and len(pool.tasks) < pool.max_pending
+
+    async def drain(self, timeout: float = 30.0) -> None:
+        """Перестать принимать задачи, дождаться текущих (не дольше timeout), остальные отменить."""
+        self._closing = True
+        pending = {t for pool in self._pools.values() for t in pool.tasks}
+        if not pending:
+            return
+        logging.info(f"Task supervisor: waiting for {len(pending)} background task(s)")
+        done, pending = await asyncio.wait(pending, timeout=timeout)
+        if pending:
+            logging.warning(f"Task supervisor: cancelling {len(pending)} task(s) after {timeout}s")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+
+supervisor = TaskSupervisor()
+metrics.register("tasks", supervisor.stats)
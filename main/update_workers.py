@@ -0,0 +1,230 @@
+"""
+Процессы-обработчики апдейтов, шардированные по user_id.
+
+Один event loop упирается в одно ядро: расклад — это склейка картинок (Pillow)
+и форматирование ответа LLM. Обработчики апдейтов выносятся в N процессов (spawn),
+в каждом — свой цикл с роутерами бота, диспетчером (main/dispatcher.py), пулом БД
+и сессией бота. Апдейт пользователя всегда уходит в процесс user_id % N: FSM
+пользователя (bot.storage, в памяти процесса) и порядок его апдейтов остаются
+в одном процессе.
+
+- UpdateRouter — отправляющая сторона: очереди процессов (multiprocessing.Queue,
+  ограничены UPDATE_WORKER_QUEUE_SIZE) и выбор шарда. Им пользуется процесс приёма
+  апдейтов (вебхук main/max_webhook.py или long polling).
+- UpdateWorkerPool — роутер, который сам запускает процессы и перезапускает
+  упавший при следующем апдейте его шарда (режим webhook в одном процессе,
+  UPDATE_WORKER_PROCESSES). В режиме BOT_SUPERVISOR процессы запускает и
+  перезапускает main/process_supervisor.py.
+
+Изменения FSM из других процессов (веб-процесс после гадания из WebApp) тоже идут
+через очередь шарда — управляющим сообщением, по порядку с апдейтами пользователя:
+clear_user_state(user_id).
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue as queue_module
+from typing import Any, Dict, List, Optional
+
+from main import metrics
+from main.dispatcher import update_user_id
+
+# Максимум апдейтов в очереди одного процесса
+UPDATE_WORKER_QUEUE_SIZE = 1000
+# Сколько ждать завершения процессов при остановке
+UPDATE_WORKER_STOP_TIMEOUT_SEC = 30
+
+# Управляющие сообщения процессу-обработчику (не апдейты MAX)
+CONTROL_KEY = 'control'
+CONTROL_FSM_CLEAR = 'fsm_clear'
+
+
+def worker_main(index: int, updates: "multiprocessing.Queue") -> None:
+    """Точка входа процесса-обработчика."""
+    logging.basicConfig(filename="bot.log", encoding="utf-8", level=logging.INFO)
+    try:
+        asyncio.run(_worker_loop(index, updates))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+def _handle_control(message: dict) -> None:
+    from main.botdef import bot
+
+    if message.get(CONTROL_KEY) == CONTROL_FSM_CLEAR:
+        bot.storage.clear(message['user_id'])
+        logging.info(f"FSM state cleared for user {message['user_id']} (control message)")
+    else:
+        logging.warning(f"Unknown update worker control message: {message}")
+
+
+async def _worker_loop(index: int, updates: "multiprocessing.Queue") -> None:
+    from bot import close_resources, setup_routers
+    from main import payment_events
+    from main.botdef import bot
+    from main.dispatcher import dispatcher
+    from main.max_webhook import close_bot_session, open_bot_session
+    from main.process_supervisor import install_stop_signals
+
+    install_stop_signals()
+    setup_routers()
+    dispatcher.install(bot)
+    await open_bot_session()
+    # Сброс FSM после оплаты — в процессе, где живёт FSM пользователя
+    payment_events.listener.start()
+    logging.info(f"Update worker {index} started")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                # С таймаутом: поток executor не держит процесс после отмены цикла (SIGTERM)
+                update = await loop.run_in_executor(None, updates.get, True, 1.0)
+            except queue_module.Empty:
+                continue
+            if update is None:
+                break
+            if CONTROL_KEY in update:
+                _handle_control(update)
+                continue
+            await bot.handle_update(update)
+    finally:
+        await close_resources()
+        await close_bot_session()
+        logging.info(f"Update worker {index} stopped")
+
+
+class UpdateRouter:
+    """Очереди процессов-обработчиков; апдейт пользователя — в очередь user_id % N."""
+
+    def __init__(self, queues: List[Any]):
+        self._queues = queues
+        self.size = len(queues)
+        self.submitted = [0] * self.size
+        self.rejected = 0
+
+    def shard(self, update: dict) -> int:
+        user_id = update_user_id(update)
+        return user_id % self.size if user_id is not None else 0
+
+    def submit(self, update: dict) -> bool:
+        """Отдать апдейт процессу своего шарда. False — очередь процесса переполнена."""
+        index = self.shard(update)
+        try:
+            self._queues[index].put_nowait(update)
+        except queue_module.Full:
+            self.rejected += 1
+            logging.warning(f"Update worker {index} queue is full, update rejected")
+            return False
+        self.submitted[index] += 1
+        return True
+
+    async def put(self, update: dict) -> None:
+        """Отдать апдейт, дожидаясь места в очереди (long polling: апдейт нельзя отбросить)."""
+        index = self.shard(update)
+        while True:
+            try:
+                self._queues[index].put_nowait(update)
+                break
+            except queue_module.Full:
+                await asyncio.sleep(0.1)
+        self.submitted[index] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        depths = []
+        for q in self._queues:
+            try:
+                depths.append(q.qsize())
+            except NotImplementedError:  # macOS
+                depths.append(None)
+        return {
+            "processes": self.size,
+            "queued": depths,
+            "submitted": list(self.submitted),
+            "rejected": self.rejected,
+        }
+
+
+class UpdateWorkerPool(UpdateRouter):
+    """Роутер, который сам запускает процессы-обработчики (режим webhook без супервизора)."""
+
+    def __init__(self, processes: int, queue_size: int = UPDATE_WORKER_QUEUE_SIZE):
+        self._ctx = multiprocessing.get_context("spawn")
+        super().__init__([self._ctx.Queue(queue_size) for _ in range(max(1, processes))])
+        self._processes: List[Optional[multiprocessing.process.BaseProcess]] = [None] * self.size
+        self.restarts = 0
+
+    def _spawn(self, index: int) -> None:
+        process = self._ctx.Process(
+            target=worker_main, args=(index, self._queues[index]),
+            name=f"update-worker-{index}", daemon=False,
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self) -> None:
+        for index in range(self.size):
+            self._spawn(index)
+        logging.info(f"Update worker pool started: {self.size} process(es)")
+
+    def submit(self, update: dict) -> bool:
+        index = self.shard(update)
+        process = self._processes[index]
+        if process is None or not process.is_alive():
+            logging.error(f"Update worker {index} is not running, restarting")
+            self.restarts += 1
+            self._spawn(index)
+        return super().submit(update)
+
+    async def stop(self, timeout: float = UPDATE_WORKER_STOP_TIMEOUT_SEC) -> None:
+        """Попросить процессы завершиться (дообработав очередь) и дождаться их."""
+        loop = asyncio.get_running_loop()
+        for index, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                try:
+                    self._queues[index].put(None, timeout=1)
+                except queue_module.Full:
+                    process.terminate()
+        for process in self._processes:
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logging.warning(f"{process.name} did not stop in {timeout}s, terminating")
+                process.terminate()
+        logging.info("Update worker pool stopped")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **super().stats(),
+            "alive": sum(1 for p in self._processes if p is not None and p.is_alive()),
+            "restarts": self.restarts,
+        }
+
+
+_router: Optional[UpdateRouter] = None
+
+
+def set_router(router: UpdateRouter) -> None:
+    """Этот процесс принимает апдейты и отдаёт их процессам-обработчикам через router."""
+    global _router
+    _router = router
+    metrics.register("update_workers", router.stats)
+
+
+def start_pool(processes: int) -> UpdateWorkerPool:
+    """Запустить пул процессов-обработчиков в этом процессе."""
+    pool = UpdateWorkerPool(processes)
+    pool.start()
+    set_router(pool)
+    return pool
+
+
+def clear_user_state(user_id: int) -> None:
+    """Сбросить FSM пользователя там, где он живёт: в процессе его шарда или в этом процессе."""
+    if _router is not None:
+        if not _router.submit({CONTROL_KEY: CONTROL_FSM_CLEAR, 'user_id': user_id}):
+            logging.error(f"Could not send FSM clear for user {user_id}: worker queue is full")
+        return
+    from main.botdef import bot
+    bot.storage.clear(user_id)
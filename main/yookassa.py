@@ -0,0 +1,160 @@
+"""
+Клиент API ЮKassa: одна aiohttp-сессия на процесс, таймауты, повторы с джиттером.
+
+- GET (статус платежа) повторяется при сетевых ошибках, 429 и 5xx;
+- POST (создание платежа) повторяется с тем же Idempotence-Key — ЮKassa вернёт
+  уже созданный платёж, а не создаст второй;
+- метрики (число запросов, ошибки, повторы, латентность) — в /internal/metrics.
+
+Базовый URL настраивается (YOOKASSA_API_URL) — для проверки против локального
+фейкового сервера ЮKassa: scripts/yookassa_stub_server.py (создание и статус
+платежа, 429 и 5xx с заданной долей).
+"""
+import asyncio
+import base64
+import logging
+import random
+import time
+import uuid
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+import aiohttp
+
+from main import metrics
+from main.config_reader import config
+
+# Таймауты: на установку соединения и на весь запрос (секунды)
+CONNECT_TIMEOUT_SEC = 5
+TOTAL_TIMEOUT_SEC = 20
+# Повторы: всего попыток и база экспоненциальной паузы (с полным джиттером)
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY_SEC = 0.5
+RETRY_MAX_DELAY_SEC = 5.0
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class YooKassaError(Exception):
+    """Ошибка ответа API ЮKassa."""
+
+    def __init__(self, status: int, body: str):
+        self.status = status
+        self.body = body
+        super().__init__(f"YooKassa error: {status}")
+
+
+class _OpStats:
+    """Счётчики одной операции API."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.latencies: Deque[float] = deque(maxlen=500)
+
+    def to_dict(self) -> Dict[str, Any]:
+        lat = sorted(self.latencies)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "error_rate": round(self.errors / self.requests, 4) if self.requests else 0.0,
+            "latency_avg_ms": round(sum(lat) / len(lat) * 1000, 1) if lat else 0.0,
+            "latency_p95_ms": round(lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000, 1) if lat else 0.0,
+        }
+
+
+class YooKassaClient:
+    """Клиент API ЮKassa с постоянной сессией и повторами."""
+
+    def __init__(self, shop_id: str, secret_key: str, base_url: str = "https://api.yookassa.ru/v3"):
+        self.base_url = base_url.rstrip("/")
+        self._auth = "Basic " + base64.b64encode(f"{shop_id}:{secret_key}".encode()).decode()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._stats: Dict[str, _OpStats] = {"create_payment": _OpStats(), "get_payment": _OpStats()}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=TOTAL_TIMEOUT_SEC, connect=CONNECT_TIMEOUT_SEC),
+                headers={"Authorization": self._auth, "Content-Type": "application/json"},
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, op: str, method: str, path: str, *, json_body=None,
+                       headers: Optional[Dict[str, str]] = None, ok_statuses=(200,)) -> dict:
+        stats = self._stats[op]
+        url = f"{self.base_url}{path}"
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            stats.requests += 1
+            started = time.monotonic()
+            retry_after: Optional[float] = None
+            try:
+                async with self._get_session().request(method, url, json=json_body, headers=headers) as resp:
+                    if resp.status in ok_statuses:
+                        data = await resp.json(content_type=None)
+                        stats.latencies.append(time.monotonic() - started)
+                        return data
+                    body = await resp.text()
+                    error: Exception = YooKassaError(resp.status, body)
+                    retryable = resp.status in _RETRY_STATUSES
+                    if resp.headers.get("Retry-After", "").isdigit():
+                        retry_after = float(resp.headers["Retry-After"])
+                    logging.error(f"YooKassa {op} error: {resp.status} - {body[:500]}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                retryable = True
+                logging.warning(f"YooKassa {op} network error (attempt {attempt}/{MAX_ATTEMPTS}): {e!r}")
+            stats.latencies.append(time.monotonic() - started)
+
+            if not retryable or attempt == MAX_ATTEMPTS:
+                stats.errors += 1
+                raise error
+            stats.retries += 1
+            delay = retry_after if retry_after is not None else random.uniform(
+                0, min(RETRY_MAX_DELAY_SEC, RETRY_BASE_DELAY_SEC * 2 ** (attempt - 1))
+            )
+            await asyncio.sleep(min(delay, RETRY_MAX_DELAY_SEC))
+
+    async def create_payment(self, payment_data: dict, idempotence_key: Optional[str] = None) -> dict:
+        """Создать платёж. Все повторы идут с одним Idempotence-Key."""
+        key = idempotence_key or str(uuid.uuid4())
+        return await self._request(
+            "create_payment", "POST", "/payments",
+            json_body=payment_data, headers={"Idempotence-Key": key}, ok_statuses=(200, 201),
+        )
+
+    async def get_payment(self, payment_id: str) -> dict:
+        """Получить платёж (статус, metadata) по id."""
+        return await self._request("get_payment", "GET", f"/payments/{payment_id}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {op: s.to_dict() for op, s in self._stats.items()}
+
+
+_client: Optional[YooKassaClient] = None
+
+
+def get_client() -> YooKassaClient:
+    """Общий клиент процесса (создаётся лениво из настроек)."""
+    global _client
+    if _client is None:
+        _client = YooKassaClient(
+            config.yookassa_shop_id.get_secret_value(),
+            config.yookassa_secret_key.get_secret_value(),
+            base_url=config.yookassa_api_url,
+        )
+        metrics.register("yookassa", _client.stats)
+    return _client
+
+
+async def close_client() -> None:
+    """Закрыть сессию клиента (при остановке процесса)."""
+    if _client is not None:
+        await _client.close()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка OpenAI-совместимого LLM (POST /v1/chat/completions) для
+проверки выбора провайдера и переключения (main/llm_providers.py) без реальных API.
+
+Отвечает фиксированным текстом с задержкой --delay (± --jitter) и с долей ошибок
+--error-rate (статус --error-status). GET /stats — сколько запросов пришло.
+Кэш префикса имитируется: повторный системный промпт считается попаданием в кэш
+(usage.prompt_cache_hit_tokens), а задержка такого ответа уменьшается на --cache-saving.
+
+Пример: быстрый и медленный провайдер с ошибками
+    python scripts/llm_stub_server.py --port 9101 --delay 0.3
+    python scripts/llm_stub_server.py --port 9102 --delay 2 --error-rate 0.3
+
+    LLM_PROVIDERS='[{"name":"fast","url":"http://localhost:9101/v1/chat/completions","model":"stub"},
+                    {"name":"slow","url":"http://localhost:9102/v1/chat/completions","model":"stub"}]'
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+
+def make_app(args) -> web.Application:
+    stats = {'requests': 0, 'errors': 0, 'cache_hits': 0}
+    seen_prefixes = set()
+
+    async def completions(request: web.Request) -> web.Response:
+        stats['requests'] += 1
+        body = await request.json()
+        messages = body.get('messages', [])
+        prefix = str(messages[0].get('content', '')) if messages and messages[0].get('role') == 'system' else ''
+        cache_hit = bool(prefix) and prefix in seen_prefixes
+        seen_prefixes.add(prefix)
+        delay = args.delay - (args.cache_saving if cache_hit else 0.0)
+        await asyncio.sleep(max(0.0, delay + random.uniform(-args.jitter, args.jitter)))
+        if random.random() < args.error_rate:
+            stats['errors'] += 1
+            return web.json_response({'error': {'message': 'stub error'}}, status=args.error_status)
+        prompt_tokens = sum(len(str(m.get('content', ''))) // 4 for m in messages)
+        cached_tokens = len(prefix) // 4 if cache_hit else 0
+        stats['cache_hits'] += int(cache_hit)
+        return web.json_response({
+            'id': f"stub-{stats['requests']}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': f"{args.text} [{args.name}]"},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 20,
+                      'total_tokens': prompt_tokens + 20,
+                      'prompt_cache_hit_tokens': cached_tokens,
+                      'prompt_cache_miss_tokens': prompt_tokens - cached_tokens},
+        })
+
+    async def stats_handler(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', completions)
+    app.router.add_get('/stats', stats_handler)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заглушка OpenAI-совместимого LLM')
+    parser.add_argument('--port', type=int, default=9101)
+    parser.add_argument('--name', default=None, help='Имя в тексте ответа (по умолчанию stub:PORT)')
+    parser.add_argument('--delay', type=float, default=0.5, help='Задержка ответа, секунд')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Разброс задержки, секунд')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов с ошибкой (0..1)')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--cache-saving', type=float, default=0.0,
+                        help='На сколько секунд быстрее ответ при попадании в кэш префикса')
+    parser.add_argument('--text', default='Прошлое: заглушка. Настоящее: заглушка. Будущее: заглушка.')
+    args = parser.parse_args()
+    args.name = args.name or f"stub:{args.port}"
+    web.run_app(make_app(args), port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Локальный «проигрыватель» апдейтов MAX для режима webhook (BOT_UPDATES_MODE=webhook).
+
+Шлёт апдейты на /webhook/max так же, как это делает MAX: из файла (JSON Lines,
+один апдейт на строку) или сгенерированные из аргументов. Удобно проверять приём
+апдейтов, отсев повторов и порядок обработки без подписки на реальный MAX.
+
+Примеры:
+    # /start от пользователя 123
+    python scripts/replay_updates.py --user-id 123 --text /start
+
+    # двойное нажатие кнопки (второе нажатие с тем же callback_id — повтор доставки)
+    python scripts/replay_updates.py --user-id 123 --callback confirm_cards --repeat 2 --same-id
+
+    # апдейты из файла, 20 в секунду, с секретом подписки
+    python scripts/replay_updates.py updates.jsonl --rate 20 --secret "$MAX_WEBHOOK_SECRET"
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+import aiohttp
+
+SECRET_HEADER = 'X-Max-Bot-Api-Secret'
+
+
+def make_message(user_id: int, text: str) -> dict:
+    now = int(time.time() * 1000)
+    return {
+        'update_type': 'message_created',
+        'timestamp': now,
+        'message': {
+            'sender': {'user_id': user_id, 'first_name': 'Replay', 'name': 'Replay', 'is_bot': False,
+                       'last_activity_time': now},
+            'recipient': {'chat_id': user_id, 'chat_type': 'dialog', 'user_id': user_id},
+            'timestamp': now,
+            'body': {'mid': f"mid.replay.{uuid.uuid4().hex}", 'seq': now, 'text': text},
+        },
+        'user_locale': 'ru',
+    }
+
+
+def make_callback(user_id: int, payload: str, callback_id: str = None) -> dict:
+    now = int(time.time() * 1000)
+    return {
+        'update_type': 'message_callback',
+        'timestamp': now,
+        'callback': {
+            'timestamp': now,
+            'callback_id': callback_id or f"cb.replay.{uuid.uuid4().hex}",
+            'payload': payload,
+            'user': {'user_id': user_id, 'first_name': 'Replay', 'name': 'Replay', 'is_bot': False,
+                     'last_activity_time': now},
+        },
+        'message': None,
+        'user_locale': 'ru',
+    }
+
+
+def load_updates(args) -> list:
+    if args.file:
+        with open(args.file, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    if not args.user_id:
+        sys.exit("Укажите файл с апдейтами или --user-id с --text / --callback")
+    updates = []
+    callback_id = f"cb.replay.{uuid.uuid4().hex}"
+    for _ in range(args.repeat):
+        if args.callback:
+            updates.append(make_callback(args.user_id, args.callback, callback_id if args.same_id else None))
+        else:
+            updates.append(make_message(args.user_id, args.text or '/start'))
+    return updates
+
+
+async def replay(args) -> None:
+    updates = load_updates(args)
+    headers = {SECRET_HEADER: args.secret} if args.secret else {}
+    delay = 1.0 / args.rate if args.rate > 0 else 0
+    started = time.monotonic()
+    statuses = {}
+    async with aiohttp.ClientSession(headers=headers) as session:
+        for update in updates:
+            async with session.post(args.url, json=update) as resp:
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+                if resp.status != 200:
+                    print(f"{resp.status} {update.get('update_type')}: {(await resp.text())[:200]}")
+            if delay:
+                await asyncio.sleep(delay)
+    print(f"Отправлено {len(updates)} апдейт(ов) за {time.monotonic() - started:.2f} с, ответы: {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Отправить апдейты MAX на локальный /webhook/max')
+    parser.add_argument('file', nargs='?', help='JSON Lines с апдейтами (один апдейт на строку)')
+    parser.add_argument('--url', default=f"http://localhost:{os.environ.get('PORT', 8081)}/webhook/max")
+    parser.add_argument('--secret', default=os.environ.get('MAX_WEBHOOK_SECRET'),
+                        help='Секрет подписки (по умолчанию MAX_WEBHOOK_SECRET)')
+    parser.add_argument('--rate', type=float, default=0, help='Апдейтов в секунду (0 — без паузы)')
+    parser.add_argument('--user-id', type=int, help='Сгенерировать апдейты от этого пользователя')
+    parser.add_argument('--text', help='Текст сообщения (по умолчанию /start)')
+    parser.add_argument('--callback', help='Payload кнопки (вместо сообщения)')
+    parser.add_argument('--repeat', type=int, default=1, help='Сколько раз повторить апдейт')
+    parser.add_argument('--same-id', action='store_true',
+                        help='Для --callback: один callback_id на все повторы (повтор доставки)')
+    asyncio.run(replay(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка API ЮKassa (POST /v3/payments, GET /v3/payments/{id}) для проверки
+клиента main/yookassa.py — повторов, Idempotence-Key, таймаутов — без реальных платежей.
+
+- создание платежа идемпотентно по Idempotence-Key: повтор с тем же ключом
+  возвращает уже созданный платёж;
+- платёж становится succeeded через --succeed-after секунд после создания
+  (0 — сразу, отрицательное — остаётся pending);
+- доля ответов 429 (с Retry-After) — --rate-limit-rate, доля 5xx — --error-rate
+  (статус --error-status); задержка ответа — --delay;
+- GET /stats — сколько запросов пришло и сколько ошибок отдано.
+
+Пример:
+    python scripts/yookassa_stub_server.py --port 9201 --error-rate 0.3 --rate-limit-rate 0.1
+
+    YOOKASSA_API_URL=http://localhost:9201/v3
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+
+def make_app(args) -> web.Application:
+    stats = {'requests': 0, 'created': 0, 'rate_limited': 0, 'errors': 0}
+    payments = {}
+    by_idempotence_key = {}
+
+    async def _fault() -> web.Response | None:
+        """Задержка и, с заданной вероятностью, 429 или 5xx вместо ответа."""
+        stats['requests'] += 1
+        await asyncio.sleep(args.delay)
+        if random.random() < args.rate_limit_rate:
+            stats['rate_limited'] += 1
+            return web.json_response(
+                {'type': 'error', 'code': 'too_many_requests'}, status=429, headers={'Retry-After': '1'}
+            )
+        if random.random() < args.error_rate:
+            stats['errors'] += 1
+            return web.json_response({'type': 'error', 'code': 'internal_server_error'}, status=args.error_status)
+        return None
+
+    def _view(payment: dict) -> dict:
+        if (payment['status'] == 'pending' and args.succeed_after >= 0
+                and time.time() - payment['_created'] >= args.succeed_after):
+            payment['status'] = 'succeeded'
+            payment['paid'] = True
+        return {k: v for k, v in payment.items() if not k.startswith('_')}
+
+    async def create_payment(request: web.Request) -> web.Response:
+        fault = await _fault()
+        if fault is not None:
+            return fault
+        key = request.headers.get('Idempotence-Key')
+        if not key:
+            return web.json_response({'type': 'error', 'code': 'invalid_request'}, status=400)
+        if key in by_idempotence_key:
+            return web.json_response(_view(payments[by_idempotence_key[key]]))
+        body = await request.json()
+        payment_id = str(uuid.uuid4())
+        payments[payment_id] = {
+            'id': payment_id,
+            'status': 'pending',
+            'paid': False,
+            'amount': body.get('amount'),
+            'description': body.get('description'),
+            'metadata': body.get('metadata') or {},
+            'confirmation': {
+                'type': 'redirect',
+                'confirmation_url': f"http://localhost:{args.port}/checkout/{payment_id}",
+            },
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'test': True,
+            '_created': time.time(),
+        }
+        by_idempotence_key[key] = payment_id
+        stats['created'] += 1
+        return web.json_response(_view(payments[payment_id]))
+
+    async def get_payment(request: web.Request) -> web.Response:
+        fault = await _fault()
+        if fault is not None:
+            return fault
+        payment = payments.get(request.match_info['payment_id'])
+        if payment is None:
+            return web.json_response({'type': 'error', 'code': 'not_found'}, status=404)
+        return web.json_response(_view(payment))
+
+    async def stats_handler(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post('/v3/payments', create_payment)
+    app.router.add_get('/v3/payments/{payment_id}', get_payment)
+    app.router.add_get('/stats', stats_handler)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заглушка API ЮKassa')
+    parser.add_argument('--port', type=int, default=9201)
+    parser.add_argument('--delay', type=float, default=0.1, help='Задержка ответа, секунд')
+    parser.add_argument('--succeed-after', type=float, default=5.0,
+                        help='Через сколько секунд платёж становится succeeded (<0 — никогда)')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Доля ответов 429 (0..1)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов 5xx (0..1)')
+    parser.add_argument('--error-status', type=int, default=503)
+    args = parser.parse_args()
+    web.run_app(make_app(args), port=args.port)
+
+
+if __name__ == '__main__':
+    main()
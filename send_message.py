@@ -11,7 +11,8 @@
 import asyncio
 import logging
 import sys
-from typing import Optional
+from datetime import datetime
+from typing import Optional, Tuple
 
 import aiohttp
 from aiomax import buttons
@@ -19,12 +20,10 @@ from main.botdef import bot
 from main.database import (
     Database,
     update_user_blocked_status,
-    get_all_users,
-    get_paid_users,
+    BROADCAST_AUDIENCE_ALL,
+    BROADCAST_AUDIENCE_PAID,
     is_send_blocked_error,
     get_users_for_div_reminder_broadcast,
-    get_users_for_activation_broadcast,
-    mark_activation_sent,
     mark_div_reminder_broadcast_sent,
     DIV_REMINDER_SKIP_SEGMENTS,
     DIV_REMINDER_SEGMENT_ACTIVE,
@@ -32,7 +31,9 @@ from main.database import (
     DIV_REMINDER_SEGMENT_PAYWALL,
     DIV_REMINDER_SEGMENT_FREE_RETURN,
 )
-from main.broadcast_schedule import is_user_due_in_tick, is_same_msk_day
+from main import broadcast_runs, messages, outbox
+from main.broadcast_schedule import MSK, is_user_due_in_tick, is_same_msk_day
+from main.cluster import in_shard
 
 logging.basicConfig(
     level=logging.INFO,
@@ -117,27 +118,9 @@ async def send_payment_reminder(user_id: int, stage: str = '10m'):
 
     stage: '10m' | '1h' | '3h' — этап автоматической рассылки.
     """
-    texts = {
-        '10m': (
-            "<b>Доступ к раскладам почти открыт — осталось только завершить оплату</b> 👇"
-        ),
-        '1h': (
-            "Кажется, оплата не дошла до конца — бывает 🔮\n\n"
-            "Если расклад всё ещё актуален, можешь завершить оплату, "
-            "когда будет удобно."
-        ),
-        '3h': (
-            "На всякий случай напоминаем: доступ к раскладам всё ещё можно открыть ✨\n\n"
-            "Если сейчас не время — ничего страшного. "
-            "Когда захочешь вернуться, нажми «Оплатить» ниже."
-        ),
-    }
-    text = texts.get(stage, texts['10m'])
-    kb = buttons.KeyboardBuilder()
-    kb.row(buttons.CallbackButton("💳 Оплатить", "remind_pay"))
-
+    text, kb, fmt = messages.payment_reminder_message(stage)
     print(f"📤 Отправляю напоминание об оплате ({stage}) пользователю {user_id}...")
-    return await send_message_to_user(user_id, text, keyboard=kb)
+    return await send_message_to_user(user_id, text, keyboard=kb, format=fmt)
 
 
 async def send_no_divinations_reminder(
@@ -147,35 +130,15 @@ async def send_no_divinations_reminder(
     segment: Optional[str] = None,
 ):
     """Напоминание тем, у кого закончились все гадания + меню оплаты"""
-    from keyboards.pay import make_payment_kb
-    from main.conversions import save_paywall_conversion
-
-    reminder_text = (
-        "✨ Привет! Может, пора сделать новый расклад?\n\n"
-        "Карты помогли тебе увидеть то, что было скрыто. "
-        "И если сейчас снова нужна ясность — я здесь.\n\n"
-        "Выбери свой путь и продолжай находить ответы внутри себя 💫"
-    )
-    payment_text = _broadcast_payment_text()
-
     print(f"📤 Отправляю напоминание о закончившихся гаданиях пользователю {user_id}...")
     try:
-        metadata = {'reminder_type': 'no_divinations', 'sent_via': sent_via}
-        if segment:
-            metadata['segment'] = segment
         try:
-            await save_paywall_conversion(
-                user_id=user_id,
-                paywall_source="no_divinations_reminder",
-                metadata=metadata,
-            )
-            from main.metrika_mp import send_conversion_event
-            await send_conversion_event(user_id, 'paywall')
+            messages.track_paywall_sent(user_id, 'no_divinations_reminder', sent_via, segment)
         except Exception as e:
             logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
 
-        await bot.send_message(reminder_text, user_id=user_id, format=None)
-        await bot.send_message(payment_text, user_id=user_id, keyboard=make_payment_kb(), format='html')
+        for text, kb, fmt in messages.no_divinations_messages():
+            await bot.send_message(text, user_id=user_id, keyboard=kb, format=fmt)
         print(f"✅ Напоминание и меню оплаты отправлены пользователю {user_id}")
         return True
     except Exception as e:
@@ -183,60 +146,25 @@ async def send_no_divinations_reminder(
         return False
 
 
-def _broadcast_payment_text() -> str:
-    return (
-        "🔮 <b>Личная консультация с тарологом Дианой</b> — от 500₽\n"
-        "Живой расклад и ответ в течение часа (10:00–22:00 МСК).\n\n"
-        "<b>🔥 Самый популярный вариант</b>\n"
-        "👑 Безлимит на месяц — 599₽\n"
-        "Гадай когда угодно и сколько угодно. Полная анонимность.\n\n"
-        "Или выбери пакет:\n"
-        "🔥 30 раскладов — 399₽\n"
-        "🌟 20 раскладов — 289₽\n"
-        "💫 10 раскладов — 179₽\n"
-        "🌙 3 расклада — 99₽\n\n"
-        "👉 Выбрать пакет"
-    )
-
-
 async def send_activation_nudge(user_id: int):
     """Welcome-активация: пользователь заходил, но ещё не сделал расклад."""
-    from keyboards.main_menu import make_main_menu
-
-    text = (
-        "Привет 🔮\n\n"
-        "Ты заходил(а), но мы ещё не успели погадать вместе.\n\n"
-        "Задай свой первый вопрос — карты уже ждут. "
-        "Можно начать с чего-то простого: «Что мне важно знать сегодня?»\n\n"
-        "Выбери расклад в меню ниже ✨"
-    )
+    text, kb, fmt = messages.activation_message()
     print(f"📤 Отправляю welcome-активацию пользователю {user_id}...")
-    return await send_message_to_user(user_id, text, keyboard=make_main_menu(), format=None)
+    return await send_message_to_user(user_id, text, keyboard=kb, format=fmt)
 
 
 async def send_gentle_nudge(user_id: int):
     """Мягкое напоминание для пользователей с активным платным доступом."""
-    text = (
-        "Привет 🔮\n\n"
-        "Просто напомню — карты здесь, если захочется новый расклад.\n\n"
-        "Не обязательно ждать сложного момента. "
-        "Можно спросить о делах, отношениях или просто «что важно знать сейчас».\n\n"
-        "Я рядом ✨"
-    )
+    text, _, fmt = messages.gentle_nudge_message()
     print(f"📤 Отправляю мягкое напоминание пользователю {user_id}...")
-    return await send_message_to_user(user_id, text, format=None)
+    return await send_message_to_user(user_id, text, format=fmt)
 
 
 async def send_free_return_nudge(user_id: int):
     """Мягкое напоминание для пользователей с оставшимися бесплатными раскладами."""
-    text = (
-        "Привет 🔮\n\n"
-        "У тебя ещё есть бесплатные расклады — можешь воспользоваться, когда будет удобно.\n\n"
-        "Карты помогают увидеть ситуацию с другой стороны. "
-        "Загляни, если захочется ясности ✨"
-    )
+    text, _, fmt = messages.free_return_message()
     print(f"📤 Отправляю мягкое напоминание (free return) пользователю {user_id}...")
-    return await send_message_to_user(user_id, text, format=None)
+    return await send_message_to_user(user_id, text, format=fmt)
 
 
 async def send_expired_sub_reminder(
@@ -246,35 +174,15 @@ async def send_expired_sub_reminder(
     segment: Optional[str] = None,
 ):
     """Напоминание пользователям, у которых закончился платный доступ."""
-    from keyboards.pay import make_payment_kb
-    from main.conversions import save_paywall_conversion
-
-    reminder_text = (
-        "Привет! 💫\n\n"
-        "Твои расклады закончились, но вопросы к картам — нет.\n\n"
-        "Если снова нужна ясность — я здесь. "
-        "Можно вернуться к любой теме, которая сейчас важна ✨"
-    )
-    payment_text = _broadcast_payment_text()
-
     print(f"📤 Отправляю напоминание об истёкшем доступе пользователю {user_id}...")
     try:
-        metadata = {'reminder_type': 'expired_sub_reminder', 'sent_via': sent_via}
-        if segment:
-            metadata['segment'] = segment
         try:
-            await save_paywall_conversion(
-                user_id=user_id,
-                paywall_source="expired_sub_reminder",
-                metadata=metadata,
-            )
-            from main.metrika_mp import send_conversion_event
-            await send_conversion_event(user_id, 'paywall')
+            messages.track_paywall_sent(user_id, 'expired_sub_reminder', sent_via, segment)
         except Exception as e:
             logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
 
-        await bot.send_message(reminder_text, user_id=user_id, format=None)
-        await bot.send_message(payment_text, user_id=user_id, keyboard=make_payment_kb(), format='html')
+        for text, kb, fmt in messages.expired_sub_messages():
+            await bot.send_message(text, user_id=user_id, keyboard=kb, format=fmt)
         print(f"✅ Напоминание об истёкшем доступе отправлено пользователю {user_id}")
         return True
     except Exception as e:
@@ -282,21 +190,18 @@ async def send_expired_sub_reminder(
         return False
 
 
-DIV_REMINDER_SENDERS = {
-    DIV_REMINDER_SEGMENT_ACTIVE: send_gentle_nudge,
-    DIV_REMINDER_SEGMENT_EXPIRED: send_expired_sub_reminder,
-    DIV_REMINDER_SEGMENT_PAYWALL: send_no_divinations_reminder,
-    DIV_REMINDER_SEGMENT_FREE_RETURN: send_free_return_nudge,
+# Сегмент Пн/Чт рассылки → шаблон сообщения (main/messages.py)
+DIV_REMINDER_TEMPLATES = {
+    DIV_REMINDER_SEGMENT_ACTIVE: 'gentle_nudge',
+    DIV_REMINDER_SEGMENT_EXPIRED: 'expired_sub',
+    DIV_REMINDER_SEGMENT_PAYWALL: 'no_divinations',
+    DIV_REMINDER_SEGMENT_FREE_RETURN: 'free_return',
 }
 
-BROADCAST_SEND_DELAY_SEC = 0.1
-
 
 def _init_broadcast_results() -> dict:
     return {
-        'sent': 0,
-        'failed': 0,
-        'blocked': 0,
+        'queued': 0,
         'skipped': 0,
         'skipped_time': 0,
         'skipped_already_sent': 0,
@@ -304,68 +209,26 @@ def _init_broadcast_results() -> dict:
     }
 
 
-async def _send_div_reminder_for_segment(user_id: int, segment: str) -> bool:
-    """Отправка по сегменту с metadata для paywall-сценариев."""
-    if segment in (DIV_REMINDER_SEGMENT_EXPIRED, DIV_REMINDER_SEGMENT_PAYWALL):
-        sender = DIV_REMINDER_SENDERS[segment]
-        return await sender(user_id, sent_via='broadcast', segment=segment)
-    sender = DIV_REMINDER_SENDERS.get(segment)
-    if not sender:
-        return False
-    return await sender(user_id)
-
-
-async def send_activation_broadcast() -> dict:
-    """
-    Welcome-активация: ≥24ч после регистрации, без гаданий.
-    Отправка в персональный слот 10:00–20:00 MSK (тик каждые 30 мин).
-    """
-    results = _init_broadcast_results()
-    targets = await get_users_for_activation_broadcast()
-    logging.info(f"Activation broadcast tick: {len(targets)} eligible users")
-
-    for target in targets:
-        uid = target['user_id']
-        last_active_at = target.get('last_active_at')
-
-        if not is_user_due_in_tick(uid, last_active_at):
-            results['skipped_time'] += 1
-            continue
-
-        try:
-            success = await send_activation_nudge(uid)
-            if success:
-                await mark_activation_sent(uid)
-                results['sent'] += 1
-            else:
-                results['blocked'] += 1
-            await asyncio.sleep(BROADCAST_SEND_DELAY_SEC)
-        except Exception as e:
-            logging.error(f"Error in activation broadcast for user {uid}: {e}", exc_info=True)
-            results['failed'] += 1
-
-    if any(v for k, v in results.items() if k != 'by_segment' and v):
-        logging.info(f"Activation broadcast tick results: {results}")
-    return results
-
-
-async def send_divination_reminder_broadcast() -> dict:
+async def send_divination_reminder_broadcast(shard: Optional[Tuple[int, int]] = None) -> dict:
     """
     Сегментированная рассылка Пн/Чт.
     Отправка в персональный слот 10:00–20:00 MSK (тик каждые 30 мин).
+    shard=(i, N) — только пользователи с user_id % N == i (часть рассылки для узла кластера).
+
+    Сообщения не отправляются здесь: пометка last_div_reminder_broadcast_at и записи
+    в outbox коммитятся одной транзакцией, доставку делает воркер outbox.
     """
     results = _init_broadcast_results()
     targets = await get_users_for_div_reminder_broadcast()
+    targets = [t for t in targets if in_shard(t['user_id'], shard)]
     logging.info(f"Divination-reminder broadcast tick: {len(targets)} users loaded")
 
+    due_by_segment: dict = {}
     for target in targets:
         uid = target['user_id']
         segment = target['segment']
         last_active_at = target.get('last_active_at')
 
-        if segment not in results['by_segment']:
-            results['by_segment'][segment] = {'sent': 0, 'failed': 0, 'blocked': 0}
-
         if segment in DIV_REMINDER_SKIP_SEGMENTS:
             results['skipped'] += 1
             continue
@@ -378,29 +241,31 @@ async def send_divination_reminder_broadcast() -> dict:
             results['skipped_time'] += 1
             continue
 
-        if segment not in DIV_REMINDER_SENDERS:
+        if segment not in DIV_REMINDER_TEMPLATES:
             logging.warning(f"Unknown broadcast segment '{segment}' for user {uid}, skipping")
             results['skipped'] += 1
             continue
 
-        try:
-            success = await _send_div_reminder_for_segment(uid, segment)
-            if success:
-                await mark_div_reminder_broadcast_sent(uid)
-                results['sent'] += 1
-                results['by_segment'][segment]['sent'] += 1
-            else:
-                results['blocked'] += 1
-                results['by_segment'][segment]['blocked'] += 1
-            await asyncio.sleep(BROADCAST_SEND_DELAY_SEC)
-        except Exception as e:
-            logging.error(
-                f"Error in divination-reminder broadcast for user {uid} "
-                f"(segment={segment}): {e}",
-                exc_info=True,
-            )
-            results['failed'] += 1
-            results['by_segment'][segment]['failed'] += 1
+        due_by_segment.setdefault(segment, []).append(uid)
+
+    if due_by_segment:
+        day = datetime.now(MSK).strftime('%Y-%m-%d')
+        await outbox.ensure_outbox_table_once()
+        pool = await Database.get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await mark_div_reminder_broadcast_sent(
+                    [uid for uids in due_by_segment.values() for uid in uids], conn=conn
+                )
+                for segment, uids in due_by_segment.items():
+                    params = {'sent_via': 'broadcast', 'segment': segment}
+                    await messages.enqueue_many(
+                        conn, DIV_REMINDER_TEMPLATES[segment],
+                        [(uid, params, f"div_reminder:{uid}:{day}") for uid in uids],
+                    )
+                    results['by_segment'][segment] = len(uids)
+                    results['queued'] += len(uids)
+        outbox.worker.wake()
 
     if any(v for k, v in results.items() if k != 'by_segment' and v) or results['by_segment']:
         logging.info(f"Divination-reminder broadcast tick results: {results}")
@@ -419,7 +284,7 @@ async def send_no_divinations_broadcast() -> dict:
 async def send_discussion_announcement(user_id: int):
     """Объявление о функции обсуждения расклада + меню оплаты"""
     from keyboards.pay import make_payment_kb
-    from main.conversions import save_paywall_conversion
+    from main.conversions import track_paywall_conversion
 
     announcement_text = (
         "✨ <b>Новое в боте!</b>\n\n"
@@ -446,13 +311,13 @@ async def send_discussion_announcement(user_id: int):
     print(f"📤 Отправляю объявление об обсуждении расклада пользователю {user_id}...")
     try:
         try:
-            await save_paywall_conversion(
+            track_paywall_conversion(
                 user_id=user_id,
                 paywall_source="discussion_announcement",
                 metadata={'reminder_type': 'discussion_announcement', 'sent_via': 'send_message_script'}
             )
-            from main.metrika_mp import send_conversion_event
-            await send_conversion_event(user_id, 'paywall')
+            from main.metrika_mp import track_conversion_event
+            track_conversion_event(user_id, 'paywall')
         except Exception as e:
             logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
 
@@ -481,7 +346,7 @@ async def send_bot_restored(user_id: int):
 async def send_friday13_promo(user_id: int):
     """Промо-рассылка: Пятница 13 — удвоение пакетов гаданий"""
     from keyboards.pay import make_payment_kb
-    from main.conversions import save_paywall_conversion
+    from main.conversions import track_paywall_conversion
 
     promo_text = (
         "🌑 <b>Пятница, 13-е… Карты говорят громче обычного.</b>\n\n"
@@ -510,13 +375,13 @@ async def send_friday13_promo(user_id: int):
     print(f"📤 Отправляю промо «Пятница 13» пользователю {user_id}...")
     try:
         try:
-            await save_paywall_conversion(
+            track_paywall_conversion(
                 user_id=user_id,
                 paywall_source="friday13_promo",
                 metadata={'reminder_type': 'friday13_promo', 'sent_via': 'send_message_script'}
             )
-            from main.metrika_mp import send_conversion_event
-            await send_conversion_event(user_id, 'paywall')
+            from main.metrika_mp import track_conversion_event
+            track_conversion_event(user_id, 'paywall')
         except Exception as e:
             logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
 
@@ -532,7 +397,7 @@ async def send_friday13_promo(user_id: int):
 async def send_tarologist_intro(user_id: int):
     """Представление таролога Дианы и новых услуг «Личная консультация» (+ меню оплаты)"""
     from keyboards.pay import make_payment_kb
-    from main.conversions import save_paywall_conversion
+    from main.conversions import track_paywall_conversion
 
     intro_text = (
         "Рады сообщить: у Вас появилась возможность получить "
@@ -569,13 +434,13 @@ async def send_tarologist_intro(user_id: int):
     print(f"📤 Отправляю представление таролога Дианы пользователю {user_id}...")
     try:
         try:
-            await save_paywall_conversion(
+            track_paywall_conversion(
                 user_id=user_id,
                 paywall_source="tarologist_intro",
                 metadata={'reminder_type': 'tarologist_intro', 'sent_via': 'send_message_script'}
             )
-            from main.metrika_mp import send_conversion_event
-            await send_conversion_event(user_id, 'paywall')
+            from main.metrika_mp import track_conversion_event
+            track_conversion_event(user_id, 'paywall')
         except Exception as e:
             logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
 
@@ -644,7 +509,7 @@ async def send_consult_diana_contact(user_id: int, package: str = 'detailed'):
 async def send_tarologist_reminder(user_id: int):
     """Повторное напоминание о тарологе Диане — для тех, кто уже видел представление."""
     from keyboards.pay import make_consultation_kb
-    from main.conversions import save_paywall_conversion
+    from main.conversions import track_paywall_conversion
 
     reminder_text = (
         "Иногда хочется просто спросить — и услышать понятный, тёплый ответ 💗\n\n"
@@ -671,13 +536,13 @@ async def send_tarologist_reminder(user_id: int):
     print(f"📤 Отправляю напоминание о тарологе Диане пользователю {user_id}...")
     try:
         try:
-            await save_paywall_conversion(
+            track_paywall_conversion(
                 user_id=user_id,
                 paywall_source="tarologist_reminder",
                 metadata={'reminder_type': 'tarologist_reminder', 'sent_via': 'send_message_script'}
             )
-            from main.metrika_mp import send_conversion_event
-            await send_conversion_event(user_id, 'paywall')
+            from main.metrika_mp import track_conversion_event
+            track_conversion_event(user_id, 'paywall')
         except Exception as e:
             logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
 
@@ -692,7 +557,7 @@ async def send_tarologist_reminder(user_id: int):
 async def send_full_moon_promo(user_id: int):
     """Промо-рассылка: полнолуние — удвоение пакетов раскладов"""
     from keyboards.pay import make_payment_kb
-    from main.conversions import save_paywall_conversion
+    from main.conversions import track_paywall_conversion
 
     promo_text = (
         "🌕 <b>Полнолуние — время ясности и силы.</b>\n\n"
@@ -720,13 +585,13 @@ async def send_full_moon_promo(user_id: int):
     print(f"📤 Отправляю промо «Полнолуние» пользователю {user_id}...")
     try:
         try:
-            await save_paywall_conversion(
+            track_paywall_conversion(
                 user_id=user_id,
                 paywall_source="full_moon_promo",
                 metadata={'reminder_type': 'full_moon_promo', 'sent_via': 'send_message_script'}
             )
-            from main.metrika_mp import send_conversion_event
-            await send_conversion_event(user_id, 'paywall')
+            from main.metrika_mp import track_conversion_event
+            track_conversion_event(user_id, 'paywall')
         except Exception as e:
             logging.error(f"Error saving paywall conversion: {e}", exc_info=True)
 
@@ -774,6 +639,67 @@ def _handle_send_error(user_id: int, error: Exception, action_desc: str):
     logging.error(f"Error sending {action_desc} to user {user_id}: {error}", exc_info=True)
 
 
+# Действия CLI: флаг (dest argparse) → (описание для лога, отправка одному пользователю).
+# Имя действия и params сохраняются в рассылке (main/broadcast_runs.py) — по ним
+# --resume восстанавливает, что отправлять.
+BROADCAST_ACTIONS = {
+    'feedback_request': ("📝 Отправка запроса обратной связи", lambda uid, p: send_feedback_request(uid)),
+    'payment_reminder': ("🚀 Отправка напоминаний об оплате", lambda uid, p: send_payment_reminder(uid)),
+    'no_divinations': (
+        "🚀 Отправка напоминаний о закончившихся гаданиях", lambda uid, p: send_no_divinations_reminder(uid)
+    ),
+    'activation': ("📤 Отправка welcome-активации", lambda uid, p: send_activation_nudge(uid)),
+    'gentle_nudge': ("🚀 Отправка мягких напоминаний", lambda uid, p: send_gentle_nudge(uid)),
+    'free_return': ("🚀 Отправка free-return напоминаний", lambda uid, p: send_free_return_nudge(uid)),
+    'expired_sub': (
+        "🚀 Отправка напоминаний об истёкшем доступе", lambda uid, p: send_expired_sub_reminder(uid)
+    ),
+    'discussion': (
+        "🚀 Отправка объявлений об обсуждении расклада", lambda uid, p: send_discussion_announcement(uid)
+    ),
+    'restored': ("🔮 Отправка сообщений о восстановлении бота", lambda uid, p: send_bot_restored(uid)),
+    'friday13': ("🌑 Отправка промо «Пятница 13»", lambda uid, p: send_friday13_promo(uid)),
+    'fullmoon': ("🌕 Отправка промо «Полнолуние»", lambda uid, p: send_full_moon_promo(uid)),
+    'tarologist_intro': (
+        "🔮 Отправка представления таролога Дианы", lambda uid, p: send_tarologist_intro(uid)
+    ),
+    'tarologist_reminder': (
+        "🔮 Отправка напоминания о тарологе Диане", lambda uid, p: send_tarologist_reminder(uid)
+    ),
+    'consult_diana_contact': (
+        "💬 Отправка контакта Дианы",
+        lambda uid, p: send_consult_diana_contact(uid, package=p.get('consult_package', 'detailed')),
+    ),
+    'text': (
+        "📤 Отправка сообщения",
+        lambda uid, p: send_message_to_user(uid, p['text'], p.get('format')),
+    ),
+}
+
+
+async def _run_broadcast(run_id: int) -> None:
+    """Выполнить (или продолжить) рассылку run_id и напечатать итог."""
+    run = await broadcast_runs.get_run(run_id)
+    if run is None:
+        print(f"❌ Рассылка {run_id} не найдена")
+        return
+    if run['status'] != 'running':
+        print(f"ℹ️ Рассылка {run_id} уже в статусе {run['status']} (отправлено {run['sent']})")
+        return
+
+    desc, func = BROADCAST_ACTIONS[run['action']]
+    params = run['params'] or {}
+    print(f"{desc}: рассылка #{run_id} (аудитория: {run['audience']}, с user_id > {run['cursor_user_id']})")
+    print(f"   Если процесс прервётся — продолжить: python send_message.py --resume {run_id}")
+    results = await broadcast_runs.execute(run_id, lambda uid: func(uid, params))
+
+    run = await broadcast_runs.get_run(run_id)
+    print(f"\n{'='*60}")
+    print(f"Этот процесс: отправлено {results['sent']}, ошибок {results['failed']}, частей {results['chunks']}")
+    print(f"Рассылка #{run_id}: {run['status']}, всего отправлено {run['sent']}, ошибок {run['failed']}")
+    print(f"{'='*60}\n")
+
+
 async def main():
     import argparse
 
@@ -782,7 +708,8 @@ async def main():
     )
     parser.add_argument(
         'user_id', type=int, nargs='*', default=[],
-        help='Max User ID (несколько через пробел). Для --broadcast берутся из БД'
+        help='Max User ID (несколько через пробел). Для --broadcast берутся из БД; '
+             'для --outbox-replay — id событий outbox'
     )
     parser.add_argument(
         '--text', type=str,
@@ -857,114 +784,81 @@ async def main():
         '--broadcast', action='store_true',
         help='Рассылать всем пользователям из БД (исключая заблокированных)'
     )
+    parser.add_argument(
+        '--resume', type=int, metavar='RUN_ID',
+        help='Продолжить прерванную рассылку с последнего чекпоинта '
+             '(параллельный запуск с тем же RUN_ID делит рассылку между процессами)'
+    )
+    parser.add_argument(
+        '--runs', action='store_true',
+        help='Показать последние рассылки (id, статус, прогресс)'
+    )
+    parser.add_argument(
+        '--cancel-run', type=int, metavar='RUN_ID',
+        help='Остановить рассылку (текущие части дойдут до конца, новые не начнутся)'
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=broadcast_runs.BROADCAST_CHUNK_SIZE,
+        help=f'Размер части рассылки (по умолчанию: {broadcast_runs.BROADCAST_CHUNK_SIZE})'
+    )
+    parser.add_argument(
+        '--outbox-replay', action='store_true',
+        help='Вернуть события outbox в очередь (по умолчанию — окончательно упавшие); '
+             'отправит воркер работающего бота'
+    )
+    parser.add_argument(
+        '--outbox-kind', type=str,
+        help='Для --outbox-replay: тип события (message, payment_succeeded, ...)'
+    )
+    parser.add_argument(
+        '--outbox-status', type=str, default='failed', choices=['failed', 'done'],
+        help='Для --outbox-replay: какие события вернуть (done — повторная отправка доставленных)'
+    )
+    parser.add_argument(
+        '--outbox-since-hours', type=int,
+        help='Для --outbox-replay: только события за последние N часов'
+    )
 
     args = parser.parse_args()
     fmt = args.format if args.format != 'none' else None
 
     try:
-        if args.feedback_request and not args.user_id:
-            paid = await get_paid_users()
-            args.user_id = [u['user_id'] for u in paid]
-            print(f"📋 Загружено {len(args.user_id)} купивших пользователей для запроса отзыва")
-        elif args.broadcast:
-            all_users = await get_all_users(include_blocked=False, include_unsubscribed_daily_card=True)
-            args.user_id = [u['user_id'] for u in all_users]
-            print(f"📋 Загружено {len(args.user_id)} пользователей для рассылки")
+        if args.outbox_replay:
+            count = await outbox.replay(
+                kind=args.outbox_kind,
+                status=args.outbox_status,
+                since_hours=args.outbox_since_hours,
+                event_ids=args.user_id or None,
+            )
+            print(f"🔁 Возвращено в очередь outbox: {count} событие(й)")
+            return
 
-        if not args.user_id:
-            print("❌ Ошибка: укажите user_id или используйте --broadcast / --feedback-request")
+        if args.runs:
+            for r in await broadcast_runs.list_runs():
+                print(
+                    f"#{r['id']} {r['action']} [{r['audience']}] {r['status']}: "
+                    f"отправлено {r['sent']}, ошибок {r['failed']}, курсор {r['cursor_user_id']}, "
+                    f"создана {r['created_at']:%Y-%m-%d %H:%M}"
+                )
             return
 
-        total = len(args.user_id)
-
-        if args.feedback_request:
-            print(f"📝 Отправка запроса обратной связи для {total} купивших пользователя(ей)...")
-            for uid in args.user_id:
-                await send_feedback_request(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.payment_reminder:
-            print(f"🚀 Отправка напоминаний об оплате для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_payment_reminder(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.no_divinations:
-            print(f"🚀 Отправка напоминаний о закончившихся гаданиях для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_no_divinations_reminder(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.activation:
-            print(f"📤 Отправка welcome-активации для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_activation_nudge(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.gentle_nudge:
-            print(f"🚀 Отправка мягких напоминаний для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_gentle_nudge(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.free_return:
-            print(f"🚀 Отправка free-return напоминаний для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_free_return_nudge(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.expired_sub:
-            print(f"🚀 Отправка напоминаний об истёкшем доступе для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_expired_sub_reminder(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.discussion:
-            print(f"🚀 Отправка объявлений об обсуждении расклада для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_discussion_announcement(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.restored:
-            print(f"🔮 Отправка сообщений о восстановлении бота для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_bot_restored(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.friday13:
-            print(f"🌑 Отправка промо «Пятница 13» для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_friday13_promo(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.fullmoon:
-            print(f"🌕 Отправка промо «Полнолуние» для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_full_moon_promo(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.tarologist_intro:
-            print(f"🔮 Отправка представления таролога Дианы для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_tarologist_intro(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.tarologist_reminder:
-            print(f"🔮 Отправка напоминания о тарологе Диане для {total} пользователя(ей)...")
-            for uid in args.user_id:
-                await send_tarologist_reminder(uid)
-                await asyncio.sleep(0.05)
-
-        elif args.consult_diana_contact:
-            pkg = CONSULT_PACKAGE_NAMES[args.consult_package]
-            print(
-                f"💬 Отправка контакта Дианы ({pkg}) для {total} пользователя(ей)..."
-            )
-            for uid in args.user_id:
-                await send_consult_diana_contact(uid, package=args.consult_package)
-                await asyncio.sleep(0.05)
+        if args.cancel_run:
+            if await broadcast_runs.cancel_run(args.cancel_run):
+                print(f"⏹ Рассылка {args.cancel_run} остановлена")
+            else:
+                print(f"❌ Рассылка {args.cancel_run} не найдена или уже завершена")
+            return
 
-        else:
+        if args.resume:
+            await _run_broadcast(args.resume)
+            print("✅ Отправка завершена")
+            return
+
+        action = next((name for name in BROADCAST_ACTIONS if name != 'text' and getattr(args, name)), None)
+        params = {}
+        if action == 'consult_diana_contact':
+            params['consult_package'] = args.consult_package
+        elif action is None:
             if not args.text:
                 print(
                     "❌ Ошибка: укажите --text или используйте один из флагов: "
@@ -975,14 +869,34 @@ async def main():
                     "--consult-diana-contact / --feedback-request"
                 )
                 return
+            action = 'text'
+            params = {'text': args.text, 'format': fmt}
 
-            if total == 1:
-                await send_message_to_user(args.user_id[0], args.text, fmt)
-            else:
-                await send_message_to_multiple_users(args.user_id, args.text, fmt)
+        # Получатели: из БД (--broadcast / --feedback-request) или список user_id
+        if args.feedback_request and not args.user_id:
+            audience = BROADCAST_AUDIENCE_PAID
+        elif args.broadcast:
+            audience = BROADCAST_AUDIENCE_ALL
+        elif not args.user_id:
+            print("❌ Ошибка: укажите user_id или используйте --broadcast / --feedback-request")
+            return
+        elif len(args.user_id) == 1:
+            await BROADCAST_ACTIONS[action][1](args.user_id[0], params)
+            print("✅ Отправка завершена")
+            return
+        else:
+            audience = broadcast_runs.AUDIENCE_IDS
+            params['user_ids'] = args.user_id
+
+        run_id = await broadcast_runs.create_run(action, audience, params, chunk_size=args.chunk_size)
+        await _run_broadcast(run_id)
 
         print("✅ Отправка завершена")
     finally:
+        from main.conversions import conversion_buffer
+        from main.metrika_mp import dispatcher as metrika_dispatcher
+        await conversion_buffer.stop()
+        await metrika_dispatcher.stop()
         await Database.close_pool()
         if bot.session:
             await bot.session.close()
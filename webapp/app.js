@@ -12,6 +12,8 @@ const IMG_BASE = '/static/images';
 const IMG_VER = 'v=2';
 const REQUIRED_CARDS = 3;
 const DISPLAYED_CARDS = 9;
+const JOB_POLL_INTERVAL_MS = 2000;
+const JOB_POLL_TIMEOUT_MS = 180000;
 
 const TAROT_CARDS = {
     "00-TheFool": "Дурак",
@@ -305,6 +307,9 @@ async function confirmSelection() {
         clearTimeout(wakeTimer);
 
         const data = await response.json().catch(() => ({}));
+        if (response.status === 429) {
+            throw new Error('Сейчас очень много раскладов. Попробуйте ещё раз через минуту.');
+        }
         if (!response.ok) {
             const msg = data.error || ('Ошибка сервера: ' + response.status);
             if (msg.indexOf('question') !== -1 || msg.indexOf('вопрос') !== -1 || msg.indexOf('No question') !== -1) {
@@ -312,10 +317,12 @@ async function confirmSelection() {
             }
             throw new Error(msg);
         }
-        if (data.status !== 'ok') {
+        if (!data.job_id) {
             throw new Error(data.error || 'Сервер вернул неожиданный ответ.');
         }
 
+        await waitForJob(data, loadingText);
+
         loading.classList.add('hidden');
         document.getElementById('success').classList.remove('hidden');
         grid.classList.add('hidden');
@@ -344,6 +351,43 @@ async function confirmSelection() {
     }
 }
 
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+function showJobProgress(job, loadingText) {
+    if (!loadingText) return;
+    if (job.status === 'queued' && job.position > 1) {
+        loadingText.textContent = 'Вы в очереди: ' + job.position + '. Расклад скоро начнётся...';
+    } else {
+        loadingText.textContent = 'Толкуем карты...';
+    }
+}
+
+/** Опрос статуса задания гадания, пока бэкенд не закончит (результат придёт в чат) */
+async function waitForJob(job, loadingText) {
+    const deadline = Date.now() + JOB_POLL_TIMEOUT_MS;
+    while (job.status === 'queued' || job.status === 'running') {
+        showJobProgress(job, loadingText);
+        if (Date.now() > deadline) {
+            // Задание продолжит выполняться — ответ всё равно придёт в чат
+            return;
+        }
+        await sleep(JOB_POLL_INTERVAL_MS);
+        try {
+            const resp = await fetch(API_URL + '/api/webapp/jobs/' + encodeURIComponent(job.job_id) +
+                '?user_id=' + encodeURIComponent(userId));
+            if (resp.status === 404) return;
+            if (resp.ok) job = await resp.json();
+        } catch (e) {
+            console.warn('Job status poll failed:', e);
+        }
+    }
+    if (job.status === 'failed') {
+        throw new Error('Не удалось сделать расклад. Попробуйте ещё раз.');
+    }
+}
+
 function hapticFeedback(type) {
     try {
         if (!window._haptic) return;
@@ -9,61 +9,38 @@ Webhook сервер для приема уведомлений от ЮKassa —
 import asyncio
 import logging
 import json
-import aiohttp
 from aiohttp import web
 from aiohttp.web_request import Request
 from aiohttp.web_response import Response
 
+from main import json_codec
 from main.botdef import bot
 from main.config_reader import config
-from handlers.pay import PAYMENT_PACKAGES, PACKAGES_BY_ID
+from handlers.pay import PAYMENT_PACKAGES
 from keyboards.main_menu import make_back_to_menu_kb
 from main.database import (
     process_successful_payment as db_process_successful_payment,
-    Database, can_user_divinate, use_divination, save_divination, get_user_balance,
+    Database,
     get_pending_question, delete_pending_question, save_webapp_follow_up_context,
+    replace_webapp_follow_up_interpretation,
     update_user_blocked_status, is_send_blocked_error
 )
-from main.metrika_mp import send_conversion_event
-from main.conversions import save_conversion
-
-# Хранилище обработанных платежей для защиты от дубликатов
-processed_payments = set()
-
-
-async def _send_message_direct(user_id: int, text: str, keyboard=None):
-    """Отправить сообщение через Max API напрямую, минуя bot.session.
-    bot.send_message() зависит от сессии, которая создаётся внутри
-    start_polling(). При cold start на Render вебхук приходит раньше —
-    сессии нет. Эта функция работает всегда."""
-    token = config.effective_bot_token.get_secret_value()
-    url = "https://platform-api.max.ru/messages"
-    params = {"user_id": user_id}
-    headers = {"Authorization": token}
-
-    body = {"text": text, "format": "html", "notify": True}
-    if keyboard:
-        from aiomax import buttons as btn
-        if isinstance(keyboard, btn.KeyboardBuilder):
-            keyboard = keyboard.to_list()
-        body["attachments"] = [{
-            "type": "inline_keyboard",
-            "payload": {
-                "buttons": [
-                    [b.to_json() if hasattr(b, 'to_json') else b for b in row]
-                    for row in keyboard
-                ]
-            },
-        }]
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, params=params, headers=headers, json=body) as resp:
-            if resp.status in range(200, 300):
-                logging.info(f"Direct API: message sent to user {user_id}")
-                return True
-            error = await resp.text()
-            logging.error(f"Direct API: failed to send to user {user_id}: {resp.status} - {error}")
-            return False
+from main.metrika_mp import dispatcher as metrika_dispatcher
+from main.conversions import conversion_buffer
+from main.tasks import supervisor
+from main.job_queue import JobQueue, QueueFullError
+from main import metrics
+from main import idempotency
+from main import outbox
+from main import messages  # noqa: F401 — обработчик исходящих сообщений outbox
+from main import max_api
+from main import max_webhook
+from main import update_workers
+from main import credit_holds
+from main.yookassa import close_client as close_yookassa_client
+
+# Очередь гаданий из WebApp: не больше WEBAPP_WORKERS одновременных запросов к LLM
+webapp_jobs = JobQueue("webapp", workers=config.webapp_workers, max_queued=config.webapp_queue_size)
 
 
 async def yookassa_webhook_handler(request: Request) -> Response:
@@ -83,12 +60,13 @@ async def yookassa_webhook_handler(request: Request) -> Response:
             return web.Response(text="Empty body", status=400)
 
         try:
-            data = json.loads(request_body.decode('utf-8'))
+            data = json_codec.loads(request_body)
         except UnicodeDecodeError as e:
             logging.error(f"Failed to decode request body: {e}")
             return web.Response(text="Invalid encoding", status=400)
 
-        logging.info(f"Webhook data: {json.dumps(data, ensure_ascii=False, indent=2)}")
+        # Полный payload — только на DEBUG: сериализация ленивая, на INFO не тратим CPU
+        logging.debug("Webhook data: %s", json_codec.LazyJson(data))
 
         event_type = data.get("event")
         payment_object = data.get("object", {})
@@ -109,17 +87,18 @@ async def yookassa_webhook_handler(request: Request) -> Response:
             logging.error("Payment ID not found in webhook data")
             return web.Response(text="OK", status=200)
 
-        if payment_id in processed_payments:
-            logging.info(f"Payment {payment_id} already processed, skipping")
-            return web.Response(text="OK", status=200)
-
         if status != "succeeded":
             logging.info(f"Payment {payment_id} status is {status}, not succeeded")
             return web.Response(text="OK", status=200)
 
+        # Дубликаты доставки отсекаем до блокирующего UPDATE платежа (кэш → таблица processed_webhooks)
+        event_key = f"yookassa:{event_type}:{payment_id}"
+        if not await idempotency.claim(event_key):
+            logging.info(f"Payment {payment_id} already processed, skipping")
+            return web.Response(text="OK", status=200)
+
         user_id = metadata.get("user_id")
         package_id = metadata.get("package_id")
-        email = metadata.get("email")
 
         logging.info(
             f"Payment succeeded: payment_id={payment_id}, user_id={user_id}, "
@@ -128,72 +107,28 @@ async def yookassa_webhook_handler(request: Request) -> Response:
 
         if not user_id:
             logging.error("User ID not found in payment metadata")
+            await idempotency.complete(event_key)
             return web.Response(text="OK", status=200)
 
-        user_id = int(user_id)
-
-        package = None
-        if package_id:
-            package = PACKAGES_BY_ID.get(package_id)
-
-        # === 1. КРИТИЧНО: сначала обновляем БД ===
+        # Синхронно — только зачисление. Уведомление, цель Метрики и сброс FSM
+        # пишутся в outbox в той же транзакции и уходят воркером (main/outbox.py)
         db_updated = False
         try:
-            db_updated = await db_process_successful_payment(payment_id, yookassa_metadata=payment_object)
+            db_updated = await db_process_successful_payment(
+                payment_id, yookassa_metadata=payment_object, notify=True
+            )
             if db_updated:
                 logging.info(f"Payment {payment_id} processed successfully in database")
         except Exception as e:
             logging.error(f"CRITICAL: Failed to process payment {payment_id} in database: {e}", exc_info=True)
 
         if not db_updated:
+            await idempotency.release(event_key)
             logging.error(f"Returning 500 for payment {payment_id} so YooKassa retries")
             return web.Response(text="DB processing failed", status=500)
 
-        processed_payments.add(payment_id)
-        if len(processed_payments) > 1000:
-            processed_payments.clear()
-            processed_payments.add(payment_id)
-
-        # === 2. Аналитика (fire-and-forget) ===
-        try:
-            asyncio.create_task(send_conversion_event(user_id, 'purchase'))
-        except Exception:
-            pass
-
-        # === 3. Уведомление пользователю (best-effort, не влияет на статус) ===
-        try:
-            from handlers.pay import (
-                is_consultation_package,
-                build_consultation_success_text,
-                make_tarologist_contact_kb,
-            )
-
-            if is_consultation_package(package):
-                success_text = build_consultation_success_text(package.get('name', ''))
-                kb = make_tarologist_contact_kb()
-            else:
-                package_description = package.get('description', 'раскладам') if package else 'раскладам'
-                email_text = f"Чек отправлен на email: {email}\n\n" if email else ""
-                success_text = (
-                    f"✅ <b>Оплата успешно завершена!</b>\n\n"
-                    f"Спасибо за покупку! Теперь у тебя есть доступ к {package_description}.\n\n"
-                    f"{email_text}"
-                    f"🔮 Можешь начинать гадать! Используй команду /divination или выбери гадание из меню."
-                )
-                kb = make_back_to_menu_kb()
-
-            await _send_message_direct(user_id, success_text, keyboard=kb)
-        except Exception as e:
-            logging.warning(f"Could not send payment notification to user {user_id}: {e}")
-            if is_send_blocked_error(e):
-                await update_user_blocked_status(user_id, True)
-
-        # === 4. Очистка FSM (best-effort) ===
-        try:
-            bot.storage.clear(user_id)
-            logging.info(f"FSM state cleared for user {user_id} after successful payment")
-        except Exception as e:
-            logging.warning(f"Could not clear FSM state for user {user_id}: {e}")
+        await idempotency.complete(event_key)
+        outbox.worker.wake()
 
         return web.Response(text="OK", status=200)
 
@@ -228,7 +163,7 @@ async def webapp_cards_handler(request: Request) -> Response:
         if not body:
             return _json_error("Empty body", 400)
 
-        data = json.loads(body.decode('utf-8'))
+        data = json_codec.loads(body)
         user_id = data.get('user_id')
         selected_cards = data.get('selected_cards', [])
         question_from_body = data.get('question')
@@ -248,13 +183,36 @@ async def webapp_cards_handler(request: Request) -> Response:
             logging.info(f"WebApp cards 400: no question for user_id={user_id} (no body, no pending)")
             return _json_error("No question found. Enter your question in the app or start a divination in chat first.", 400)
 
-        can_div, access_type = await can_user_divinate(user_id)
-        if not can_div:
+        # Повторная отправка формы, пока гадание идёт, — статус текущего задания без резерва
+        active = webapp_jobs.active_job(user_id)
+        if active is not None:
+            return web.json_response(_job_payload(active), status=202)
+
+        # Резерв гадания до постановки в очередь
+        hold = await credit_holds.reserve(user_id, "Таро")
+        if hold is None:
+            from handlers.divination import track_divination_blocked
+            track_divination_blocked(user_id, "Таро", question)
             return _json_error("No divinations remaining", 403)
 
-        asyncio.ensure_future(_process_webapp_divination(user_id, question, selected_cards))
+        # Пока шёл резерв, задание могло появиться (параллельный запрос) — резерв возвращаем;
+        # дальше до submit нет await, гонки нет
+        active = webapp_jobs.active_job(user_id)
+        if active is not None:
+            await credit_holds.release(hold)
+            return web.json_response(_job_payload(active), status=202)
+
+        try:
+            job = webapp_jobs.submit(user_id, _process_webapp_divination(user_id, question, selected_cards, hold))
+        except QueueFullError:
+            await credit_holds.release(hold)
+            logging.warning(f"WebApp divination queue full, rejecting user_id={user_id}")
+            return web.json_response(
+                {"error": "Too many requests, try again in a minute"},
+                status=429, headers={"Retry-After": "30"}
+            )
 
-        return web.json_response({"status": "ok"})
+        return web.json_response(_job_payload(job), status=202)
 
     except json.JSONDecodeError:
         return _json_error("Invalid JSON", 400)
@@ -263,14 +221,41 @@ async def webapp_cards_handler(request: Request) -> Response:
         return _json_error(f"Internal error: {type(e).__name__}: {e}", 500)
 
 
-async def _process_webapp_divination(user_id: int, question: str, card_ids: list):
-    """Фоновая обработка гадания по картам из мини-приложения"""
-    from handlers.tarot_cards import get_card_info, send_card_images
-    from handlers.divination import get_chatgpt_response_with_prompt, TAROT_SYSTEM_PROMPT, TAROT_USER_INSTRUCTION
+def _job_payload(job) -> dict:
+    """Ответ WebApp о задании гадания: статус и позиция в очереди."""
+    return {
+        "status": job.status,
+        "job_id": job.job_id,
+        "position": webapp_jobs.position(job),
+    }
+
+
+async def webapp_job_status_handler(request: Request) -> Response:
+    """Статус задания гадания из WebApp (опрос из webapp/app.js)"""
+    job = webapp_jobs.get(request.match_info['job_id'])
+    user_id = request.query.get('user_id')
+    if not job or not user_id or str(job.user_id) != user_id:
+        return _json_error("Job not found", 404)
+    return web.json_response(_job_payload(job))
+
+
+async def _process_webapp_divination(user_id: int, question: str, card_ids: list, hold: dict) -> bool:
+    """
+    Фоновая обработка гадания по картам из мини-приложения (выполняется воркером webapp_jobs).
+    hold — резерв гадания (main/credit_holds.py), взятый при приёме запроса.
+    """
+    from handlers.tarot_cards import get_card_info, send_card_images, compose_offline_reading
+    from handlers.divination import (
+        get_chatgpt_response_with_prompt, TAROT_SYSTEM_PROMPT, tarot_user_prompt,
+        send_quietly, track_service_usage, llm_lane,
+        interpret_with_deadline, settle_reading, offline_note, spawn_full_interpretation,
+        track_divination_blocked, NO_DIVINATIONS_TEXT, abort_reading,
+    )
 
+    late_task = None
+    divination_id = None
+    settled = False
     try:
-        await send_card_images(bot, None, card_ids, as_media_group=True, user_id=user_id)
-
         cards_info = []
         positions = ["Прошлое", "Настоящее", "Будущее"]
         for i, card_id in enumerate(card_ids):
@@ -278,39 +263,27 @@ async def _process_webapp_divination(user_id: int, question: str, card_ids: list
             cards_info.append(f"{positions[i]}: {card['name']} — {card['meaning']}")
 
         system_prompt = TAROT_SYSTEM_PROMPT
-        chatgpt_question = (
-            f"Вопрос пользователя: {question}\n\n"
-            f"Выпавшие карты:\n" + "\n".join(cards_info) + "\n\n"
-            f"{TAROT_USER_INSTRUCTION}"
+        chatgpt_question = tarot_user_prompt(question, cards_info)
+
+        # Картинка карт и толкование — параллельно; LLM не успел — краткое толкование без ИИ
+        _, (chatgpt_response, late_task) = await asyncio.gather(
+            send_quietly(send_card_images(bot, None, card_ids, as_media_group=True, user_id=user_id), "изображение карт"),
+            interpret_with_deadline(get_chatgpt_response_with_prompt(
+                chatgpt_question, system_prompt, lane=llm_lane(hold['access_type']), hedge=True
+            )),
         )
-
-        chatgpt_response = await get_chatgpt_response_with_prompt(chatgpt_question, system_prompt)
-
-        balance_before = await get_user_balance(user_id)
-        is_free = balance_before and balance_before['free_divinations_remaining'] > 0 if balance_before else True
-
-        used = await use_divination(user_id)
-        if not used:
-            await bot.send_message(
-                "❌ Ошибка при списании гадания.",
-                user_id=user_id, keyboard=make_back_to_menu_kb()
-            )
-            return
-
-        divination_id = await save_divination(
-            user_id=user_id, divination_type="Таро", question=question,
-            selected_cards=card_ids, interpretation=chatgpt_response, is_free=is_free
+        offline = chatgpt_response is None
+        if offline:
+            chatgpt_response = compose_offline_reading(card_ids, question)
+
+        # Закрытие резерва и сохранение гадания — одной транзакцией
+        divination_id = await settle_reading(
+            hold, question=question, interpretation=chatgpt_response,
+            selected_cards=card_ids, offline=offline,
+            upgrade_pending=late_task is not None,
         )
-
-        if divination_id:
-            try:
-                await save_conversion(
-                    user_id=user_id, conversion_type='service_usage', divination_type="Таро",
-                    metadata={'divination_id': divination_id, 'card_ids': card_ids, 'is_free': is_free, 'method': 'webapp'}
-                )
-                asyncio.create_task(send_conversion_event(user_id, 'service_usage'))
-            except Exception as e:
-                logging.error(f"Error saving conversion: {e}", exc_info=True)
+        settled = True
+        is_free = hold['is_free']
 
         await delete_pending_question(user_id)
 
@@ -320,14 +293,15 @@ async def _process_webapp_divination(user_id: int, question: str, card_ids: list
             f"<b>Ваш вопрос:</b> <i>«{question}»</i>\n\n"
             f"<b>Карты:</b> {', '.join(cards_names)}\n\n"
             f"<b>Толкование:</b>\n{chatgpt_response}\n\n"
-            "💬 Хочешь уточнить расклад? Просто напиши свой вопрос.\n"
+            + (f"{offline_note(late_task is not None)}\n\n" if offline else "")
+            + "💬 Хочешь уточнить расклад? Просто напиши свой вопрос.\n"
             "🔮 Новый расклад — нажми ◀ В меню",
             user_id=user_id, keyboard=make_back_to_menu_kb(), format='html'
         )
 
         # Контекст уточняющих вопросов сохраняем в БД (FSM недоступен из HTTP)
         conversation_history = [
-            {"role": "user", "content": f"Мой вопрос: {question}"},
+            {"role": "user", "content": f"Мой вопрос: {question}\nВыпавшие карты:\n" + "\n".join(cards_info)},
             {"role": "assistant", "content": chatgpt_response}
         ]
         await save_webapp_follow_up_context(
@@ -338,18 +312,55 @@ async def _process_webapp_divination(user_id: int, question: str, card_ids: list
             original_interpretation=chatgpt_response
         )
 
+        if late_task is not None:
+            task, late_task = late_task, None
+            await spawn_full_interpretation(
+                task,
+                hold=hold,
+                divination_id=divination_id,
+                offline_text=chatgpt_response,
+                send=lambda text: bot.send_message(
+                    text, user_id=user_id, keyboard=make_back_to_menu_kb(), format='html'
+                ),
+                on_ready=lambda text: replace_webapp_follow_up_interpretation(user_id, divination_id, text),
+            )
+
         # Сбрасываем FSM-состояние (осталось selecting_cards), чтобы
         # handle_free_text_question мог подхватить уточняющий вопрос из БД
         try:
-            bot.storage.clear(user_id)
+            update_workers.clear_user_state(user_id)
             logging.info(f"FSM state cleared for user {user_id} after WebApp divination")
         except Exception as e:
             logging.error(f"Could not clear FSM state for user {user_id}: {e}", exc_info=True)
 
+        # Аналитика — после ответа пользователю
+        track_service_usage(
+            user_id, "Таро",
+            {'divination_id': divination_id, 'card_ids': card_ids, 'is_free': is_free,
+             'method': 'webapp', 'offline': offline}
+        )
+
         logging.info(f"WebApp divination completed for user {user_id}")
+        return True
+
+    except asyncio.CancelledError:
+        await abort_reading(hold, late_task=late_task, divination_id=divination_id, settled=settled)
+        raise
+
+    except credit_holds.HoldExpiredError as e:
+        logging.warning(f"WebApp reading of user {user_id} not charged: {e}")
+        track_divination_blocked(user_id, "Таро", question)
+        try:
+            await bot.send_message(
+                NO_DIVINATIONS_TEXT, user_id=user_id, keyboard=make_back_to_menu_kb(), format='html'
+            )
+        except Exception as send_error:
+            logging.error(f"Could not notify user {user_id}: {send_error}")
+        return False
 
     except Exception as e:
         logging.error(f"Error processing webapp divination for user {user_id}: {e}", exc_info=True)
+        await abort_reading(hold, late_task=late_task, divination_id=divination_id, settled=settled)
         if is_send_blocked_error(e):
             await update_user_blocked_status(user_id, True)
             logging.info(f"User {user_id} blocked the bot, updated status after webapp divination")
@@ -361,6 +372,7 @@ async def _process_webapp_divination(user_id: int, question: str, card_ids: list
                 )
             except Exception:
                 pass
+        return False
 
 
 def _json_error(message: str, status: int) -> Response:
@@ -380,13 +392,26 @@ async def health_check(request: Request) -> Response:
         return web.Response(text=f"Error: {str(e)}", status=503)
 
 
+async def internal_metrics_handler(request: Request) -> Response:
+    """
+    Внутренние метрики (пулы задач, очереди). Доступ — только с токеном METRICS_TOKEN
+    в заголовке X-Metrics-Token; без настроенного токена эндпоинт выключен (404).
+    """
+    token = config.metrics_token.get_secret_value() if config.metrics_token else None
+    if not token:
+        return web.Response(status=404)
+    if request.headers.get("X-Metrics-Token") != token:
+        return web.Response(status=403)
+    return web.json_response(metrics.snapshot(), dumps=json_codec.dumps)
+
+
 async def root_handler(request: Request) -> Response:
     """Обработчик корневого пути для отладки"""
     if request.method == "POST":
         try:
             body = await request.read()
-            data = json.loads(body.decode('utf-8'))
-            logging.warning(f"POST request to root path / - data: {json.dumps(data, ensure_ascii=False, indent=2)}")
+            data = json_codec.loads(body)
+            logging.warning("POST request to root path / - data: %s", json_codec.LazyJson(data))
             logging.warning(f"Webhook URL should be: {request.url.scheme}://{request.host}/webhook/yookassa")
         except Exception:
             logging.warning(f"POST request to root path / - could not parse body")
@@ -414,11 +439,15 @@ def create_webhook_app() -> web.Application:
     app = web.Application()
 
     app.router.add_post('/webhook/yookassa', yookassa_webhook_handler)
+    app.router.add_post(max_webhook.MAX_UPDATES_PATH, max_webhook.max_updates_handler)
     app.router.add_get('/api/webapp/pending-question', webapp_pending_question_handler)
     app.router.add_options('/api/webapp/pending-question', cors_preflight)
     app.router.add_post('/api/webapp/cards', webapp_cards_handler)
     app.router.add_options('/api/webapp/cards', cors_preflight)
+    app.router.add_get('/api/webapp/jobs/{job_id}', webapp_job_status_handler)
+    app.router.add_options('/api/webapp/jobs/{job_id}', cors_preflight)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/internal/metrics', internal_metrics_handler)
     app.router.add_post('/', root_handler)
     app.router.add_get('/', root_handler)
 
@@ -476,6 +505,8 @@ async def start_webhook_server(port: int = None):
         await site.start()
         logging.info(f"Webhook server started successfully on 0.0.0.0:{port}")
         logging.info(f"Webhook URL: {service_url}/webhook/yookassa")
+        if max_webhook.enabled():
+            logging.info(f"MAX updates URL: {service_url}{max_webhook.MAX_UPDATES_PATH}")
         logging.info(f"Health check: {service_url}/health")
     except Exception as e:
         logging.error(f"Failed to start webhook server: {e}", exc_info=True)
@@ -494,6 +525,7 @@ if __name__ == "__main__":
         runner = None
         try:
             runner = await start_webhook_server()
+            outbox.worker.start()
             logging.info("Webhook server is running. Press Ctrl+C to stop.")
             await asyncio.Event().wait()
         except KeyboardInterrupt:
@@ -504,6 +536,13 @@ if __name__ == "__main__":
         finally:
             if runner:
                 await runner.cleanup()
+            await webapp_jobs.stop()
+            await supervisor.drain()
+            await outbox.worker.stop()
+            await conversion_buffer.stop()
+            await metrika_dispatcher.stop()
+            await max_api.close_session()
+            await close_yookassa_client()
             await Database.close_pool()
             logging.info("Webhook server stopped")
 